@@ -44,14 +44,19 @@ classes = (
     byasp.YASP_OT_next,
     byasp.YASP_OT_prev,
     byasp.YASP_OT_setallKeyframes,
+    byasp.YASP_OT_animate_all_strips,
+    byasp.YASP_OT_energy_lipsync,
+    byasp.YASP_OT_purge_action_cache,
     byasp.YASP_OT_deleteallKeyframes,
     byasp.YASP_OT_delete_seq,
     bface.VIEW3D_PT_tools_openface,
     bface.VIEW3D_PT_pdm2d_openface,
     bface.FACE_OT_animate,
     bface.FACE_OT_clear_animation,
+    bface.FACE_OT_purge_openface_cache,
     bface.FACE_OT_pdm_del_animate,
     bface.FACE_OT_pdm2d_animate,
+    bface.FACE_OT_pdm_solve,
     bface.FACE_OT_pdm3d_rm_rotation,
 )
 
@@ -63,7 +68,7 @@ def register():
         name="FACS Rig name",
         subtype='FILE_NAME',
         default='',
-        description='name of FACS rig')
+        description='name of FACS rig. Separate the rigs of multi-face takes with commas')
 
     bpy.types.Scene.yafr_videofile = StringProperty(
         name="Path to video face reference",
@@ -91,17 +96,28 @@ def register():
         name="Polynomial Order",
         description='Polynomial order. Should be less than window size')
 
+    bpy.types.Scene.yafr_openface_filter = EnumProperty(
+        name="Smoothing Filter",
+        items=[('offline', 'Offline', 'Savitzky-Golay followed by a gaussian'),
+               ('live', 'Live (One Euro)', 'Causal adaptive low-pass, for live or streamed data'),
+               ('lowpass', 'Low-pass (IIR)', 'Causal Butterworth low-pass')],
+        default='offline',
+        description='Filters used to smooth the OpenFace data')
+
     bpy.types.Scene.yafr_openface_au_intensity = FloatProperty(
         name="Animation Intensity",
-        description='Increase intensity of animation by factor')
+        description='Increase intensity of animation by factor',
+        update=bface.update_intensity)
 
     bpy.types.Scene.yafr_openface_vgaze_intensity = FloatProperty(
         name="Vertical Gaze Intensity",
-        description='Increase intensity of vertical gaze by factor')
+        description='Increase intensity of vertical gaze by factor',
+        update=bface.update_intensity)
 
     bpy.types.Scene.yafr_openface_hgaze_intensity = FloatProperty(
         name="Horizontal Gaze Intensity",
-        description='Increase intensity of horizontal gaze by factor')
+        description='Increase intensity of horizontal gaze by factor',
+        update=bface.update_intensity)
 
     bpy.types.Scene.yafr_openface_mouth = BoolProperty(
         name="Enable Mouth",
@@ -113,6 +129,28 @@ def register():
         description="Enable head animation",
         default=True)
 
+    bpy.types.Scene.yafr_openface_resample = BoolProperty(
+        name="Resample to Scene FPS",
+        description="Use the timestamps of the OpenFace data to key it on the scene's frames",
+        default=True)
+
+    bpy.types.Scene.yafr_openface_eye_landmarks = BoolProperty(
+        name="Eyes from Landmarks",
+        description="Derive the blinks and the gaze from the eye landmarks instead of OpenFace's AU45 and gaze angles",
+        default=False)
+
+    bpy.types.Scene.yafr_openface_jobs = IntProperty(
+        name="OpenFace Processes",
+        default=1,
+        min=1,
+        description='Split the video into this many segments and run OpenFace on them in parallel. Needs ffmpeg')
+
+    bpy.types.Scene.yafr_openface_overlap = FloatProperty(
+        name="Segment Overlap",
+        default=1.0,
+        min=0.0,
+        description='Seconds before every segment OpenFace tracks the face for, and which are dropped')
+
     bpy.types.Scene.yafr_pdm_2d = BoolProperty(
         name="2D Plotting",
         description="plot 2D data",
@@ -123,6 +161,17 @@ def register():
         description="plot all the data provided",
         default=False)
 
+    bpy.types.Scene.yafr_pdm_calibration = StringProperty(
+        name="Path to calibration file",
+        subtype='FILE_PATH',
+        default='',
+        description='JSON file with the frames of the neutral and extreme poses of the sliders in a calibration csv')
+
+    bpy.types.Scene.yafr_pdm_bounded = BoolProperty(
+        name="Bounded Weights",
+        description="Keep the solved slider weights between 0 and 1",
+        default=True)
+
     bpy.types.Scene.yasp_phoneme_rig = StringProperty(
         name="Phoneme Rig Name",
         subtype='FILE_NAME',
@@ -149,11 +198,57 @@ def register():
         name="Avg Window",
         description='Average keyframe values within the window')
 
+    bpy.types.Scene.yasp_coarticulation = BoolProperty(
+        name="Coarticulation",
+        description="Blend visemes of neighbouring phonemes on every frame instead of keying markers",
+        default=True)
+
+    bpy.types.Scene.yasp_energy_gain = FloatProperty(
+        name="Energy Gain",
+        default=1.0,
+        min=0.0,
+        description='How far the loudness of the audio opens the mouth in energy lip-sync')
+
+    bpy.types.Scene.yasp_log_level = EnumProperty(
+        name="Log Level",
+        items=[('0', 'Debug', 'Keep all aligner messages'),
+               ('1', 'Info', 'Keep informational messages and above'),
+               ('3', 'Warning', 'Keep warnings and errors'),
+               ('4', 'Error', 'Keep errors only')],
+        default='3',
+        description='Lowest level of aligner messages to keep')
+
+    bpy.types.Scene.yasp_log_path = StringProperty(
+        name="Path to log file",
+        subtype='FILE_PATH',
+        default='',
+        description='Optionally write the aligner log to this file')
+
+    bpy.types.Scene.yasp_trace_path = StringProperty(
+        name="Path to trace file",
+        subtype='FILE_PATH',
+        default='',
+        description='Optionally record operator timings to this Chrome trace file')
+
+    bpy.types.Scene.yasp_action_cache = BoolProperty(
+        name="Reuse Cached Actions",
+        description="Bake generated animation into Actions cached by their inputs, and reuse them when the inputs are the same",
+        default=True)
+
     bface.set_init_state(True)
+    bpy.app.handlers.load_post.append(byasp.yasp_load_post)
+    bpy.app.handlers.load_post.append(bface.yafr_load_post)
+    bpy.app.handlers.save_pre.append(byasp.yasp_save_pre)
 
 def unregister():
     for cls in reversed(classes):
         bpy.utils.unregister_class(cls)
+    if byasp.yasp_load_post in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(byasp.yasp_load_post)
+    if bface.yafr_load_post in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(bface.yafr_load_post)
+    if byasp.yasp_save_pre in bpy.app.handlers.save_pre:
+        bpy.app.handlers.save_pre.remove(byasp.yasp_save_pre)
 
 if __name__ == "__main__":
     register()
@@ -0,0 +1,87 @@
+import bpy
+import os
+import logging
+from . import file_cache
+
+logger = logging.getLogger(__name__)
+
+action_cache = None
+
+# Generated animation baked into Actions. Every entry is a library .blend,
+# <root>/<key>.blend, holding the Actions of one generation by role, e.g.
+# face.0 or head. The key is a hash of the content of the input files and
+# of the parameters, so the same inputs give back the same Actions in any
+# .blend, for any rig with the same bones.
+class ActionCache(file_cache.FileCache):
+    def get_path(self, key):
+        return os.path.join(self.root, key + '.blend')
+
+    def lookup(self, key):
+        entry = self.load()['entries'].get(key)
+        if not entry or not os.path.isfile(self.get_path(key)):
+            return None
+        return entry
+
+    # Store the actions, a dict of role -> Action. They're renamed after
+    # the key and tagged with it.
+    def store(self, key, label, files, actions):
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        names = {}
+        for role, action in actions.items():
+            action.name = 'YASP_%s_%s' % (role, key[:8])
+            action['yasp_cache_key'] = key
+            names[role] = action.name
+        path = self.get_path(key)
+        bpy.data.libraries.write(path, set(actions.values()),
+                                 fake_user=True)
+        self.add_entry(key, files, {'label': label, 'actions': names,
+                                    'size': os.path.getsize(path)})
+
+    # The Actions of the key by role. Actions already in the file are used
+    # as they are, the others are appended from the library.
+    def get_actions(self, key):
+        entry = self.lookup(key)
+        if not entry:
+            return None
+        actions = {}
+        missing = {}
+        for role, name in entry['actions'].items():
+            action = bpy.data.actions.get(name)
+            if action and action.get('yasp_cache_key') == key:
+                actions[role] = action
+            else:
+                missing[role] = name
+        if not missing:
+            return actions
+        roles = list(missing.keys())
+        with bpy.data.libraries.load(self.get_path(key), link=False) as \
+             (data_from, data_to):
+            data_to.actions = [missing[r] for r in roles]
+        for role, action in zip(roles, data_to.actions):
+            if not action:
+                return None
+            action.use_fake_user = False
+            actions[role] = action
+        return actions
+
+def get_action_cache():
+    global action_cache
+    if not action_cache:
+        action_cache = ActionCache(file_cache.get_cache_dir('actions'))
+    return action_cache
+
+def assign_action(rig, action):
+    if not rig.animation_data:
+        rig.animation_data_create()
+    rig.animation_data.action = action
+
+def get_action(rig):
+    if not rig.animation_data:
+        return None
+    return rig.animation_data.action
+
+# the action is being changed, it's not the cached one anymore
+def forget_action(action):
+    if action and 'yasp_cache_key' in action:
+        del action['yasp_cache_key']
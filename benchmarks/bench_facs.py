@@ -0,0 +1,128 @@
+# Benchmark the facs_process stages on synthetic OpenFace takes.
+#
+#   python benchmarks/bench_facs.py [-n 1000 10000 100000] [-o bench_facs.json]
+#   blender --background --python benchmarks/bench_facs.py -- -n 1000 500000
+#
+# parse, process, the AU table, the other tables and export are timed
+# separately. A second pass under tracemalloc records the peak memory of
+# each stage; skip it with --no-memory on long takes, tracemalloc slows
+# everything down a lot.
+# The synthetic takes are kept in --cache-dir and reused between runs.
+import os
+import sys
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import common
+import synth_openface
+
+def get_take(cache_dir, nframes, faces, seed):
+    path = os.path.join(cache_dir, 'openface_%d_%d_%d.csv' % (nframes, faces,
+                                                             seed))
+    if not os.path.isfile(path):
+        print('generating', path, file=sys.stderr)
+        synth_openface.write_openface_csv(path + '.tmp', nframes,
+                                          faces=faces, seed=seed)
+        os.rename(path + '.tmp', path)
+    return path
+
+# Tables are processed the first time they're asked for. process only
+# sets up the processing, animation_data processes the AUs the way
+# Animate Face does, tables processes the rest of the tables of every
+# take.
+def process_tables(facs, names):
+    for t in facs.get_takes():
+        for name in names:
+            t.get_table(name)
+
+def stages(facs, csv, window_size, polyorder, fps, profile):
+    names = facs.csv_table_names + list(facs.feature_sources)
+    return [('parse', lambda: facs.load_openface_csv(csv)),
+            ('process', lambda: facs.process_database(window_size, polyorder,
+                                                      fps, profile)),
+            ('animation_data', lambda: process_tables(facs,
+                                                      ['animation_data'])),
+            ('tables', lambda: process_tables(facs, names)),
+            ('export', facs.export_database)]
+
+def run_take(facs, csv, window_size, polyorder, fps, profile, memory):
+    result = {}
+    facs.reset_database()
+    for name, fn in stages(facs, csv, window_size, polyorder, fps, profile):
+        t, _ = common.timed(fn)
+        result[name] = {'time': t}
+    result['total'] = {'time': sum(v['time'] for v in result.values())}
+    result['rows'] = len(facs.get_facs_data()['frame'][facs.VALUES])
+    channels = 0
+    for table in [facs.get_facs_data(), facs.get_pdm2d_data(),
+                  facs.get_pdm3d_data(), facs.get_rigid_data(),
+                  facs.get_non_rigid_data()]:
+        channels = channels + len(table)
+    result['channels'] = channels
+
+    if memory:
+        facs.reset_database()
+        tracemalloc.start()
+        for name, fn in stages(facs, csv, window_size, polyorder, fps, profile):
+            tracemalloc.reset_peak()
+            fn()
+            result[name]['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    facs.reset_database()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='facs_process benchmark')
+    parser.add_argument('-n', '--frames', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('-o', '--output', default='bench_facs.json',
+                        help='results file, - for stdout')
+    parser.add_argument('--faces', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--window-size', type=int, default=5)
+    parser.add_argument('--polyorder', type=int, default=2)
+    parser.add_argument('--profile', default='offline',
+                        help='facs_process filter profile')
+    parser.add_argument('--fps', type=float, default=0,
+                        help='resample the takes to this frame rate')
+    parser.add_argument('--no-memory', action='store_true')
+    parser.add_argument('--trace', default='',
+                        help="write the add-on's timing spans to this "
+                             "Chrome trace file")
+    parser.add_argument('--cache-dir',
+                        default=os.path.join(tempfile.gettempdir(),
+                                             'yasp_bench'))
+    args = parser.parse_args(common.script_args())
+
+    os.makedirs(args.cache_dir, exist_ok=True)
+    common.ensure_bpy()
+    facs = common.import_addon('facs_process')
+    facs.init_database()
+    # keep the scipy import out of the first take's smoothing time
+    facs.smooth_array([0.0] * 16, args.window_size, args.polyorder)
+
+    results = {'window_size': args.window_size,
+               'polyorder': args.polyorder,
+               'faces': args.faces,
+               'fps': args.fps,
+               'profile': args.profile,
+               'takes': {}}
+    common.start_trace(args.trace)
+    for n in args.frames:
+        csv = get_take(args.cache_dir, n, args.faces, args.seed)
+        r = run_take(facs, csv, args.window_size, args.polyorder, args.fps,
+                     args.profile, not args.no_memory)
+        r['csv_bytes'] = os.path.getsize(csv)
+        results['takes'][str(n)] = r
+        print('%8d frames: %s' % (n, ', '.join('%s %.3fs' % (k, r[k]['time'])
+              for k in ['parse', 'process', 'animation_data', 'tables',
+                        'export', 'total'] if k in r)),
+              file=sys.stderr)
+
+    common.finish_trace(args.trace)
+    common.write_results(args.output, 'facs_process', results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+# Benchmark the Blender side keyframing paths on synthetic data.
+#
+#   blender --background --factory-startup --python benchmarks/bench_keyframing.py -- [options]
+#   python benchmarks/bench_keyframing.py [options]
+#
+# Stages:
+#   yasp_markers        byasp.Sequence.animate_all_markers(), per marker
+#                       heuristics and Bone.heuristic_pass2()
+#   yasp_coarticulated  byasp.Sequence.animate_all_markers() with
+#                       coarticulation
+#   yasp_batch          byasp.SequenceMgr.animate_all_sequences() over
+#                       --strips strips spread across two rigs
+#   heuristic_pass2     byasp.Bone.heuristic_pass2() alone
+#   animate_face        bface.FACE_OT_animate.animate_face()
+#   pdm2d_animate       bface.FACE_OT_pdm2d_animate.animate_pdm2d()
+#
+# Each stage is timed on a fresh scene. A second pass under tracemalloc
+# records the peak python memory of each stage (--no-memory skips it).
+# Without Blender a bpy stand-in is used (see bpy_stub.py): it measures
+# the add-on's own python overhead, not Blender's.
+import os
+import sys
+import types
+import random
+import logging
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import common
+
+bpy, real_bpy = common.ensure_bpy()
+
+# Calls operator methods without going through bpy.ops, so the methods
+# under test can be driven with synthetic data.
+class OperatorProxy(object):
+    def __init__(self, cls):
+        self.op_class = cls
+        self.reports = []
+
+    def __getattr__(self, name):
+        attr = getattr(self.op_class, name)
+        if callable(attr):
+            return types.MethodType(attr, self)
+        return attr
+
+    def report(self, level, msg):
+        self.reports.append((level, msg))
+
+def new_armature(name, data_name, bone_names):
+    if not real_bpy:
+        import bpy_stub
+        return bpy_stub.new_armature(name, data_name, bone_names)
+
+    arm = bpy.data.armatures.new(data_name)
+    obj = bpy.data.objects.new(name, arm)
+    bpy.context.scene.collection.objects.link(obj)
+    bpy.context.view_layer.objects.active = obj
+    bpy.ops.object.mode_set(mode='EDIT')
+    for i, b in enumerate(bone_names):
+        eb = arm.edit_bones.new(b)
+        eb.head = (i * 0.1, 0, 0)
+        eb.tail = (i * 0.1, 0, 0.1)
+    bpy.ops.object.mode_set(mode='OBJECT')
+    return obj
+
+def reset_scene():
+    if not real_bpy:
+        import bpy_stub
+        bpy_stub.reset()
+        return
+    if bpy.context.object and bpy.context.object.mode != 'OBJECT':
+        bpy.ops.object.mode_set(mode='OBJECT')
+    for obj in list(bpy.data.objects):
+        bpy.data.objects.remove(obj)
+    for act in list(bpy.data.actions):
+        bpy.data.actions.remove(act)
+    for arm in list(bpy.data.armatures):
+        bpy.data.armatures.remove(arm)
+    bpy.context.scene.timeline_markers.clear()
+
+def count_keys():
+    total = 0
+    for act in bpy.data.actions:
+        for fc in act.fcurves:
+            total = total + len(fc.keyframe_points)
+    return total
+
+def synth_phoneme_track(byasp, nmarkers, rng):
+    names = [p for p in byasp.yasp_process.yasp_phonemes \
+             if byasp.get_yaspmapper().get_phoneme_animation_data(p)]
+    names = names + ['SIL']
+    markers = []
+    frame = 1
+    for i in range(nmarkers):
+        frame = frame + rng.choice([1, 2, 2, 3, 3, 4, 6, 9, 14])
+        markers.append((rng.choice(names), frame))
+    return markers
+
+def yasp_stage(addon, args, rng, coarticulation):
+    byasp = addon.byasp
+    scn = bpy.context.scene
+    scn.yasp_coarticulation = coarticulation
+    scn.yasp_avg_window_size = args.window_size
+    bones = ['ph_' + v for v in byasp.get_yaspmapper().get_visemes()]
+    rig = new_armature('MBLab_skeleton_phoneme_rig',
+                       'MBLab_skeleton_phoneme_rig', bones + ['ph_REST'])
+    bpy.context.view_layer.objects.active = rig
+    bpy.ops.object.mode_set(mode='POSE')
+    seq = byasp.Sequence(None)
+    for name, frame in synth_phoneme_track(byasp, args.markers, rng):
+        seq.mark_seq_at_frame(name, frame, scn)
+    seq.set_bones(rig.pose.bones)
+
+    def run():
+        seq.animate_all_markers()
+        return count_keys()
+    return run
+
+# stands in for a sound strip, only its custom properties are looked at.
+# Strips are only equal to themselves, like Blender's.
+class Strip(dict):
+    name = 'strip'
+    __eq__ = object.__eq__
+    __ne__ = object.__ne__
+    __hash__ = object.__hash__
+
+def yasp_batch_stage(addon, args, rng):
+    byasp = addon.byasp
+    scn = bpy.context.scene
+    scn.yasp_coarticulation = args.coarticulation
+    scn.yasp_avg_window_size = args.window_size
+    bones = ['ph_' + v for v in byasp.get_yaspmapper().get_visemes()]
+    rigs = ['phoneme_rig_a', 'phoneme_rig_b']
+    for name in rigs:
+        new_armature(name, name, bones + ['ph_REST'])
+    mgr = byasp.SequenceMgr()
+    per_strip = max(1, args.markers // args.strips)
+    track = synth_phoneme_track(byasp, per_strip * args.strips, rng)
+    for i in range(args.strips):
+        strip = Strip(yasp_rig=rigs[i % len(rigs)])
+        mgr.add_sequence(strip)
+        seq = mgr.get_sequence(strip)
+        for name, frame in track[i * per_strip:(i + 1) * per_strip]:
+            seq.mark_seq_at_frame(name, frame, scn)
+
+    def run():
+        mgr.animate_all_sequences(scn)
+        return count_keys()
+    return run
+
+def heuristic_stage(addon, args, rng):
+    byasp = addon.byasp
+    bones = ['ph_%d' % i for i in range(args.bones)]
+    rig = new_armature('heuristic_rig', 'heuristic_rig', bones)
+    wrappers = []
+    for pb in rig.pose.bones:
+        b = byasp.Bone(pb)
+        frame = 1
+        for i in range(args.markers):
+            frame = frame + rng.randint(1, 6)
+            b.insert_keyframe(frame, rng.random())
+        wrappers.append(b)
+
+    def run():
+        for b in wrappers:
+            b.heuristic_pass2(float(args.window_size))
+        return len(wrappers) * args.markers
+    return run
+
+def synth_table(facs, names, nframes, rng):
+    import numpy as np
+
+    t = np.arange(nframes)
+    noise = np.random.default_rng(rng.randint(0, 1 << 30))
+    table = {'frame': [t.tolist(), [], []],
+             'timestamp': [(t / 30.0).tolist(), [], []]}
+    for name in names:
+        if name in table:
+            continue
+        freq = rng.uniform(0.01, 0.2)
+        # slow motion with tracking jitter, which is what produces most of
+        # the extrema on real takes
+        values = np.sin(t * freq + rng.uniform(0, 6)) + 1 + \
+                 noise.normal(0, 0.02, nframes)
+        values = values.tolist()
+        maximas, minimas = facs.find_extrema(values)
+        table[name] = [values, maximas, minimas]
+    return table
+
+def animate_face_stage(addon, args, rng):
+    bface = addon.bface
+    facs = bface.load_facs()
+    scn = bpy.context.scene
+    scn.yafr_start_frame = 0
+    scn.yafr_facs_rig = ''
+    sliders = []
+    for k in facs.facs_data_items:
+        if 'AU' in k:
+            sliders.append('facs_rig_slider_' + k.strip('_r'))
+    sliders = sliders + ['facs_rig_slider_GZ0H', 'facs_rig_slider_GZ0V']
+    new_armature('MBLab_skeleton_facs_rig', 'MBLab_skeleton_facs_rig',
+                 sliders)
+    new_armature('MBLab_skeleton_base_ik', 'MBLab_skeleton_base_ik',
+                 ['head'])
+    table = synth_table(facs, facs.facs_data_items, args.frames, rng)
+    bface.global_sliders_set = False
+    op = OperatorProxy(bface.FACE_OT_animate)
+
+    def run():
+        op.animate_face(True, True, table, 0.5, 0.5, 0.5)
+        return count_keys()
+    return run
+
+def pdm2d_stage(addon, args, rng):
+    bface = addon.bface
+    facs = bface.load_facs()
+    names = ['x_%d' % i for i in range(facs.MAX_PDM_ENTRIES)] + \
+            ['y_%d' % i for i in range(facs.MAX_PDM_ENTRIES)]
+    pdm_2d = synth_table(facs, names, args.frames, rng)
+    rigid = synth_table(facs, facs.rigid_data_items, args.frames, rng)
+    features = synth_table(facs, [f[0] for f in facs.distance_feature_points],
+                           args.frames, rng)
+    bpy.context.scene.yafr_start_frame = 0
+    bface.plot_all = False
+    op = OperatorProxy(bface.FACE_OT_pdm2d_animate)
+
+    def run():
+        op.animate_pdm2d(pdm_2d, rigid, features)
+        return count_keys()
+    return run
+
+stage_builders = {
+    'yasp_markers': lambda a, args, rng: yasp_stage(a, args, rng, False),
+    'yasp_coarticulated': lambda a, args, rng: yasp_stage(a, args, rng, True),
+    'yasp_batch': yasp_batch_stage,
+    'heuristic_pass2': heuristic_stage,
+    'animate_face': animate_face_stage,
+    'pdm2d_animate': pdm2d_stage,
+}
+
+def run_stage(addon, name, args, memory):
+    reset_scene()
+    rng = random.Random(args.seed)
+    run = stage_builders[name](addon, args, rng)
+    if memory:
+        tracemalloc.start()
+    t, keys = common.timed(run)
+    result = {'time': t, 'keys': keys,
+              'keys_per_second': keys / t if t > 0 else 0}
+    if memory:
+        result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='keyframing benchmark')
+    parser.add_argument('-o', '--output', default='bench_keyframing.json',
+                        help='results file, - for stdout')
+    parser.add_argument('--stages', nargs='+', default=list(stage_builders),
+                        choices=list(stage_builders))
+    parser.add_argument('--markers', type=int, default=2000,
+                        help='phoneme markers / keys per bone')
+    parser.add_argument('--strips', type=int, default=20,
+                        help='strips for yasp_batch')
+    parser.add_argument('--coarticulation', action='store_true',
+                        help='use coarticulation in yasp_batch')
+    parser.add_argument('--bones', type=int, default=12,
+                        help='bones for heuristic_pass2')
+    parser.add_argument('--frames', type=int, default=2000,
+                        help='frames of the synthetic FACS tables')
+    parser.add_argument('--window-size', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true')
+    parser.add_argument('--trace', default='',
+                        help="write the add-on's timing spans to this "
+                             "Chrome trace file")
+    parser.add_argument('--verbose', action='store_true',
+                        help="keep the add-on's logging")
+    args = parser.parse_args(common.script_args())
+
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+
+    addon = common.import_addon()
+    addon.register()
+
+    results = {'blender': real_bpy, 'markers': args.markers,
+               'bones': args.bones, 'frames': args.frames, 'stages': {}}
+    common.start_trace(args.trace)
+    for name in args.stages:
+        r = run_stage(addon, name, args, False)
+        if not args.no_memory:
+            r['peak_memory'] = run_stage(addon, name, args,
+                                         True)['peak_memory']
+        results['stages'][name] = r
+        print('%-20s %8.3fs %8d keys %10.0f keys/s' % (name, r['time'],
+              r['keys'], r['keys_per_second']), file=sys.stderr)
+    results['total_time'] = sum(r['time'] for r in
+                                results['stages'].values())
+
+    common.finish_trace(args.trace)
+    reset_scene()
+    addon.unregister()
+    common.write_results(args.output, 'keyframing', results)
+
+if __name__ == '__main__':
+    main()
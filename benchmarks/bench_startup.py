@@ -0,0 +1,72 @@
+# Measure what enabling the add-on costs at Blender startup, and what is
+# deferred until an operator is first used.
+#
+#   blender --background --factory-startup --python benchmarks/bench_startup.py -- [-o out.json]
+#   python benchmarks/bench_startup.py [-o out.json]
+#
+# Without Blender a bpy stand-in is used (see bpy_stub.py). Run it in a
+# fresh process each time: import timings are only meaningful the first
+# time a module is imported.
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import common
+
+def deferred_stages(addon):
+    byasp = addon.byasp
+    bface = addon.bface
+    stages = [('yasp_libraries', byasp.load_yasp),
+              ('phoneme_map', byasp.get_yaspmapper),
+              ('facs_tables', bface.load_facs)]
+
+    def load_filters():
+        import scipy.signal
+        import scipy.ndimage
+
+    def load_plotting():
+        try:
+            import matplotlib.pyplot
+        except ImportError:
+            return False
+        return True
+
+    stages.append(('scipy_filters', load_filters))
+    stages.append(('matplotlib', load_plotting))
+    return stages
+
+def main():
+    parser = argparse.ArgumentParser(description='add-on startup benchmark')
+    parser.add_argument('-o', '--output', default='-',
+                        help='results file, - for stdout')
+    args = parser.parse_args(common.script_args())
+
+    bpy, real_bpy = common.ensure_bpy()
+
+    results = {'blender': real_bpy}
+    t_import, addon = common.timed(common.import_addon)
+    t_register, _ = common.timed(addon.register)
+    results['import'] = t_import
+    results['register'] = t_register
+    results['startup'] = t_import + t_register
+
+    deferred = {}
+    for name, fn in deferred_stages(addon):
+        try:
+            t, rc = common.timed(fn)
+            deferred[name] = {'time': t, 'ok': rc is not False}
+        except Exception as e:
+            deferred[name] = {'time': 0, 'ok': False, 'error': str(e)}
+    results['deferred'] = deferred
+    deferred_total = sum(v['time'] for v in deferred.values())
+    results['deferred_total'] = deferred_total
+    # this is what startup used to cost when everything was loaded on
+    # import
+    results['eager_startup'] = results['startup'] + deferred_total
+
+    addon.unregister()
+    common.write_results(args.output, 'startup', results)
+
+if __name__ == '__main__':
+    main()
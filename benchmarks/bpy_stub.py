@@ -0,0 +1,422 @@
+import sys
+import types
+
+# A minimal stand-in for the parts of bpy the add-on touches, so the
+# benchmarks can run under a plain python interpreter. Nothing is drawn or
+# evaluated, but keyframes end up in F-curves on actions like they do in
+# Blender, so keys written can be counted.
+
+class Property(object):
+    defaults = {'BoolProperty': False, 'BoolVectorProperty': (),
+                'EnumProperty': '', 'FloatProperty': 0.0,
+                'IntProperty': 0, 'StringProperty': ''}
+
+    def __init__(self, kind, kwargs):
+        self.kind = kind
+        self.kwargs = kwargs
+        self.name = None
+
+    def get_name(self, owner):
+        if not self.name:
+            for k, v in vars(owner).items():
+                if v is self:
+                    self.name = k
+        return self.name
+
+    def default(self):
+        if 'default' in self.kwargs:
+            return self.kwargs['default']
+        if self.kind == 'EnumProperty' and self.kwargs.get('items'):
+            return self.kwargs['items'][0][0]
+        return self.defaults[self.kind]
+
+    def __get__(self, obj, owner):
+        if obj is None:
+            return self
+        return obj.__dict__.get(self.get_name(owner), self.default())
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.get_name(type(obj))] = value
+
+def prop_factory(kind):
+    def prop(**kwargs):
+        return Property(kind, kwargs)
+    return prop
+
+# An ordered collection of named items, indexable by name or position
+class Collection(object):
+    def __init__(self, factory=None):
+        self.items_list = []
+        self.factory = factory
+
+    def __iter__(self):
+        return iter(list(self.items_list))
+
+    def __len__(self):
+        return len(self.items_list)
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self.items_list[key]
+        for item in self.items_list:
+            if item.name == key:
+                return item
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [i.name for i in self.items_list]
+
+    def values(self):
+        return list(self.items_list)
+
+    def items(self):
+        return [(i.name, i) for i in self.items_list]
+
+    def link(self, item):
+        self.items_list.append(item)
+        return item
+
+    def new(self, *args, **kwargs):
+        return self.link(self.factory(*args, **kwargs))
+
+    def remove(self, item, **kwargs):
+        if item in self.items_list:
+            self.items_list.remove(item)
+
+class KeyframePoints(object):
+    def __init__(self):
+        self.points = []
+
+    def __len__(self):
+        return len(self.points)
+
+    def __iter__(self):
+        return iter(self.points)
+
+    def add(self, count):
+        self.points.extend([[0.0, 0.0] for i in range(count)])
+
+    def insert(self, frame, value):
+        for p in self.points:
+            if p[0] == frame:
+                p[1] = value
+                return p
+        p = [float(frame), value]
+        self.points.append(p)
+        self.points.sort()
+        return p
+
+    def delete(self, frame):
+        for p in self.points:
+            if p[0] == frame:
+                self.points.remove(p)
+                return True
+        return False
+
+    def foreach_set(self, attr, seq):
+        for i, p in enumerate(self.points):
+            p[0] = seq[2 * i]
+            p[1] = seq[2 * i + 1]
+
+    def foreach_get(self, attr, seq):
+        for i, p in enumerate(self.points):
+            seq[2 * i] = p[0]
+            seq[2 * i + 1] = p[1]
+
+class FCurve(object):
+    def __init__(self, data_path, index=0, action_group=''):
+        self.data_path = data_path
+        self.array_index = index
+        self.group = action_group
+        self.keyframe_points = KeyframePoints()
+
+    def update(self):
+        self.keyframe_points.points.sort()
+
+class FCurves(Collection):
+    def __init__(self):
+        Collection.__init__(self, FCurve)
+
+    def find(self, data_path, index=0):
+        for fc in self.items_list:
+            if fc.data_path == data_path and fc.array_index == index:
+                return fc
+        return None
+
+class Action(object):
+    def __init__(self, name):
+        self.name = name
+        self.fcurves = FCurves()
+
+class AnimData(object):
+    def __init__(self):
+        self.action = None
+
+# Keyframe insertion shared by objects and pose bones. path_prefix is
+# where the animated struct lives relative to the object holding the
+# action.
+class Animatable(object):
+    path_prefix = ''
+
+    def owner(self):
+        return self
+
+    def get_fcurve(self, data_path, index, create):
+        owner = self.owner()
+        if not owner.animation_data:
+            if not create:
+                return None
+            owner.animation_data_create()
+        if not owner.animation_data.action:
+            if not create:
+                return None
+            owner.animation_data.action = \
+                data.actions.new(owner.name + 'Action')
+        path = self.path_prefix + data_path
+        fcurves = owner.animation_data.action.fcurves
+        fc = fcurves.find(path, index=index)
+        if not fc and create:
+            fc = fcurves.new(path, index=index)
+        return fc
+
+    def keyframe_insert(self, data_path, index=-1, frame=0, **kwargs):
+        values = getattr(self, data_path)
+        indices = range(len(values)) if index < 0 else [index]
+        for i in indices:
+            self.get_fcurve(data_path, i, True).keyframe_points.insert(
+                frame, values[i])
+        return True
+
+    def keyframe_delete(self, data_path, index=-1, frame=0, **kwargs):
+        values = getattr(self, data_path)
+        indices = range(len(values)) if index < 0 else [index]
+        deleted = False
+        for i in indices:
+            fc = self.get_fcurve(data_path, i, False)
+            if fc and fc.keyframe_points.delete(frame):
+                deleted = True
+        if not deleted:
+            raise RuntimeError('no keyframe to delete')
+        return True
+
+class PoseBone(Animatable):
+    def __init__(self, name, id_data):
+        self.name = name
+        self.id_data = id_data
+        self.path_prefix = 'pose.bones["%s"].' % name
+        self.location = [0.0, 0.0, 0.0]
+        self.rotation_quaternion = [1.0, 0.0, 0.0, 0.0]
+
+    def owner(self):
+        return self.id_data
+
+class Pose(object):
+    def __init__(self):
+        self.bones = Collection()
+
+class ObjectData(object):
+    def __init__(self, name):
+        self.name = name
+
+class Object(Animatable):
+    def __init__(self, name, object_data=None, type='EMPTY'):
+        self.name = name
+        self.data = object_data
+        self.type = type
+        self.pose = None
+        self.animation_data = None
+        self.selected = False
+        self.rotation_mode = 'XYZ'
+        self.location = [0.0, 0.0, 0.0]
+        self.rotation_quaternion = [1.0, 0.0, 0.0, 0.0]
+        self.properties = {}
+
+    # custom properties
+    def __getitem__(self, key):
+        return self.properties[key]
+
+    def __setitem__(self, key, value):
+        self.properties[key] = value
+
+    def select_set(self, state):
+        self.selected = state
+
+    def select_get(self):
+        return self.selected
+
+    def animation_data_create(self):
+        self.animation_data = AnimData()
+        return self.animation_data
+
+    def animation_data_clear(self):
+        self.animation_data = None
+
+class Marker(object):
+    def __init__(self, name, frame=0):
+        self.name = name
+        self.frame = frame
+
+class Render(object):
+    def __init__(self):
+        self.fps = 24
+        self.fps_base = 1.0
+
+class Scene(object):
+    def __init__(self):
+        self.name = 'Scene'
+        self.frame_start = 1
+        self.frame_end = 250
+        self.frame_current = 1
+        self.render = Render()
+        self.timeline_markers = Collection(Marker)
+        self.sequence_editor = None
+
+class Objects(object):
+    def __init__(self):
+        self.active = None
+
+class ViewLayer(object):
+    def __init__(self):
+        self.objects = Objects()
+
+class Context(object):
+    def __init__(self):
+        self.scene = Scene()
+        self.view_layer = ViewLayer()
+
+    @property
+    def object(self):
+        return self.view_layer.objects.active
+
+class Data(object):
+    def __init__(self):
+        self.objects = Collection(Object)
+        self.actions = Collection(Action)
+
+data = Data()
+context = Context()
+
+# create an armature object with the given pose bones
+def new_armature(name, data_name, bone_names):
+    obj = data.objects.new(name, ObjectData(data_name), type='ARMATURE')
+    obj.pose = Pose()
+    for b in bone_names:
+        obj.pose.bones.link(PoseBone(b, obj))
+    return obj
+
+# drop every object and action
+def reset():
+    data.objects.items_list = []
+    data.actions.items_list = []
+    context.view_layer.objects.active = None
+
+def mode_set(mode='OBJECT'):
+    return {'FINISHED'}
+
+def select_all(action='SELECT'):
+    return {'FINISHED'}
+
+def empty_add(type='PLAIN_AXES', radius=1.0, **kwargs):
+    obj = data.objects.new('Empty')
+    context.view_layer.objects.active = obj
+    return {'FINISHED'}
+
+def delete(use_global=False):
+    for obj in list(data.objects):
+        if obj.selected:
+            data.objects.remove(obj)
+    return {'FINISHED'}
+
+class Operator(object):
+    def report(self, level, msg):
+        print(level, msg)
+
+class Panel(object):
+    pass
+
+def register_class(cls):
+    pass
+
+def unregister_class(cls):
+    pass
+
+# user resources go in the temp directory
+def user_resource(resource_type, path='', create=False):
+    import os
+    import tempfile
+
+    target = os.path.join(tempfile.gettempdir(), 'yasp_bench_user',
+                          resource_type.lower(), path)
+    if create and not os.path.exists(target):
+        os.makedirs(target)
+    return target
+
+def persistent(fn):
+    return fn
+
+class ExportHelper(object):
+    pass
+
+class ImportHelper(object):
+    pass
+
+def install():
+    if 'bpy' in sys.modules:
+        return sys.modules['bpy']
+
+    bpy = types.ModuleType('bpy')
+    bpy.types = types.ModuleType('bpy.types')
+    bpy.types.Operator = Operator
+    bpy.types.Panel = Panel
+    bpy.types.Scene = Scene
+
+    bpy.props = types.ModuleType('bpy.props')
+    for name in Property.defaults.keys():
+        setattr(bpy.props, name, prop_factory(name))
+
+    bpy.utils = types.ModuleType('bpy.utils')
+    bpy.utils.register_class = register_class
+    bpy.utils.unregister_class = unregister_class
+    bpy.utils.user_resource = user_resource
+
+    bpy.app = types.ModuleType('bpy.app')
+    bpy.app.stand_in = True
+    bpy.app.handlers = types.ModuleType('bpy.app.handlers')
+    bpy.app.handlers.persistent = persistent
+    bpy.app.handlers.load_post = []
+    bpy.app.handlers.save_pre = []
+
+    bpy.path = types.ModuleType('bpy.path')
+    bpy.path.abspath = lambda p: p
+
+    bpy.ops = types.SimpleNamespace(
+        object=types.SimpleNamespace(mode_set=mode_set, empty_add=empty_add,
+                                     delete=delete),
+        pose=types.SimpleNamespace(select_all=select_all))
+    bpy.data = data
+    bpy.context = context
+
+    bpy_extras = types.ModuleType('bpy_extras')
+    bpy_extras.io_utils = types.ModuleType('bpy_extras.io_utils')
+    bpy_extras.io_utils.ExportHelper = ExportHelper
+    bpy_extras.io_utils.ImportHelper = ImportHelper
+
+    sys.modules['bpy'] = bpy
+    sys.modules['bpy.types'] = bpy.types
+    sys.modules['bpy.props'] = bpy.props
+    sys.modules['bpy.utils'] = bpy.utils
+    sys.modules['bpy.app'] = bpy.app
+    sys.modules['bpy.app.handlers'] = bpy.app.handlers
+    sys.modules['bpy.path'] = bpy.path
+    sys.modules['bpy_extras'] = bpy_extras
+    sys.modules['bpy_extras.io_utils'] = bpy_extras.io_utils
+    return bpy
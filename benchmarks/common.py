@@ -0,0 +1,89 @@
+import os
+import sys
+import json
+import time
+import platform
+import importlib
+
+# The add-on is a package rooted at the top of the repository. Its name
+# depends on how it was checked out (BYASP, yasp, ...), so import it by
+# directory name.
+addon_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+addon_name = os.path.basename(addon_dir)
+
+def import_addon(submodule=''):
+    parent = os.path.dirname(addon_dir)
+    if parent not in sys.path:
+        sys.path.insert(0, parent)
+    name = addon_name
+    if submodule:
+        name = name + '.' + submodule
+    return importlib.import_module(name)
+
+# Make sure there is a bpy module to import. Inside Blender this is the
+# real thing, otherwise fall back to the stand-in in bpy_stub.py
+def ensure_bpy():
+    try:
+        import bpy
+        return bpy, getattr(bpy.app, 'stand_in', False) is False
+    except ImportError:
+        pass
+    bench_dir = os.path.dirname(os.path.realpath(__file__))
+    if bench_dir not in sys.path:
+        sys.path.insert(0, bench_dir)
+    import bpy_stub
+    return bpy_stub.install(), False
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+# Record the add-on's timing spans for the run when a trace path is given
+def start_trace(path):
+    if not path:
+        return
+    timing = import_addon('timing')
+    timing.reset()
+    timing.enable(True)
+
+def finish_trace(path):
+    if not path:
+        return
+    timing = import_addon('timing')
+    timing.enable(False)
+    timing.export_chrome_trace(path)
+    print(timing.summary_table(), file=sys.stderr)
+
+# Arguments after '--' belong to the script when it's run through
+# blender --background --python <script> -- <args>
+def script_args():
+    if '--' in sys.argv:
+        return sys.argv[sys.argv.index('--') + 1:]
+    return sys.argv[1:]
+
+def write_results(path, name, results):
+    doc = {'benchmark': name,
+           'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'python': platform.python_version(),
+           'platform': platform.platform(),
+           'commit': git_commit(),
+           'results': results}
+    if path == '-':
+        json.dump(doc, sys.stdout, indent=4)
+        sys.stdout.write('\n')
+        return
+    with open(path, 'w') as f:
+        json.dump(doc, f, indent=4)
+
+def git_commit():
+    head = os.path.join(addon_dir, '.git', 'HEAD')
+    try:
+        with open(head, 'r') as f:
+            ref = f.read().strip()
+        if ref.startswith('ref: '):
+            with open(os.path.join(addon_dir, '.git', ref[5:]), 'r') as f:
+                return f.read().strip()
+        return ref
+    except Exception:
+        return ''
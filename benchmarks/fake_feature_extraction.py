@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# Stands in for OpenFace's FeatureExtraction when testing the add-on's
+# OpenFace runner. Takes the same -f/-out_dir arguments, ignores the rest,
+# and writes a synthetic take into <out_dir>/<video name>.csv a chunk at a
+# time, printing its progress like FeatureExtraction does.
+#
+#   FAKE_OPENFACE_FRAMES  frames to write (default 600)
+#   FAKE_OPENFACE_CHUNK   frames per chunk (default 50)
+#   FAKE_OPENFACE_DELAY   seconds to sleep after every chunk (default 0.1)
+#   FAKE_OPENFACE_FAIL    exit with this code after the first chunk
+#
+# Point the add-on at it by copying or linking it to
+# openface/FeatureExtraction in the add-on directory.
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import synth_openface
+
+def get_arg(name):
+    if name in sys.argv:
+        return sys.argv[sys.argv.index(name) + 1]
+    return None
+
+def main():
+    video = get_arg('-f')
+    outdir = get_arg('-out_dir')
+    if not video or not outdir:
+        print('usage: %s -f <video> -out_dir <dir>' % sys.argv[0])
+        return 1
+    nframes = int(os.environ.get('FAKE_OPENFACE_FRAMES', 600))
+    chunk = int(os.environ.get('FAKE_OPENFACE_CHUNK', 50))
+    delay = float(os.environ.get('FAKE_OPENFACE_DELAY', 0.1))
+    fail = int(os.environ.get('FAKE_OPENFACE_FAIL', 0))
+
+    os.makedirs(outdir, exist_ok=True)
+    path = os.path.join(outdir,
+                        os.path.splitext(os.path.basename(video))[0]+'.csv')
+    print('Attempting to read from file: %s' % video, flush=True)
+
+    def on_chunk(written):
+        print('Processing frame %d, %d%% done' % (written,
+              100 * written // nframes), flush=True)
+        if fail:
+            print('Failed to process the video', flush=True)
+            sys.exit(fail)
+        time.sleep(delay)
+
+    synth_openface.write_openface_csv(path, nframes, chunk=chunk,
+                                      on_chunk=on_chunk)
+    print('Closing output recorder', flush=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
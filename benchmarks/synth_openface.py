@@ -0,0 +1,138 @@
+# Generate synthetic OpenFace FeatureExtraction output.
+#
+#   python benchmarks/synth_openface.py -n 10000 -o take.csv [--faces 2]
+#
+# The column set and order match FeatureExtraction's CSV output: gaze,
+# eye landmarks, head pose, 2D/3D PDM landmarks, rigid/non-rigid shape
+# parameters and AU intensities/presence. The signals are smooth random
+# walks with some jitter, and a fraction of the rows have a confidence
+# below the 0.7 threshold facs_process drops.
+import argparse
+
+MAX_PDM_ENTRIES = 68
+MAX_PDM_NON_RIGID_ENTRIES = 34
+MAX_PDM_EYE_LMK = 56
+AU_R = ['AU01', 'AU02', 'AU04', 'AU05', 'AU06', 'AU07', 'AU09', 'AU10',
+        'AU12', 'AU14', 'AU15', 'AU17', 'AU20', 'AU23', 'AU25', 'AU26',
+        'AU45']
+AU_C = AU_R[:-1] + ['AU28', 'AU45']
+
+def openface_columns():
+    cols = ['frame', 'face_id', 'timestamp', 'confidence', 'success']
+    cols += ['gaze_0_x', 'gaze_0_y', 'gaze_0_z',
+             'gaze_1_x', 'gaze_1_y', 'gaze_1_z',
+             'gaze_angle_x', 'gaze_angle_y']
+    for axis in ['x', 'y', 'X', 'Y', 'Z']:
+        cols += ['eye_lmk_%s_%d' % (axis, i) for i in range(MAX_PDM_EYE_LMK)]
+    cols += ['pose_Tx', 'pose_Ty', 'pose_Tz', 'pose_Rx', 'pose_Ry', 'pose_Rz']
+    for axis in ['x', 'y', 'X', 'Y', 'Z']:
+        cols += ['%s_%d' % (axis, i) for i in range(MAX_PDM_ENTRIES)]
+    cols += ['p_scale', 'p_rx', 'p_ry', 'p_rz', 'p_tx', 'p_ty']
+    cols += ['p_%d' % i for i in range(MAX_PDM_NON_RIGID_ENTRIES)]
+    cols += [au + '_r' for au in AU_R]
+    cols += [au + '_c' for au in AU_C]
+    return cols
+
+# channel groups with their base value and range
+def channel_scale(name):
+    if name.startswith('AU') and name.endswith('_r'):
+        return 1.0, 1.5
+    if name.startswith('gaze_angle'):
+        return 0.0, 0.3
+    if name.startswith('gaze_'):
+        return 0.0, 0.5
+    if name.startswith('pose_R') or name.startswith('p_r'):
+        return 0.0, 0.2
+    if name.startswith('pose_T'):
+        return 0.0, 50.0
+    if name.startswith('eye_lmk_') or name[:2] in ('x_', 'y_'):
+        return 300.0, 5.0
+    if name[:2] in ('X_', 'Y_', 'Z_'):
+        return 0.0, 40.0
+    return 0.0, 1.0
+
+# Per channel base value, range and the frequency/phase/amplitude of the
+# sinusoids making up its motion. Every face gets its own set.
+def synth_params(np, rng, columns):
+    base = np.zeros(len(columns))
+    span = np.zeros(len(columns))
+    for i, name in enumerate(columns):
+        base[i], span[i] = channel_scale(name)
+    freq = rng.uniform(0.05, 2.0, (len(columns), 3))
+    phase = rng.uniform(0, 2 * np.pi, (len(columns), 3))
+    amp = rng.dirichlet(np.ones(3), len(columns))
+    return base, span, freq, phase, amp
+
+def synth_block(np, rng, columns, params, nframes, first, fps, face,
+                low_conf):
+    base, span, freq, phase, amp = params
+    frames = np.arange(first, first + nframes)
+    t = frames / fps
+    motion = np.sin(2 * np.pi * freq[None] * t[:, None, None] + phase[None])
+    motion = (motion * amp[None]).sum(axis=2)
+    # slow motion plus per frame tracking jitter
+    data = base + span * motion + \
+           rng.normal(0, 1, (nframes, len(columns))) * span * 0.02
+    for i, name in enumerate(columns):
+        if name == 'frame':
+            data[:, i] = frames + 1
+        elif name == 'face_id':
+            data[:, i] = face
+        elif name == 'timestamp':
+            data[:, i] = t
+        elif name == 'confidence':
+            conf = rng.uniform(0.85, 0.98, nframes)
+            drop = rng.random(nframes) < low_conf
+            conf[drop] = rng.uniform(0.1, 0.6, drop.sum())
+            data[:, i] = conf
+        elif name == 'success':
+            data[:, i] = 1
+        elif name.startswith('AU') and name.endswith('_c'):
+            data[:, i] = rng.random(nframes) < 0.3
+        elif name.startswith('AU') and name.endswith('_r'):
+            # AU intensities are never negative
+            data[:, i] = np.clip(data[:, i], 0, 5)
+    return data
+
+# on_chunk, if given, is called with the number of frames written after
+# every chunk is flushed
+def write_openface_csv(path, nframes, faces=1, fps=30.0, low_conf=0.02,
+                       seed=0, chunk=2000, on_chunk=None):
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    columns = openface_columns()
+    fmt = ['%d', '%d', '%.3f', '%.2f', '%d'] + \
+          ['%.6f'] * (len(columns) - 5)
+    params = [synth_params(np, rng, columns) for face in range(faces)]
+    with open(path, 'w') as f:
+        # FeatureExtraction separates its header with ', '
+        f.write(', '.join(columns) + '\n')
+        for first in range(0, nframes, chunk):
+            n = min(chunk, nframes - first)
+            blocks = [synth_block(np, rng, columns, params[face], n, first,
+                                  fps, face, low_conf) \
+                      for face in range(faces)]
+            # multi-face output interleaves the faces of every frame
+            data = np.stack(blocks, axis=1).reshape(n * faces, len(columns))
+            np.savetxt(f, data, fmt=fmt, delimiter=', ')
+            if on_chunk:
+                f.flush()
+                on_chunk(first + n)
+    return path
+
+def main():
+    parser = argparse.ArgumentParser(description='synthetic OpenFace take')
+    parser.add_argument('-n', '--frames', type=int, default=1000)
+    parser.add_argument('-o', '--output', required=True)
+    parser.add_argument('--faces', type=int, default=1)
+    parser.add_argument('--fps', type=float, default=30.0)
+    parser.add_argument('--low-confidence', type=float, default=0.02,
+                        help='fraction of rows below the confidence threshold')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    write_openface_csv(args.output, args.frames, args.faces, args.fps,
+                       args.low_confidence, args.seed)
+
+if __name__ == '__main__':
+    main()
@@ -11,18 +11,36 @@ import sys
 import platform
 import random
 import math
-import subprocess
-import datetime
-from bpy.props import EnumProperty, StringProperty, BoolVectorProperty
-from . import facs_process as facs
+import shutil
+from bpy.props import EnumProperty, StringProperty, BoolVectorProperty, BoolProperty
+from . import timing
+from . import openface_run
+from . import action_cache
+from . import file_cache
 
 logger = logging.getLogger(__name__)
 
+# facs_process is loaded on first use. See load_facs()
+facs = None
+
 # Global sliders
 global_sliders_set = False
 global_sliders = {}
 init_state = False
 plot_all = False
+openface_cache = None
+# The unscaled values of the keys written by Animate Face, so the
+# intensities can be changed without keying again. They're kept on the
+# actions too, see save_base_keys(), and read back when a file is opened.
+# (object name, data path, index) -> [kind, {frame: value}]
+base_keys = {}
+
+# The OpenFace output groups the add-on reads: AU intensities, gaze (which
+# comes with the eye landmarks), head pose, the 2D and 3D landmarks and the
+# shape parameters the PDM plots, distance features and slider solve use.
+# Aligned faces and HOG features aren't written. The groups are part of
+# the flags the OpenFace cache is keyed on.
+openface_outputs = ['-aus', '-gaze', '-pose', '-2Dfp', '-3Dfp', '-pdmparams']
 
 def set_rotation_type(rtype):
     rotation_types = ('BOUNDING_BOX_CENTER', 'CURSOR', 'INDIVIDUAL_ORIGINS', 'MEDIAN_POINT', 'ACTIVE_ELEMENT')
@@ -63,8 +81,20 @@ def set_init_state(state):
     global init_state
 
     init_state = state
-    if init_state:
+    # the FACS tables are built when facs_process is first loaded
+    if init_state and facs:
+        facs.init_database()
+
+# facs_process pulls in numpy and builds the FACS tables. Defer that until
+# an operator actually needs it, instead of paying for it on add-on load.
+def load_facs():
+    global facs
+
+    if not facs:
+        from . import facs_process
+        facs = facs_process
         facs.init_database()
+    return facs
 
 class FACE_OT_clear_animation(bpy.types.Operator):
     bl_idname = "yafr.del_animation"
@@ -85,7 +115,9 @@ class FACE_OT_clear_animation(bpy.types.Operator):
 
         global_sliders_set = False
         global_sliders = {}
-        facs.reset_database()
+        base_keys.clear()
+        if facs:
+            facs.reset_database()
         return {'FINISHED'}
 
 def get_mb_rig():
@@ -95,9 +127,306 @@ def get_mb_rig():
             return obj
     return None
 
-def process_csv_file(csv, ws, po):
+# The FACS rig of the i-th face of a take. yafr_facs_rig can list a rig
+# per face separated by commas. Faces past the end of the list use the
+# names Blender gives duplicates of the first rig: rig.001, rig.002, ...
+def get_face_rig_name(scn, i):
+    names = [n.strip() for n in scn.yafr_facs_rig.split(',') if n.strip()]
+    if i < len(names):
+        return names[i]
+    base = 'MBLab_skeleton_facs_rig'
+    if names:
+        base = names[0]
+    if i == 0:
+        return base
+    return '%s.%03d' % (base, i)
+
+# frame rate the OpenFace data is resampled to, 0 to keep a key per row
+def get_resample_fps(scn):
+    if not scn.yafr_openface_resample:
+        return 0
+    return scn.render.fps / scn.render.fps_base
+
+def get_openface_cache():
+    global openface_cache
+    if not openface_cache:
+        openface_cache = openface_run.OpenFaceCache(
+            file_cache.get_cache_dir('openface'))
+    return openface_cache
+
+# the unscaled keys of a channel of a pose bone
+def get_base_keys(pose_bone, attr, index, kind):
+    path = 'pose.bones["%s"].%s' % (pose_bone.name, attr)
+    key = (pose_bone.id_data.name, path, index)
+    if key not in base_keys:
+        base_keys[key] = [kind, {}]
+    return base_keys[key][1]
+
+# Scale unscaled key values the way FACE_OT_animate.set_keyframes() and
+# set_keyframes_hr() do. kind is AU, GZ0H, GZ0V or head.
+def scale_keys(kind, values, intensity, vgi, hgi):
+    import numpy as np
+
+    if kind == 'GZ0H':
+        return values * (1 + hgi)
+    if kind == 'GZ0V':
+        return values * (1 + vgi)
+    if kind == 'head':
+        return values * (1 + intensity)
+    if intensity > 0:
+        # don't accept negative values
+        return np.abs(values) * (1 + intensity)
+    return values
+
+# Apply the scene's intensities to the keys Animate Face wrote. The key
+# values are computed from the unscaled ones in a single read and write
+# of every F-curve. Keys added or moved by hand are left alone.
+@timing.span('yafr.rescale')
+def rescale_animation(scn):
+    import numpy as np
+
+    intensity = scn.yafr_openface_au_intensity
+    vgi = scn.yafr_openface_vgaze_intensity
+    hgi = scn.yafr_openface_hgaze_intensity
+    for (obj_name, path, index), (kind, base) in base_keys.items():
+        obj = bpy.data.objects.get(obj_name)
+        if not obj or not obj.animation_data or \
+           not obj.animation_data.action:
+            continue
+        fc = obj.animation_data.action.fcurves.find(path, index=index)
+        if not fc or not base:
+            continue
+        points = fc.keyframe_points
+        co = np.empty(len(points) * 2)
+        points.foreach_get('co', co)
+        frames = np.array(sorted(base.keys()), dtype=float)
+        values = scale_keys(kind, np.array([base[f] for f in sorted(base)]),
+                            intensity, vgi, hgi)
+        i = np.minimum(np.searchsorted(frames, co[0::2]), len(frames) - 1)
+        found = frames[i] == co[0::2]
+        if (co[1::2][found] == values[i[found]]).all():
+            continue
+        # a cached action stays the cached one as long as it isn't changed
+        action_cache.forget_action(obj.animation_data.action)
+        co[1::2][found] = values[i[found]]
+        points.foreach_set('co', co)
+        fc.update()
+        timing.count(curves=1, keys=int(found.sum()))
+
+# Keep the base keys of every object on its action, as a list of
+# {path, index, kind, co} in yafr_base_keys, so they're saved with the
+# file
+def save_base_keys():
+    curves = {}
+    for (obj_name, path, index), (kind, base) in base_keys.items():
+        co = [float(c) for f in sorted(base) for c in (f, base[f])]
+        curves.setdefault(obj_name, []).append(
+            {'path': path, 'index': index, 'kind': kind, 'co': co})
+    for obj_name, saved in curves.items():
+        obj = bpy.data.objects.get(obj_name)
+        action = action_cache.get_action(obj) if obj else None
+        if action:
+            action['yafr_base_keys'] = saved
+
+# the base keys saved on the actions of the objects of the file
+def load_base_keys():
+    base_keys.clear()
+    for obj in bpy.data.objects:
+        action = action_cache.get_action(obj)
+        if not action or 'yafr_base_keys' not in action:
+            continue
+        for fc in action['yafr_base_keys']:
+            co = list(fc['co'])
+            base_keys[(obj.name, fc['path'], fc['index'])] = \
+                [fc['kind'], dict(zip(co[0::2], co[1::2]))]
+
+# The animation state of the file which was open is gone. The keys of the
+# new one can still be rescaled if it was animated before it was saved.
+@persistent
+def yafr_load_post(dummy):
+    global global_sliders_set
+    global global_sliders
+
+    global_sliders = {}
+    load_base_keys()
+    global_sliders_set = bool(base_keys)
+
+# update callback of the intensity properties
+def update_intensity(self, context):
+    if global_sliders_set and base_keys:
+        rescale_animation(context.scene)
+
+# The action cache key of the animation Animate Face makes of csv with the
+# scene's settings. The cached actions hold the unscaled keys, the
+# intensities are applied after they're assigned, so they aren't part of
+# the key.
+def get_action_key(scn, csv):
+    params = {'kind': 'face',
+              'window_size': scn.yafr_openface_ws,
+              'polyorder': scn.yafr_openface_polyorder,
+              'filter': scn.yafr_openface_filter,
+              'fps': get_resample_fps(scn),
+              'mouth': scn.yafr_openface_mouth,
+              'head': scn.yafr_openface_head,
+              'eye_landmarks': scn.yafr_openface_eye_landmarks,
+              'start_frame': scn.yafr_start_frame}
+    return action_cache.get_action_cache().get_key([csv], params)
+
+# The channels of a take Animate Face keys. With eye landmarks on, the
+# blink and gaze derived from the eye landmarks replace OpenFace's AU45
+# and gaze angles.
+def get_take_channels(scn, t):
+    animation_data = t.get_table('animation_data')
+    if not scn.yafr_openface_eye_landmarks:
+        return animation_data
+    return merge_eye_channels(animation_data, t.get_table('eye_features'))
+
+# The channels of the rows of a take read so far, processed like
+# get_take_channels() does once the take is complete
+def get_chunk_channels(scn, t, ws, po, fps, profile):
+    animation_data = facs.process_table(t.animation_data, ws, po, fps,
+                                        profile)
+    if not scn.yafr_openface_eye_landmarks:
+        return animation_data
+    eye = facs.process_table(t.eye_feature_table(), ws, po, fps, profile)
+    return merge_eye_channels(animation_data, eye)
+
+# animation_data with AU45 and the gaze angles of the eye features
+def merge_eye_channels(animation_data, eye):
+    if len(eye['frame'][facs.VALUES]) != \
+       len(animation_data['frame'][facs.VALUES]):
+        return animation_data
+    data = dict(animation_data)
+    data['AU45_r'] = eye['blink']
+    data['gaze_angle_x'] = eye['gaze_x']
+    data['gaze_angle_y'] = eye['gaze_y']
+    return data
+
+# the rig animated in a role of the action cache, face.<i> or head
+def get_role_rig(scn, role):
+    if role == 'head':
+        return get_mb_rig()
+    return bpy.data.objects.get(get_face_rig_name(scn, int(role[5:])))
+
+# the kind of keys of an F-curve Animate Face wrote, see get_base_keys()
+def get_key_kind(role, data_path):
+    if role == 'head':
+        return 'head'
+    bone = data_path.split('"')[1]
+    if 'GZ' in bone:
+        return bone[-4:]
+    return 'AU'
+
+# Give the rigs the cached actions of the key. Returns False if there
+# aren't any or a rig is missing. The actions hold the unscaled keys,
+# they're the base keys of the rigs and get the scene's intensities.
+def assign_cached_actions(scn, key):
+    import numpy as np
+
+    actions = action_cache.get_action_cache().get_actions(key)
+    if not actions:
+        return False
+    rigs = dict((role, get_role_rig(scn, role)) for role in actions)
+    if not all(rigs.values()):
+        return False
+    for role, action in actions.items():
+        action_cache.assign_action(rigs[role], action)
+        for fc in action.fcurves:
+            co = np.empty(len(fc.keyframe_points) * 2)
+            fc.keyframe_points.foreach_get('co', co)
+            base_keys[(rigs[role].name, fc.data_path, fc.array_index)] = \
+                [get_key_kind(role, fc.data_path),
+                 dict(zip(co[0::2].tolist(), co[1::2].tolist()))]
+    save_base_keys()
+    rescale_animation(scn)
+    return True
+
+# Cache the keys Animate Face just wrote for csv. Every role gets a new
+# action with only the F-curves in base_keys, holding the unscaled keys,
+# other animation of the rigs isn't cached.
+def store_actions(scn, key, csv):
+    roles = ['face.%d' % i for i, t in \
+             enumerate([t for t in facs.get_takes() if len(t)])]
+    if scn.yafr_openface_head:
+        roles.append('head')
+    rigs = {}
+    for role in roles:
+        rig = get_role_rig(scn, role)
+        if not rig or not action_cache.get_action(rig):
+            return
+        rigs[role] = rig
+    actions = {}
+    for role, rig in rigs.items():
+        action = bpy.data.actions.new('YASP_%s' % role)
+        actions[role] = action
+        for (obj_name, path, index), (kind, base) in base_keys.items():
+            if obj_name != rig.name or not base:
+                continue
+            fc = action.fcurves.new(path, index=index,
+                                    action_group=path.split('"')[1])
+            fc.keyframe_points.add(len(base))
+            fc.keyframe_points.foreach_set('co',
+                [c for f in sorted(base) for c in (f, base[f])])
+            fc.update()
     try:
-        js = facs.process_openface_csv(csv, ws, po)
+        action_cache.get_action_cache().store(key, os.path.basename(csv),
+                                              [csv], actions)
+    except Exception as e:
+        logger.critical(e)
+    # the library has them, the rigs keep the actions they were keyed in
+    for action in actions.values():
+        bpy.data.actions.remove(action)
+
+# A background OpenFace run on the video. With more than one job the video
+# is split into segments which are processed in parallel, this needs
+# ffmpeg and ffprobe.
+def new_openface_run(scn, openface, video):
+    jobs = scn.yafr_openface_jobs
+    if jobs > 1:
+        if shutil.which('ffmpeg') and shutil.which('ffprobe'):
+            return openface_run.SegmentedRun(openface, video, '',
+                                             openface_outputs, jobs,
+                                             scn.yafr_openface_overlap)
+        logger.critical("ffmpeg or ffprobe not found, "
+                        "running a single OpenFace process")
+    return openface_run.OpenFaceRun(openface, video, '', openface_outputs)
+
+# Run OpenFace on the video and wait for it to finish, for when there's no
+# UI to run it in the background from. Returns the path of its csv, which
+# is cached like the output of background runs.
+def extract_openface(scn, openface, video, interval=0.5):
+    cache = get_openface_cache()
+    run = new_openface_run(scn, openface, video)
+    key = cache.get_key(openface, video, run.get_flags())
+    csv = cache.lookup(key)
+    if csv:
+        return csv
+    run.outdir = cache.get_dir(key)
+    run.start()
+    while not run.poll():
+        time.sleep(interval)
+    csv = run.get_csv_path()
+    if run.returncode or not os.path.isfile(csv):
+        raise RuntimeError('OpenFace failed (%s)\n%s' % (run.returncode,
+                           run.get_output(10)))
+    cache.store(key, openface, video, run.get_flags(), csv)
+    return csv
+
+# the animation data with only the extrema in [first, last)
+def get_frame_range(data, first, last):
+    result = {}
+    for k, v in data.items():
+        result[k] = [v[facs.VALUES],
+                     [m for m in v[facs.MAXIMAS] if first <= m < last],
+                     [m for m in v[facs.MINIMAS] if first <= m < last]]
+    return result
+
+@timing.span('yafr.process_csv')
+def process_csv_file(csv, ws, po, fps=0, profile='offline', solver=None,
+                     bounded=True):
+    try:
+        js = facs.process_openface_csv(csv, ws, po, fps, profile, solver,
+                                       bounded)
     except Exception as e:
         msg = 'failed to process results\n'+traceback.format_exc()
         logger.critical(msg)
@@ -109,28 +438,176 @@ def process_csv_file(csv, ws, po):
 
     return True, 'Success'
 
+# Animate Face keys the first frame of the video at yafr_start_frame, if
+# it's set
+def get_frame_offset(scn):
+    if scn.yafr_start_frame > 0:
+        return scn.yafr_start_frame - 1
+    return 0
+
+# the scene frame of every row of table, from its frame column
+def get_scene_frames(scn, table):
+    offset = get_frame_offset(scn)
+    return [int(round(f)) + offset for f in table['frame'][facs.VALUES]]
+
+# Call fn and return what it returns, or None and the error. The tables of
+# a take are only processed once they're asked for, see
+# facs_process.Take.process(), processing them fails here rather than in
+# process_csv_file().
+def get_processed(fn):
+    try:
+        return fn(), 'Success'
+    except Exception:
+        msg = 'failed to process results\n'+traceback.format_exc()
+        logger.critical(msg)
+        return None, msg
+
+# the channels of every take with rows, see get_take_channels()
+def get_takes_channels(scn):
+    return [(t.face_id, get_take_channels(scn, t)) \
+            for t in facs.get_takes() if len(t)]
+
 class FACE_OT_animate(bpy.types.Operator):
     bl_idname = "yafr.animate_face"
     bl_label = "Animate Face"
     bl_description = "Create Facial Animation"
 
-    def run_openface(self, openface, video):
-        outdir = os.path.join(os.path.dirname(openface),
-            os.path.splitext(os.path.basename(video))[0]+"_processed")
-        if not os.path.exists(outdir):
-            os.makedirs(outdir)
-        rc = subprocess.run([openface, '-verbose', '-f', video, '-out_dir', outdir],
-                            stdout=subprocess.PIPE)
-        return rc.returncode, rc.stdout.decode(), outdir
+    # Start OpenFace in the background. modal() keys the rows as they're
+    # written out, Blender stays responsive while the video is processed.
+    # If OpenFace already ran on the same video, with the same binary and
+    # flags, nothing is started and the path of its csv is returned.
+    def start_openface(self, context, openface, video):
+        cache = get_openface_cache()
+        self.run = new_openface_run(context.scene, openface, video)
+        self.cache_key = cache.get_key(openface, video, self.run.get_flags())
+        csv = cache.lookup(self.cache_key)
+        if csv:
+            return csv
+        self.run.outdir = cache.get_dir(self.cache_key)
+        # don't pick up the rows of an unfinished earlier run
+        csv = self.run.get_csv_path()
+        if os.path.isfile(csv):
+            os.remove(csv)
+        self.run.start()
+        self.tail = openface_run.CsvTail(csv)
+        self.keyed = {}
+        facs.reset_database()
+
+        wm = context.window_manager
+        self.timer = wm.event_timer_add(0.5, window=context.window)
+        wm.modal_handler_add(self)
+        wm.progress_begin(0, 100)
+        return ''
+
+    def stop_openface(self, context):
+        wm = context.window_manager
+        wm.event_timer_remove(self.timer)
+        wm.progress_end()
+        self.run.terminate()
+
+    # Key the frames of every take which won't change anymore. While
+    # OpenFace is running the last frames of the rows read so far still
+    # depend on rows to come, see facs_process.filter_margin()
+    def animate_chunk(self, scn, final):
+        ws = scn.yafr_openface_ws
+        po = scn.yafr_openface_polyorder
+        profile = scn.yafr_openface_filter
+        fps = get_resample_fps(scn)
+        margin = 0
+        if not final:
+            margin = facs.filter_margin(profile, ws, po)
+
+        if final:
+            channels, msg = get_processed(lambda: get_takes_channels(scn))
+        else:
+            channels, msg = get_processed(lambda: [
+                (t.face_id, get_chunk_channels(scn, t, ws, po, fps,
+                                               profile)) \
+                for t in facs.get_takes() if len(t)])
+        if channels is None:
+            return False, msg
+
+        tables = []
+        for face_id, data in channels:
+            first = self.keyed.get(face_id, 0)
+            last = len(data['frame'][facs.VALUES]) - margin
+            if last <= first:
+                continue
+            self.keyed[face_id] = last
+            tables.append((face_id, get_frame_range(data, first, last)))
+        if tables:
+            self.animate_takes(scn, scn.yafr_openface_mouth,
+                               scn.yafr_openface_head,
+                               scn.yafr_openface_au_intensity,
+                               scn.yafr_openface_vgaze_intensity,
+                               scn.yafr_openface_hgaze_intensity, tables)
+        return True, 'Success'
+
+    def modal(self, context, event):
+        scn = context.scene
+        if event.type == 'ESC':
+            self.stop_openface(context)
+            self.report({'WARNING'}, 'OpenFace cancelled')
+            return {'CANCELLED'}
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        with timing.span('yafr.openface_poll') as s:
+            done = self.run.poll()
+            context.window_manager.progress_update(
+                int(self.run.progress * 100))
+            s.count(rows=facs.add_rows(self.tail.read_rows()))
+        if not done:
+            rc, msg = self.animate_chunk(scn, False)
+            if rc:
+                return {'RUNNING_MODAL'}
+            self.stop_openface(context)
+            self.report({'ERROR'}, msg)
+            return {'CANCELLED'}
 
-    def set_keyframes_hr(self, result, array, attr, head_bone, intensity):
+        self.stop_openface(context)
+        if self.run.returncode:
+            msg = 'OpenFace failed (%d)\n%s' % (self.run.returncode,
+                                                self.run.get_output(10))
+            logger.critical(msg)
+            self.report({'ERROR'}, msg)
+            return {'CANCELLED'}
+        if not len(facs.take):
+            msg = "Failed to process video. No rows in "+self.tail.path
+            self.report({'ERROR'}, msg)
+            return {'CANCELLED'}
+        get_openface_cache().store(self.cache_key, self.run.openface,
+                                   self.run.video, self.run.get_flags(),
+                                   self.tail.path)
+
+        # process the whole take like a csv file and key what's left
+        facs.process_database(scn.yafr_openface_ws,
+                              scn.yafr_openface_polyorder,
+                              get_resample_fps(scn),
+                              scn.yafr_openface_filter)
+        rc, msg = self.animate_chunk(scn, True)
+        if not rc:
+            self.report({'ERROR'}, msg)
+            return {'CANCELLED'}
+        if scn.yasp_action_cache:
+            store_actions(scn, get_action_key(scn, self.tail.path),
+                          self.tail.path)
+        return {'FINISHED'}
+
+    # frames are the scene frames of the rows of result, see
+    # get_scene_frames()
+    def set_keyframes_hr(self, result, array, frames, attr, head_bone,
+                         intensity):
         rotation = {'Rx': 1, 'Ry': 2, 'Rz': 3}
 
+        base = get_base_keys(head_bone, 'rotation_quaternion',
+                             rotation[attr], 'head')
         for m in array:
             # angle in radians
             val = result[m] + (result[m] * intensity)
             head_bone.rotation_quaternion[rotation[attr]] = val
-            head_bone.keyframe_insert('rotation_quaternion', index=rotation[attr], frame=m)
+            head_bone.keyframe_insert('rotation_quaternion', index=rotation[attr], frame=frames[m])
+            base[frames[m]] = result[m]
 
     def get_head_bone(self, mb_rig):
         for obj in bpy.data.objects:
@@ -148,16 +625,18 @@ class FACE_OT_animate(bpy.types.Operator):
 
         return head_bone, msg
 
-    def set_keyframes(self, result, array, slider_bone, intensity, vgi, hgi):
+    def set_keyframes(self, result, array, frames, slider_bone, intensity,
+                      vgi, hgi):
         global global_sliders
-        if bpy.context.scene.yafr_start_frame > 0:
-            frame_offset = bpy.context.scene.yafr_start_frame - 1
-        else:
-            frame_offset = 0
 
+        kind = 'AU'
+        if 'GZ' in slider_bone.name:
+            kind = slider_bone.name[-4:]
+        base = get_base_keys(slider_bone, 'location', 0, kind)
         for m in array:
             if not 'GZ' in slider_bone.name:
                 value = (result[m] / 5) * 0.377
+                base[frames[m]] = value
             else:
                 # normalize the gaze values to fit in the -0.189 - 0.189
                 # range of the gaze slider
@@ -170,6 +649,7 @@ class FACE_OT_animate(bpy.types.Operator):
                 elif value < 0:
                     value = max(value, -1)
                     value = value * 0.189
+                base[frames[m]] = value
 
                 gaze_intensity = hgi
                 # intensify the gaze motion independently
@@ -189,8 +669,8 @@ class FACE_OT_animate(bpy.types.Operator):
                 value = value + (value * intensity)
             slider_bone.location[0] = value
             slider_bone.keyframe_insert(data_path="location",
-                frame=m+frame_offset, index=0)
-            global_sliders[slider_bone.name].append(m)
+                frame=frames[m], index=0)
+            global_sliders[slider_bone.name].append(frames[m])
 
     def set_every_keyframe(self, result, slider_bone, intensity):
         frame = 1
@@ -206,11 +686,10 @@ class FACE_OT_animate(bpy.types.Operator):
                 slider_bone.keyframe_insert(data_path="location", frame=frame, index=0)
             frame = frame + 1
 
-    def set_animation_prereq(self, scn):
-        if not scn.yafr_facs_rig:
-            facs_rig = bpy.data.objects.get('MBLab_skeleton_facs_rig')
-        else:
-            facs_rig = bpy.data.objects.get(scn.yafr_facs_rig)
+    def set_animation_prereq(self, scn, rig_name=''):
+        if not rig_name:
+            rig_name = get_face_rig_name(scn, 0)
+        facs_rig = bpy.data.objects.get(rig_name)
         if not facs_rig:
             return False
 
@@ -222,10 +701,11 @@ class FACE_OT_animate(bpy.types.Operator):
         bpy.ops.object.mode_set(mode='POSE')
         return True
 
-    def animate_face(self, mouth, head, animation_data, intensity, vgi, hgi):
+    def animate_face(self, mouth, head, animation_data, intensity, vgi, hgi,
+                     rig_name=''):
         global global_sliders_set
 
-        if not self.set_animation_prereq(bpy.context.scene):
+        if not self.set_animation_prereq(bpy.context.scene, rig_name):
             print("Animation prerequisites not set")
             return
 
@@ -234,7 +714,72 @@ class FACE_OT_animate(bpy.types.Operator):
             print("Animation already set. Delete animation first")
             return
 
+        self.animate_rig(mouth, head, animation_data, intensity, vgi, hgi)
+        global_sliders_set = True
+
+    # Animate every face of the take on its own FACS rig. tables is a
+    # list of (face_id, animation data), by default the whole data of
+    # every face.
+    def animate_takes(self, scn, mouth, head, intensity, vgi, hgi,
+                      tables=None):
+        global global_sliders_set
+
+        if tables is None:
+            # animation already done
+            if global_sliders_set:
+                print("Animation already set. Delete animation first")
+                return True, 'Success'
+            tables, msg = get_processed(lambda: get_takes_channels(scn))
+            if tables is None:
+                return False, msg
+
+        faces = [t.face_id for t in facs.get_takes() if len(t)]
+        for face_id, data in tables:
+            i = faces.index(face_id)
+            rig_name = get_face_rig_name(scn, i)
+            if not self.set_animation_prereq(scn, rig_name):
+                msg = "FACS rig %s for face %d not found" % (rig_name,
+                                                             face_id)
+                logger.critical(msg)
+                self.report({'WARNING'}, msg)
+                continue
+            # there is a single MB rig, it follows the first face
+            self.animate_rig(mouth, head and i == 0, data, intensity,
+                             vgi, hgi)
+
+        save_base_keys()
+        global_sliders_set = True
+        return True, 'Success'
+
+    # Animate the take in csv. With the action cache on, the rigs get the
+    # actions cached for the same csv and settings if there are any.
+    def animate_csv(self, scn, csv, mouth, head, intensity, vgi, hgi):
+        global global_sliders_set
+
+        key = None
+        if scn.yasp_action_cache:
+            key = get_action_key(scn, csv)
+            if assign_cached_actions(scn, key):
+                global_sliders_set = True
+                return True, 'Success'
+
+        rc, msg = process_csv_file(csv, scn.yafr_openface_ws,
+                                   scn.yafr_openface_polyorder,
+                                   get_resample_fps(scn),
+                                   scn.yafr_openface_filter)
+        if rc:
+            rc, msg = self.animate_takes(scn, mouth, head, intensity, vgi,
+                                         hgi)
+        if rc:
+            if key:
+                store_actions(scn, key, csv)
+        return rc, msg
+
+    # key the sliders of the active FACS rig
+    @timing.span('yafr.keyframes')
+    def animate_rig(self, mouth, head, animation_data, intensity, vgi, hgi):
         mouth_aus = ['AU10', 'AU12', 'AU13', 'AU14', 'AU15', 'AU16', 'AU17', 'AU20', 'AU23']
+        frames = get_scene_frames(bpy.context.scene, animation_data)
 
         for key, value in animation_data.items():
             # don't use specific AUs if mouth is not selected
@@ -276,8 +821,9 @@ class FACE_OT_animate(bpy.types.Operator):
                     logger.critical(msg)
                     self.report({'ERROR'}, msg)
                     return
-                self.set_keyframes_hr(result, maximas, key.strip('pose_'), head_bone, intensity)
-                self.set_keyframes_hr(result, minimas, key.strip('pose_'), head_bone, intensity)
+                self.set_keyframes_hr(result, maximas, frames, key.strip('pose_'), head_bone, intensity)
+                self.set_keyframes_hr(result, minimas, frames, key.strip('pose_'), head_bone, intensity)
+                timing.count(channels=1, keys=len(maximas) + len(minimas))
             else:
                 global_sliders[slider_name] = []
                 slider_bone = bpy.context.object.pose.bones.get(slider_name)
@@ -285,15 +831,16 @@ class FACE_OT_animate(bpy.types.Operator):
                     logger.critical('slider %s not found', slider_name)
                     continue
 
-                self.set_keyframes(result, maximas, slider_bone, intensity, vgi, hgi)
-                self.set_keyframes(result, minimas, slider_bone, intensity, vgi, hgi)
+                self.set_keyframes(result, maximas, frames, slider_bone, intensity, vgi, hgi)
+                self.set_keyframes(result, minimas, frames, slider_bone, intensity, vgi, hgi)
+                timing.count(channels=1, keys=len(maximas) + len(minimas))
                 #self.set_every_keyframe(result, slider_bone, intensity, vgi, hgi)
 
-        global_sliders_set = True
-
+    @timing.operator_span('yafr.animate')
     def execute(self, context):
         global global_sliders_set
 
+        load_facs()
         set_init_state(False)
 
         scn = context.scene
@@ -336,11 +883,9 @@ class FACE_OT_animate(bpy.types.Operator):
                 else:
                     csv = dirname+csv
 
-            rc, msg = process_csv_file(csv, ws, po)
-            # animate the data
+            rc, msg = self.animate_csv(scn, csv, mouth, head, intensity,
+                                       vgi, hgi)
             if rc:
-                facs_data = facs.get_facs_data()
-                self.animate_face(mouth, head, facs_data, intensity, vgi, hgi)
                 return {'FINISHED'}
 
             self.report({'ERROR'}, msg)
@@ -365,37 +910,118 @@ class FACE_OT_animate(bpy.types.Operator):
             else:
                 video = dirname+video
 
-        outdir = ''
         try:
-            rc, output, outdir = self.run_openface(openface, video)
-            if rc:
-                self.report({'ERROR'}, ouput)
-                return {'FINISHED'}
+            csv = self.start_openface(context, openface, video)
         except Exception as e:
             logger.critical(e)
             msg = 'failed to run openface\n'+traceback.format_exc()
             self.report({'ERROR'}, msg)
             return {'FINISHED'}
 
-        # process the csv file
-        csv = os.path.join(outdir,
-            os.path.splitext(os.path.basename(video))[0]+'.csv')
+        if not csv:
+            # the rows are keyed as OpenFace writes them, see modal()
+            return {'RUNNING_MODAL'}
+
+        # reuse the output of an earlier run on this video
+        rc, msg = self.animate_csv(scn, csv, mouth, head, intensity, vgi, hgi)
+        if rc:
+            return {'FINISHED'}
+
+        self.report({'ERROR'}, msg)
+        return {'FINISHED'}
+
+# Animate the FACS rig from the 2D landmarks instead of the AU regressors
+# of OpenFace. The slider weights of every frame are solved against a
+# calibration of the actor's neutral and extreme poses, see
+# facs_process.load_calibration(), then keyed like the AUs.
+class FACE_OT_pdm_solve(FACE_OT_animate):
+    bl_idname = "yafr.solve_pdm_face"
+    bl_label = "Solve Sliders"
+    bl_description = "Animate the FACS rig by solving the landmarks for the calibrated sliders"
+
+    @timing.operator_span('yafr.pdm_solve')
+    def execute(self, context):
+        load_facs()
+        set_init_state(False)
+
+        scn = context.scene
+        csv = bpy.path.abspath(scn.yafr_csvfile)
+        calibration = bpy.path.abspath(scn.yafr_pdm_calibration)
+        ws = scn.yafr_openface_ws
+        po = scn.yafr_openface_polyorder
+
+        if global_sliders_set:
+            self.report({'ERROR'}, "Delete current animation first")
+            return {'FINISHED'}
+
+        if po >= ws:
+            msg = "polyorder must be less than window_length."
+            logger.critical(msg)
+            self.report({'ERROR'}, msg)
+            return {'FINISHED'}
+
+        if ws % 2 == 0:
+            msg = "window size needs to be an odd number"
+            logger.critical(msg)
+            self.report({'ERROR'}, msg)
+            return {'FINISHED'}
+
         if not os.path.isfile(csv):
-            msg = "Failed to process video. No csv file found: "+csv
+            self.report({'ERROR'}, "bad csv file provided "+csv)
+            return {'FINISHED'}
+
+        if not os.path.isfile(calibration):
+            self.report({'ERROR'}, "bad calibration file provided " +
+                        calibration)
+            return {'FINISHED'}
+
+        try:
+            with timing.span('yafr.pdm_calibrate'):
+                solver = facs.load_calibration(calibration)
+        except Exception as e:
+            msg = "failed to calibrate: %s" % e
+            logger.critical(msg)
             self.report({'ERROR'}, msg)
             return {'FINISHED'}
 
-        # animate the data
-        rc, msg = process_csv_file(csv, ws, po)
-        # animate the data
-        if rc:
-            facs_data = facs.get_facs_data()
-            self.animate_face(mouth, head, facs_data, intensity, vgi, hgi)
-            #frame_end = facs_data['frame'][facs.VALUES][-1]
-            #bpy.context.scene.frame_end = frame_end
+        facs.reset_database()
+        rc, msg = process_csv_file(csv, ws, po, get_resample_fps(scn),
+                                   scn.yafr_openface_filter, solver,
+                                   scn.yafr_pdm_bounded)
+        if not rc:
+            self.report({'ERROR'}, msg)
             return {'FINISHED'}
 
-        self.report({'ERROR'}, msg)
+        tables, msg = get_processed(lambda: [
+            (t.face_id, t.get_table('landmark_sliders')) \
+            for t in facs.get_takes()])
+        if tables is None:
+            self.report({'ERROR'}, msg)
+            return {'FINISHED'}
+        tables = [(face_id, data) for face_id, data in tables \
+                  if data['frame'][facs.VALUES]]
+        if not tables:
+            self.report({'ERROR'}, "No 2D landmarks in " + csv)
+            return {'FINISHED'}
+        self.animate_takes(scn, scn.yafr_openface_mouth, False,
+                           scn.yafr_openface_au_intensity,
+                           scn.yafr_openface_vgaze_intensity,
+                           scn.yafr_openface_hgaze_intensity, tables)
+        return {'FINISHED'}
+
+class FACE_OT_purge_openface_cache(bpy.types.Operator):
+    bl_idname = "yafr.purge_openface_cache"
+    bl_label = "Purge OpenFace Cache"
+    bl_description = "Delete cached OpenFace output"
+
+    stale_only: BoolProperty(
+        name="Stale Only",
+        description="Only delete output of videos or binaries which changed",
+        default=True)
+
+    def execute(self, context):
+        removed = get_openface_cache().purge(self.stale_only)
+        self.report({'INFO'}, "Removed %d cached OpenFace runs" % removed)
         return {'FINISHED'}
 
 class FACE_OT_pdm_del_animate(bpy.types.Operator):
@@ -438,8 +1064,9 @@ class FACE_OT_pdm3d_rm_rotation(bpy.types.Operator):
             #obj.keyframe_insert(data_path="rotation_quaternion", frame=f, index=2)
             #obj.keyframe_insert(data_path="rotation_quaternion", frame=f, index=3)
 
+    @timing.operator_span('yafr.rm_rotation')
     def execute(self, context):
-        data = facs.get_facs_data()
+        data = load_facs().get_facs_data()
 
         rx = data['pose_Rx'][facs.VALUES]
         ry = data['pose_Ry'][facs.VALUES]
@@ -454,9 +1081,8 @@ class FACE_OT_pdm3d_rm_rotation(bpy.types.Operator):
             if not 'amir' in obj.name:
             #if not 'pdm3d_' in obj.name:
                 continue
-            logger.critical("Rotating object %s: %s", obj.name,
-                            str(datetime.datetime.now()))
-            self.rotate_obj(obj, rx, ry, rz)
+            with timing.span('yafr.rotate_obj', keys=len(rx)):
+                self.rotate_obj(obj, rx, ry, rz)
 
         return {'FINISHED'}
 
@@ -465,7 +1091,8 @@ class FACE_OT_pdm2d_animate(bpy.types.Operator):
     bl_label = "Plot"
     bl_description = "Experimental feature"
 
-    def plot_axis(self, obj, axis, result, array, adj=[], div=400):
+    # frames are the scene frames of the rows of result
+    def plot_axis(self, obj, axis, result, array, frames, adj=[], div=400):
         if plot_all:
             f = 0
             values = []
@@ -481,7 +1108,8 @@ class FACE_OT_pdm2d_animate(bpy.types.Operator):
                 if axis == 1 or axis == 2:
                     value = value * -1
                 obj.location[axis] = value
-                obj.keyframe_insert(data_path="location", frame=f, index=axis)
+                obj.keyframe_insert(data_path="location", frame=frames[f],
+                                    index=axis)
                 values.append(value)
                 f = f+1
             return values
@@ -490,7 +1118,10 @@ class FACE_OT_pdm2d_animate(bpy.types.Operator):
             if axis == 1 or axis == 2:
                 value = value * -1
             obj.location[axis] = value
-            obj.keyframe_insert(data_path="location", frame=m, index=axis)
+            obj.keyframe_insert(data_path="location", frame=frames[m],
+                                index=axis)
+        # only the plot_all path hands the values back
+        return []
 
     def animate_2d_empty(self, obj, attr, pdm_2d, rigid_data):
         y_name = 'y_'+attr.strip('x_')
@@ -499,17 +1130,18 @@ class FACE_OT_pdm2d_animate(bpy.types.Operator):
         y_info = pdm_2d[y_name]
         p_tx = rigid_data['p_tx'][facs.VALUES]
         p_ty = rigid_data['p_ty'][facs.VALUES]
+        frames = get_scene_frames(bpy.context.scene, pdm_2d)
 
         x_values = self.plot_axis(obj, 0, x_info[facs.VALUES],
-                       x_info[facs.MAXIMAS], adj=p_tx)
+                       x_info[facs.MAXIMAS], frames, adj=p_tx)
         if not plot_all:
             self.plot_axis(obj, 0, x_info[facs.VALUES],
-                           x_info[facs.MINIMAS], adj=p_tx)
+                           x_info[facs.MINIMAS], frames, adj=p_tx)
         y_values = self.plot_axis(obj, 1, y_info[facs.VALUES],
-                       y_info[facs.MAXIMAS], adj=p_ty)
+                       y_info[facs.MAXIMAS], frames, adj=p_ty)
         if not plot_all:
             self.plot_axis(obj, 1, y_info[facs.VALUES],
-                           y_info[facs.MINIMAS], adj=p_ty)
+                           y_info[facs.MINIMAS], frames, adj=p_ty)
 
         return x_values, y_values
 
@@ -524,96 +1156,70 @@ class FACE_OT_pdm2d_animate(bpy.types.Operator):
         tx_adj = head_pose['pose_Tx'][facs.VALUES]
         ty_adj = head_pose['pose_Ty'][facs.VALUES]
         tz_adj = head_pose['pose_Tz'][facs.VALUES]
+        frames = get_scene_frames(bpy.context.scene, pdm_3d)
 
         self.plot_axis(obj, 0, x_info[facs.VALUES],
-                       x_info[facs.MAXIMAS], adj=tx_adj, div=div)
+                       x_info[facs.MAXIMAS], frames, adj=tx_adj, div=div)
         if not plot_all:
             self.plot_axis(obj, 0, x_info[facs.VALUES],
-                           x_info[facs.MINIMAS], adj=tx_adj, div=div)
+                           x_info[facs.MINIMAS], frames, adj=tx_adj, div=div)
         self.plot_axis(obj, 1, y_info[facs.VALUES],
-                       x_info[facs.MAXIMAS], adj=ty_adj, div=div)
+                       x_info[facs.MAXIMAS], frames, adj=ty_adj, div=div)
         if not plot_all:
             self.plot_axis(obj, 1, y_info[facs.VALUES],
-                           x_info[facs.MINIMAS], adj=ty_adj, div=div)
+                           x_info[facs.MINIMAS], frames, adj=ty_adj, div=div)
         self.plot_axis(obj, 2, z_info[facs.VALUES],
-                       x_info[facs.MAXIMAS], adj=tz_adj,  div=div)
+                       x_info[facs.MAXIMAS], frames, adj=tz_adj,  div=div)
         if not plot_all:
             self.plot_axis(obj, 2, z_info[facs.VALUES],
-                           x_info[facs.MINIMAS], adj=tz_adj, div=div)
-
-    def delta(self, pp, startpoint, endpoints):
-        sp = pp[startpoint]
-        num_frames = len(sp[0])
-        resutl = []
-        for i in range(0, len(num_frames)):
-            a = np.array(sp[0][i], sp[1][i])
-            eps = []
-            for e in endpoints:
-                eps.append(pp[e][0][i] + pp[e][1][i])
-            b = np.array(eps)
-            dist = scipy.spatial.distance.cdist(a,b)
-            flat_dist = [item for sublist in dist.tolist() for item in sublist]
-            avg = sum(flat_dist) / len(flat_dist)
-            result.append(avg)
-        return result
-
-    def animate_pdm2d(self, pdm_2d, rigid_data):
+                           x_info[facs.MINIMAS], frames, adj=tz_adj, div=div)
+
+    # Key the distance features of the take, smoothed like the AUs, as
+    # custom properties of an empty so they can be looked at in the graph
+    # editor next to the landmarks. They're keyed on the frames of the
+    # landmark empties.
+    def animate_features(self, features):
+        if not features['frame'][facs.VALUES]:
+            return
+        names = [k for k in features.keys() \
+                 if k != 'frame' and k != 'timestamp']
+        bpy.ops.object.empty_add(type='PLAIN_AXES', radius=0.01)
+        empty = bpy.context.view_layer.objects.active
+        empty.name = 'pdm2d_features'
+        empty.animation_data_create()
+        action = bpy.data.actions.new(empty.name+'Action')
+        empty.animation_data.action = action
+        frames = get_scene_frames(bpy.context.scene, features)
+        for name in names:
+            values = features[name][facs.VALUES]
+            empty[name] = values[0]
+            fc = action.fcurves.new('["%s"]' % name, action_group='features')
+            fc.keyframe_points.add(len(values))
+            fc.keyframe_points.foreach_set('co',
+                [c for f, v in zip(frames, values) for c in (f, v)])
+            fc.update()
+
+    @timing.span('yafr.pdm2d')
+    def animate_pdm2d(self, pdm_2d, rigid_data, features):
         # create all the empties
-        pp = {}
         for k, v in pdm_2d.items():
             if 'y_' in k or 'frame' in k or 'timestamp' in k:
                 continue
             bpy.ops.object.empty_add(type='SPHERE', radius=0.01)
             empty = bpy.context.view_layer.objects.active
-            entry = k.strip('x_')
             empty.name = 'pdm2d_'+k.strip('x_')
             # animate each empty
-            logger.critical('Start plotting %s: %s', k,
-                        str(datetime.datetime.now()))
-            x_values, y_values = self.animate_2d_empty(empty, k, pdm_2d, rigid_data)
+            with timing.span('yafr.pdm2d_empty'):
+                self.animate_2d_empty(empty, k, pdm_2d, rigid_data)
+            timing.count(empties=1)
 
-            # post process the values
-            if len(x_values) != len(y_values):
-                print("Unexpected array lengths")
-                continue
-
-            if not plot_all:
-                continue
-
-            if int(entry) in [51, 62, 57, 66, 54, 12, 48, 4, 54, 11, 5, 57, 8, 53, 29, 49, 55, 9, 59, 7] + \
-                              list(range(13, 15)) + list(range(3,1)):
-                pp[int(entry)] = [x_values, y_values]
-
-        if not plot_all:
-            return
-
-        # keeping deltas on the following points
-        # The array is indexed by frames
-        # upper lip roll: 51-62
-        # lower lip roll: 57-66
-        # left lip side: 54-12
-        # Right lip side: 48-4
-        # left lip up: 54-[13-15]
-        # right lip up: 48-[3-1]
-        # Left lip down: 54-11
-        # Right lip down: 48-5
-        # Chin: 57-8
-        # left upper lip curl: 53-29
-        # right upper lip curl: 49-29
-        # left lower lip curl: 55-9
-        # right lower lip curl: 59-7
-        deltas = [{'upper-lip-roll': self.delta(pp, 51, [62]), 'lower-lip-roll': self.delta(pp, 57, [66]),
-                'left-lip-side': self.delta(pp, 54, [12]), 'right-lip-side': self.delta(pp, 48, [4]),
-                'left-lip-up': self.delta(pp, 54, list(range(13-16))), 'right-lip-up': self.delta(pp, 48, list(range(1, 4))),
-                'left-lip-down': self.delta(pp, 48, [5]), 'right-lip-down': self.delta(pp, 48, [5]),
-                'chin': self.delta(pp, 57, [8]), 'left-upper-lip-curl': self.delta(pp, 53, [29]),
-                'right-upper-lip-curl': self.delta(pp, 49, [29]),
-                'left-lower-lip-curl': self.delta(pp, 55, [9]),
-                'right-lower-lip-curl': self.delta(pp, 59, [7])}]
-        print(deltas)
-        # The idea now is that we can use that delta in comparison with
-        # the basis delta we collected to calculate the percentage of 
+        # The distances between the landmarks around the mouth, upper and
+        # lower lip roll, lip corners, chin and so on, are computed by
+        # facs_process. They can be compared with the distances of a
+        # neutral pose to work out how far the mouth moved.
+        self.animate_features(features)
 
+    @timing.span('yafr.pdm3d')
     def animate_pdm3d(self, pdm_3d, head_pose):
         # create all the empties
         for k, v in pdm_3d.items():
@@ -624,12 +1230,11 @@ class FACE_OT_pdm2d_animate(bpy.types.Operator):
             empty = bpy.context.view_layer.objects.active
             empty.name = 'pdm3d_'+k.strip('X_')
             # animate each empty
-            logger.critical('Start plotting %s: %s', k,
-                        str(datetime.datetime.now()))
-            self.animate_3d_empty(empty, k, pdm_3d, head_pose)
-            #logger.critical('Finished plotting %s: %s', k,
-            #            str(datetime.datetime.now()))
+            with timing.span('yafr.pdm3d_empty'):
+                self.animate_3d_empty(empty, k, pdm_3d, head_pose)
+            timing.count(empties=1)
 
+    @timing.operator_span('yafr.pdm_plot')
     def execute(self, context):
         global plot_all
 
@@ -641,6 +1246,7 @@ class FACE_OT_pdm2d_animate(bpy.types.Operator):
         two_d = scn.yafr_pdm_2d
         plot_all = scn.yafr_pdm_plot_all
 
+        load_facs()
         set_init_state(False)
 
         if po >= ws:
@@ -671,31 +1277,28 @@ class FACE_OT_pdm2d_animate(bpy.types.Operator):
         # reset and reload the data base
         facs.reset_database()
 
-        logger.critical('Start processing CSV: %s',
-                    str(datetime.datetime.now()))
-        rc, msg = process_csv_file(csv, ws, po)
-        logger.critical('Finished processing CSV: %s',
-                    str(datetime.datetime.now()))
+        rc, msg = process_csv_file(csv, ws, po, get_resample_fps(scn),
+                                   scn.yafr_openface_filter)
         # animate the data
         if not rc:
             self.report({'ERROR'}, msg)
             return {'FINISHED'}
         if two_d:
-            logger.critical('Start plotting 2D: %s',
-                        str(datetime.datetime.now()))
-            pdm2d_data = facs.get_pdm2d_data()
-            rigid_data = facs.get_rigid_data()
-            self.animate_pdm2d(pdm2d_data, rigid_data)
-            logger.critical('Finished plotting 2D: %s',
-                        str(datetime.datetime.now()))
+            tables, msg = get_processed(lambda: (
+                facs.get_pdm2d_data(), facs.get_rigid_data(),
+                facs.get_distance_features()))
         else:
-            logger.critical('Start plotting 3D: %s',
-                        str(datetime.datetime.now()))
-            pdm3d_data = facs.get_pdm3d_data()
-            head_pose = facs.get_facs_data()
+            tables, msg = get_processed(lambda: (facs.get_pdm3d_data(),
+                                                 facs.get_facs_data()))
+        if tables is None:
+            self.report({'ERROR'}, msg)
+            return {'FINISHED'}
+        if two_d:
+            pdm2d_data, rigid_data, features = tables
+            self.animate_pdm2d(pdm2d_data, rigid_data, features)
+        else:
+            pdm3d_data, head_pose = tables
             self.animate_pdm3d(pdm3d_data, head_pose)
-            logger.critical('Finished plotting 3D: %s',
-                        str(datetime.datetime.now()))
 
         if two_d:
             frame_end = pdm2d_data['frame'][facs.VALUES][-1]
@@ -729,6 +1332,8 @@ class VIEW3D_PT_tools_openface(bpy.types.Panel):
         col.prop(scn, "yafr_openface_ws", text='')
         col.label(text="Polynomial Order")
         col.prop(scn, "yafr_openface_polyorder", text='')
+        col.label(text="Smoothing Filter")
+        col.prop(scn, "yafr_openface_filter", text='')
         col.label(text="Animation Intensity")
         col.prop(scn, "yafr_openface_au_intensity", text='')
         col.label(text="Vertical Gaze Intensity")
@@ -737,11 +1342,35 @@ class VIEW3D_PT_tools_openface(bpy.types.Panel):
         col.prop(scn, "yafr_openface_hgaze_intensity", text='')
         col.prop(scn, "yafr_openface_mouth", text='Mouth Animation')
         col.prop(scn, "yafr_openface_head", text='Head Animation')
+        col.prop(scn, "yafr_openface_resample", text='Resample to Scene FPS')
+        col.prop(scn, "yafr_openface_eye_landmarks", text='Eyes from Landmarks')
+        col.prop(scn, "yasp_action_cache", text='Reuse Cached Actions')
+        col.label(text="OpenFace Processes")
+        col.prop(scn, "yafr_openface_jobs", text='')
+        col.label(text="Segment Overlap (seconds)")
+        col.prop(scn, "yafr_openface_overlap", text='')
+        col.label(text="Trace file (optional)")
+        col.prop(scn, "yasp_trace_path", text='')
         col = layout.column(align=False)
         col.operator('yafr.animate_face', icon='ANIM_DATA')
         col = layout.column(align=False)
         col.operator('yafr.del_animation', icon='DECORATE_ANIMATE')
 
+        entries = get_openface_cache().get_entries()
+        if not entries:
+            return
+        col = layout.column(align=True)
+        col.label(text="OpenFace Cache")
+        for key, entry, stale in entries:
+            icon = 'ERROR' if stale else 'FILE_MOVIE'
+            col.label(text='%s (%.1f MB)' % (os.path.basename(entry['video']),
+                      entry['size'] / 1e6), icon=icon)
+        row = col.row(align=True)
+        op = row.operator('yafr.purge_openface_cache', text='Purge Stale')
+        op.stale_only = True
+        op = row.operator('yafr.purge_openface_cache', text='Purge All')
+        op.stale_only = False
+
 class VIEW3D_PT_pdm2d_openface(bpy.types.Panel):
     bl_label = "PDM Experimental"
     bl_space_type = "VIEW_3D"
@@ -758,6 +1387,11 @@ class VIEW3D_PT_pdm2d_openface(bpy.types.Panel):
         col.prop(scn, "yafr_pdm_2d", text='2D Plotting')
         col.prop(scn, "yafr_pdm_plot_all", text='Plot All')
         col.operator('yafr.animate_pdm2d_face', icon='ANIM_DATA')
+        col = layout.column(align=True)
+        col.label(text="Calibration file")
+        col.prop(scn, "yafr_pdm_calibration", text='')
+        col.prop(scn, "yafr_pdm_bounded", text='Bounded Weights')
+        col.operator('yafr.solve_pdm_face', icon='ANIM_DATA')
         col = layout.column(align=False)
         col.operator('yafr.rm_pdm3d_rotation', icon='ANIM_DATA')
         col = layout.column(align=False)
@@ -1,7 +1,6 @@
 import bpy
 import logging
 import os
-import json
 from bpy_extras.io_utils import ExportHelper, ImportHelper
 from bpy.app.handlers import persistent
 import time
@@ -11,6 +10,10 @@ import platform
 import random
 import math
 from bpy.props import EnumProperty, StringProperty, BoolVectorProperty
+from . import yasp_process
+from . import timing
+from . import action_cache
+from . import file_cache
 
 random.seed(23483)
 addon_path = os.path.dirname(os.path.realpath(__file__))
@@ -22,15 +25,65 @@ pocketsphinxlib = None
 sphinxadlib = None
 sphinxbaselib = None
 yasplib = None
+yasp = None
 libs_loaded = True
+libs_attempted = False
 
 logger = logging.getLogger(__name__)
 
+# In-memory log of the aligner. Kept around so the log of the last run
+# can be looked at when it fails
+yasp_log_buffer = yasp_process.YaspLogBuffer()
+yasp_log_cb_ptr = None
+
+# sphinxbase's err_cb_f is variadic:
+#   void (*)(void *user_data, err_lvl_t lvl, const char *fmt, ...)
+# ctypes can't describe that, so declare enough pointer sized arguments to
+# cover the formats sphinxbase passes to it. The extra arguments are
+# only looked at if the format asks for them.
+yasp_log_cb_t = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_int,
+                                 ctypes.c_char_p, ctypes.c_void_p,
+                                 ctypes.c_void_p, ctypes.c_void_p,
+                                 ctypes.c_void_p)
+
+def yasp_read_c_str(ptr):
+    return ctypes.string_at(ptr).decode(errors='replace')
+
+def yasp_log_cb(user_data, level, fmt, a1, a2, a3, a4):
+    if not fmt:
+        return
+    try:
+        msg = yasp_process.format_c_message(fmt.decode(errors='replace'),
+                                            [a1, a2, a3, a4], yasp_read_c_str)
+    except Exception:
+        return
+    yasp_log_buffer.log(level, msg)
+
+# Route the aligner logs into yasp_log_buffer instead of a log file.
+# yasp_setup_logging() only installs its callback once it managed to open
+# the log files, so register the callback with sphinxbase directly.
+def yasp_setup_buffer_logging(level):
+    global yasp_log_cb_ptr
+
+    if not yasp_log_cb_ptr:
+        yasp_log_cb_ptr = yasp_log_cb_t(yasp_log_cb)
+    yasp_log_buffer.clear()
+    yasp_log_buffer.set_level(level)
+    sphinxbaselib.err_set_logfp(None)
+    sphinxbaselib.err_set_callback(yasp_log_cb_ptr, None)
+
+def get_yasp_logs(level=yasp_process.ERR_DEBUG):
+    return yasp_log_buffer.get_lines(level)
+
 # Load the .so files we need
 # Then import yasp
 # Now we're ready to do some speech parsing
 def yasp_load_dep():
     global libs_loaded
+    global pocketsphinxlib
+    global sphinxadlib
+    global sphinxbaselib
+    global yasplib
     pocketsphinx = os.path.join(yasp_sphinx_dir, "libpocketsphinx.so")
     sphinxad = os.path.join(yasp_sphinx_dir, "libsphinxad.so")
     sphinxbase = os.path.join(yasp_sphinx_dir, "libsphinxbase.so")
@@ -45,16 +98,67 @@ def yasp_load_dep():
         sphinxadlib = ctypes.cdll.LoadLibrary(os.path.abspath(sphinxad))
         pocketsphinxlib = ctypes.cdll.LoadLibrary(os.path.abspath(pocketsphinx))
         yasplib = ctypes.cdll.LoadLibrary(os.path.abspath(yasp))
+        # The result buffer is owned by the native library. Keep it as a
+        # raw pointer so we can free it once we're done with it.
+        yasplib.yasp_interpret_get_str.restype = ctypes.c_void_p
+        yasplib.yasp_interpret_get_str.argtypes = [ctypes.c_char_p,
+            ctypes.c_char_p, ctypes.c_char_p]
+        yasplib.yasp_free_json_str.restype = None
+        yasplib.yasp_free_json_str.argtypes = [ctypes.c_void_p]
+        sphinxbaselib.err_set_logfp.restype = None
+        sphinxbaselib.err_set_logfp.argtypes = [ctypes.c_void_p]
+        sphinxbaselib.err_set_callback.restype = None
+        sphinxbaselib.err_set_callback.argtypes = [yasp_log_cb_t,
+                                                   ctypes.c_void_p]
     except Exception as e:
         logger.critical(e)
         logger.critical("Failed to load libraries")
         libs_loaded = False
 
+# Run the aligner and return the phoneme track as a
+# yasp_process.PhonemeSegments.
+# The result buffer is copied out and handed back to the native library
+# right away, so nothing is leaked regardless of whether parsing succeeds.
+def yasp_interpret_segments(wave, transcript):
+    with timing.span('yasp.recognition'):
+        res = yasplib.yasp_interpret_get_str(wave.encode(),
+                                             transcript.encode(), None)
+    if not res:
+        return None
+    try:
+        json_str = ctypes.string_at(res)
+    finally:
+        yasplib.yasp_free_json_str(res)
+    with timing.span('yasp.parse') as s:
+        segments = yasp_process.segments_from_json(json_str)
+        # None if the json has no words or phonemes
+        if segments is not None:
+            s.count(segments=len(segments))
+    return segments
+
+# Loading the sphinx libraries is deferred until the first time they're
+# needed, so enabling the add-on doesn't pay for it.
+def load_yasp():
+    global libs_loaded
+    global libs_attempted
+    global yasp
+
+    if libs_attempted:
+        return libs_loaded and yasp is not None
+
+    libs_attempted = True
+    if platform.system() != "Linux":
+        libs_loaded = False
+        return False
 
-if platform.system() == "Linux":
     yasp_load_dep()
     if libs_loaded:
-        import yasp
+        try:
+            import yasp
+        except Exception as e:
+            logger.critical(e)
+            libs_loaded = False
+    return libs_loaded and yasp is not None
 
 def get_data_path():
     addon_directory = os.path.dirname(os.path.realpath(__file__))
@@ -70,24 +174,98 @@ def get_data_path():
 # of phonemes which we use for the animation
 class YASP2MBPhonemeMapper(object):
     def __init__(self):
-        self.yasp_2_mb_phoneme_map = None
+        self.phoneme_map = None
         data_path = get_data_path()
         if not data_path:
-            logger.critical("CRITICAL", "%s not found. Please check your Blender addons directory. Might need to reinstall YASP", data_path)
+            logger.critical("%s not found. Please check your Blender addons directory. Might need to reinstall YASP", data_path)
             raise ValueError("No Data directory")
 
         map_file = os.path.join(data_path, 'yasp_map.json')
-        if not map_file:
-            logger.critical("CRITICAL", "%s not found. Please check your Blender addons directory. Might need to reinstall YASP", map_file)
-        with open(map_file, 'r') as f:
-            self.yasp_2_mb_phoneme_map = json.load(f)
+        if not os.path.isfile(map_file):
+            logger.critical("%s not found. Please check your Blender addons directory. Might need to reinstall YASP", map_file)
+        # the compiled phoneme x viseme matrix is cached next to the map
+        cache_file = os.path.join(data_path, 'yasp_map.npz')
+        self.phoneme_map = yasp_process.load_phoneme_map(map_file, cache_file)
+
+    def get_visemes(self):
+        return self.phoneme_map.visemes
+
+    # viseme weights of a list of phoneme names. One row per phoneme, one
+    # column per viseme
+    def get_track_weights(self, names):
+        return self.phoneme_map.get_weights(self.phoneme_map.get_ids(names))
 
     def get_phoneme_animation_data(self, phoneme):
-        try:
-            anim_data = self.yasp_2_mb_phoneme_map[phoneme]
-        except:
-            return None
-        return anim_data
+        return self.phoneme_map.get_phoneme_animation_data(phoneme)
+
+# Write whole F-curves of the rotation_quaternion[index] of bones in one
+# go, replacing any keys already in the written frame range.
+#   curves: list of (bone_name, frames, values)
+@timing.span('yasp.keyframes')
+def write_bone_curves(rig, curves, index=3):
+    if not rig.animation_data:
+        rig.animation_data_create()
+    action = rig.animation_data.action
+    if not action:
+        action = bpy.data.actions.new(rig.name+'Action')
+        rig.animation_data.action = action
+
+    for bone_name, frames, values in curves:
+        if not len(frames) or not rig.pose.bones.get(bone_name):
+            continue
+        data_path = 'pose.bones["%s"].rotation_quaternion' % bone_name
+        co = []
+        fc = action.fcurves.find(data_path, index=index)
+        if fc:
+            # keep the keys outside of the range we're writing
+            old = [0.0] * (len(fc.keyframe_points) * 2)
+            fc.keyframe_points.foreach_get('co', old)
+            lo = frames[0]
+            hi = frames[-1]
+            for i in range(0, len(old), 2):
+                if old[i] < lo or old[i] > hi:
+                    co.append((old[i], old[i+1]))
+            action.fcurves.remove(fc)
+        co.extend(zip(frames, values))
+        co.sort()
+        fc = action.fcurves.new(data_path, index=index,
+                                action_group=bone_name)
+        fc.keyframe_points.add(len(co))
+        fc.keyframe_points.foreach_set('co',
+            [c for point in co for c in point])
+        fc.update()
+        timing.count(keys=len(frames))
+
+# The curves of the viseme bones and of the rest bone from a track of
+# frames x visemes and the rest pose value of every frame, without the
+# keys that lie on a line between their neighbours
+def track_curves(frames, values, rest):
+    import numpy as np
+
+    bone_names = ['ph_'+v for v in get_yaspmapper().get_visemes()] + \
+                 ['ph_REST']
+    values = np.column_stack((values, rest))
+    keep = yasp_process.key_frames_mask(values)
+    curves = []
+    for col, name in enumerate(bone_names):
+        mask = keep[:, col]
+        curves.append((name, frames[mask].tolist(),
+                       values[mask, col].tolist()))
+    return curves
+
+# Viseme curves driven by the loudness and the spectral balance of the
+# audio alone, starting on frame offset. Needs no transcript or speech
+# recognition, which makes it cheap enough for background characters.
+@timing.span('yasp.energy')
+def energy_curves(wave, fps, offset, gain=1.0):
+    import numpy as np
+
+    samples, rate = yasp_process.read_wave(wave)
+    rms, shares = yasp_process.energy_envelope(samples, rate, fps)
+    values, rest = yasp_process.energy_viseme_values(rms, shares,
+                        get_yaspmapper().get_visemes(), gain=gain)
+    timing.count(frames=len(rms))
+    return track_curves(np.arange(len(rms)) + offset, values, rest)
 
 class Bone(object):
     def __init__(self, bone):
@@ -219,6 +397,14 @@ class Sequence(object):
         self.markers = []
         self.bones = {}
         self.bones_set = False
+        # bones of the phoneme rig in the order of the mapper's visemes
+        self.viseme_bones = []
+
+    # Drop the bones of a previous rig and use the ones passed in
+    def reset_bones(self, bones):
+        self.bones_set = False
+        self.bones = {}
+        self.set_bones(bones)
 
     def set_bones(self, bones):
         if self.bones_set == True:
@@ -230,6 +416,9 @@ class Sequence(object):
             b = Bone(bone)
             self.bones[b.get_name()] = b
 
+        self.viseme_bones = [self.bones.get('ph_'+v) \
+                             for v in get_yaspmapper().get_visemes()]
+
     # Markers are added in sequential order
     def add_marker(self, m):
         self.markers.append(m)
@@ -242,6 +431,18 @@ class Sequence(object):
         for m in self.markers:
             scn.timeline_markers.remove(m)
         self.markers = []
+        self.save_track()
+
+    # Store the markers in the strip, so they survive the file being
+    # closed. See SequenceMgr.restore_sequence()
+    def save_track(self):
+        strip = self.sequence
+        if self.markers:
+            strip['yasp_track'] = yasp_process.pack_track(
+                [m.name for m in self.markers],
+                [m.frame for m in self.markers])
+        elif strip.get('yasp_track') is not None:
+            del strip['yasp_track']
 
     def is_sequence(self, s):
         return (self.sequence == s)
@@ -274,7 +475,9 @@ class Sequence(object):
         for k, bone in self.bones.items():
             bone.insert_keyframe(frame, 0)
 
-    def set_keyframe(self, m, pm, idx):
+    # weights is the marker's row of viseme values. If not provided it's
+    # looked up from the marker name
+    def set_keyframe(self, m, pm, idx, weights=None):
         delta = 0
         # Heuristic: If the delta between this marker and the previous
         # marker is >= 12 frames then we want to set a rest
@@ -302,37 +505,103 @@ class Sequence(object):
             self.reset_all_bones(frame)
         self.reset_all_bones(m.frame)
 
-        phonemes = yaspmapper.get_phoneme_animation_data(m.name)
-        if not phonemes:
-            logger.critical("Can't find corresponding mapping for:", m.name)
+        if weights is None:
+            weights = get_yaspmapper().get_track_weights([m.name])[0]
+        if not weights.any():
+            logger.critical("Can't find corresponding mapping for: %s", m.name)
             return
-        for phone in phonemes:
-            bone_name = 'ph_'+phone[0]
-            bone = self.bones[bone_name]
-            bone.insert_keyframe(m.frame, phone[1])
+        for bone, value in zip(self.viseme_bones, weights.tolist()):
+            if bone:
+                bone.insert_keyframe(m.frame, value)
+
+    # Compute the viseme curves of the whole marker track at once with
+    # yasp_process.coarticulate(). Returns a list of
+    # (bone_name, frames, values) as taken by write_bone_curves()
+    def coarticulated_curves(self):
+        scn = bpy.context.scene
+        if not self.markers:
+            return []
+        mapper = get_yaspmapper()
+        starts = [m.frame for m in self.markers]
+        fps = scn.render.fps / scn.render.fps_base
+        # a phoneme lasts until the next one starts
+        ends = starts[1:] + [starts[-1] + round(fps * 0.1)]
+        with timing.span('yasp.coarticulation') as s:
+            ids = mapper.phoneme_map.get_ids([m.name for m in self.markers])
+            frames, values, rest = yasp_process.coarticulate(ids, starts,
+                                        ends, fps, mapper.phoneme_map)
+            s.count(markers=len(ids), frames=len(frames))
+        return track_curves(frames, values, rest)
+
+    def get_rig(self):
+        if not self.bones:
+            return None
+        return next(iter(self.bones.values())).mybone.id_data
 
+    # write the coarticulated viseme curves out in bulk
+    def animate_coarticulated(self):
+        if not self.bones:
+            return
+        curves = self.coarticulated_curves()
+        if curves:
+            write_bone_curves(self.get_rig(), curves)
 
-    # go through the markers on the selected sequence.
-    # for each marker look up the marker name in our mapper
-    # Set the corresponding bones in the list to the values specified.
-    def animate_all_markers(self):
+    # Run the per marker heuristics and the averaging pass over the
+    # markers. This only fills in the animation data of the bones.
+    def set_marker_keys(self):
         idx = 0
-        bpy.ops.pose.select_all(action='DESELECT')
         pm = None
+        # look up the viseme values of the whole track at once
+        weights = get_yaspmapper().get_track_weights(
+                        [m.name for m in self.markers])
         # first pass is to create keyframe entries in every bone for each
         # marker
-        for m in self.markers:
-            self.set_keyframe(m, pm, idx)
-            pm = m
-            idx = idx + 1
+        with timing.span('yasp.markers_keys', markers=len(self.markers)):
+            for m in self.markers:
+                self.set_keyframe(m, pm, idx, weights[idx])
+                pm = m
+                idx = idx + 1
+
+            self.reset_all_bones(m.frame + 5)
+
+        # second pass is to run a heuristic pass on the animation data
+        window_size = float(bpy.context.scene.yasp_avg_window_size)
+        for k, bone in self.bones.items():
+            with timing.span('yasp.heuristics') as s:
+                bone.heuristic_pass2(window_size)
+                s.count(keys=len(bone.animation_data))
+
+    # Compute the keys of the track without touching the rig. Returns a
+    # list of (bone_name, frames, values) as taken by write_bone_curves()
+    def animation_curves(self):
+        if bpy.context.scene.yasp_coarticulation:
+            return self.coarticulated_curves()
+
+        if not self.markers:
+            return []
+        self.set_marker_keys()
+        curves = []
+        for name, bone in self.bones.items():
+            frames = sorted(bone.animation_data.keys())
+            curves.append((name, frames,
+                           [bone.animation_data[f] for f in frames]))
+        return curves
 
-        self.reset_all_bones(m.frame + 5)
+    # go through the markers on the selected sequence.
+    # for each marker look up the marker name in our mapper
+    # Set the corresponding bones in the list to the values specified.
+    def animate_all_markers(self):
+        if bpy.context.scene.yasp_coarticulation:
+            self.animate_coarticulated()
+            return
+
+        bpy.ops.pose.select_all(action='DESELECT')
+        self.set_marker_keys()
 
-        # second pass is to run a heuristic pass on the animation data and
-        # animate
         for k, bone in self.bones.items():
-            bone.heuristic_pass2(float(bpy.context.scene.yasp_avg_window_size))
-            bone.animate()
+            with timing.span('yasp.keyframes') as s:
+                bone.animate()
+                s.count(keys=len(bone.animation_data))
 
     def animate_marker_at_frame(self, cur_frame):
         idx = 0
@@ -366,10 +635,15 @@ class Sequence(object):
         bone = self.bones['ph_REST']
         bone.insert_keyframe(frame, random.uniform(0, 1))
 
+# The marked strips. Their markers are stored in the strips (see
+# Sequence.save_track()) when marked and when the file is saved. After a
+# file is opened the strips are picked up again on first use, with the
+# timeline markers they had.
 class SequenceMgr(object):
     def __init__(self):
         self.sequences = []
         self.orig_frame_set = False
+        self.restored = False
 
     def set_orig_frame(self, scn):
         if not self.orig_frame_set:
@@ -385,12 +659,63 @@ class SequenceMgr(object):
         if s in self.sequences:
                 self.sequences.remove(s)
 
-    def get_sequence(self, s):
+    def find_sequence(self, s):
         for seq in self.sequences:
             if seq.is_sequence(s):
                 return seq
         return None
 
+    def get_sequence(self, s):
+        seq = self.find_sequence(s)
+        if not seq:
+            seq = self.restore_sequence(s, bpy.context.scene)
+        return seq
+
+    # Pick up a strip marked before the file was opened. Its markers are
+    # matched up with the timeline markers by name and frame, markers
+    # which are gone are put back.
+    def restore_sequence(self, s, scn):
+        track = s.get('yasp_track')
+        if track is None:
+            return None
+        track = yasp_process.unpack_track(track)
+        if not track:
+            logger.critical("can't read the phoneme track of %s", s.name)
+            return None
+        claimed = set()
+        for seq in self.sequences:
+            claimed.update(seq.markers)
+        free = {}
+        for m in scn.timeline_markers:
+            if m not in claimed:
+                free.setdefault((m.name, m.frame), []).append(m)
+        seq = Sequence(s)
+        for name, frame in zip(*track):
+            found = free.get((name, frame))
+            if found:
+                seq.add_marker(found.pop(0))
+            else:
+                seq.mark_seq_at_frame(name, frame, scn)
+        self.sequences.append(seq)
+        return seq
+
+    # pick up every marked strip of the scene
+    def restore_all(self, scn):
+        if self.restored or not scn.sequence_editor:
+            return
+        self.restored = True
+        for s in scn.sequence_editor.sequences_all:
+            if not self.find_sequence(s):
+                self.restore_sequence(s, scn)
+
+    def save_tracks(self):
+        for seq in self.sequences:
+            try:
+                seq.save_track()
+            except ReferenceError:
+                # the strip was deleted
+                pass
+
     def set_bones(self, s, bones):
         seq = self.get_sequence(s)
         if not seq:
@@ -453,71 +778,200 @@ class SequenceMgr(object):
             return
         seq.del_all_keyframes()
 
+    # Animate every marked strip. The strips are mapped to their rigs and
+    # the keys of all of them are computed first, then each rig's F-curves
+    # are written in one go. Nothing is selected and the mode isn't
+    # changed. Returns the number of strips animated and the names of the
+    # rigs that couldn't be found.
+    #
+    # With the action cache on, a rig whose strips were animated the same
+    # way before gets the cached Action instead.
+    def animate_all_sequences(self, scn):
+        self.restore_all(scn)
+        rigs = {}
+        missing = []
+        for seq in sorted(self.sequences,
+                          key=lambda q: q.markers[0].frame if q.markers else 0):
+            if not seq.markers:
+                continue
+            rig_name = get_strip_rig_name(seq.sequence, scn)
+            rig = get_phoneme_rig(scn, rig_name)
+            if not rig:
+                if rig_name not in missing:
+                    missing.append(rig_name)
+                continue
+            rigs.setdefault(rig.name, [rig, []])[1].append(seq)
+
+        count = 0
+        cache = action_cache.get_action_cache()
+        for rig, seqs in rigs.values():
+            count = count + len(seqs)
+            current = action_cache.get_action(rig)
+            # only actions made by a previous run are replaced, other
+            # animation on the rig is kept
+            from_cache = current and 'yasp_cache_key' in current
+            key = None
+            if scn.yasp_action_cache and (not current or from_cache):
+                key = get_lipsync_key(scn, seqs)
+                actions = cache.get_actions(key)
+                if actions:
+                    action_cache.assign_action(rig, actions['phoneme'])
+                    continue
+                if from_cache:
+                    rig.animation_data.action = None
+            elif from_cache:
+                action_cache.forget_action(current)
+
+            bone_keys = {}
+            for seq in seqs:
+                if seq.get_rig() != rig:
+                    seq.reset_bones(rig.pose.bones)
+                # later strips win where strips overlap
+                for name, frames, values in seq.animation_curves():
+                    bone_keys.setdefault(name, {}).update(zip(frames, values))
+            curves = []
+            for name, keys in bone_keys.items():
+                frames = sorted(keys.keys())
+                curves.append((name, frames, [keys[f] for f in frames]))
+            write_bone_curves(rig, curves)
+            if key and action_cache.get_action(rig):
+                try:
+                    cache.store(key, rig.name, get_lipsync_files(seqs),
+                                {'phoneme': rig.animation_data.action})
+                except Exception as e:
+                    logger.critical(e)
+        return count, missing
+
     def restore_start_end_frames(self):
         bpy.context.scene.frame_start = self.orig_frame_start
         bpy.context.scene.frame_end = self.orig_frame_end
 
+# The wave and transcript files of the strips and the phoneme map
+def get_lipsync_files(seqs):
+    files = [os.path.join(get_data_path(), 'yasp_map.json')]
+    for seq in seqs:
+        sound = getattr(seq.sequence, 'sound', None)
+        if sound:
+            files.append(bpy.path.abspath(sound.filepath))
+        transcript = seq.sequence.get('yasp_transcript', '')
+        if transcript:
+            files.append(transcript)
+    return [f for f in files if os.path.isfile(f)]
+
+# The action cache key of the animation of strips on one rig: the content
+# of their files, their markers and the animation settings
+def get_lipsync_key(scn, seqs):
+    params = {'kind': 'lipsync',
+              'coarticulation': scn.yasp_coarticulation,
+              'window_size': scn.yasp_avg_window_size,
+              'fps': scn.render.fps / scn.render.fps_base,
+              'markers': [[(m.name, m.frame) for m in seq.markers] \
+                          for seq in seqs]}
+    return action_cache.get_action_cache().get_key(get_lipsync_files(seqs),
+                                                   params)
+
 seqmgr = SequenceMgr()
-yaspmapper = YASP2MBPhonemeMapper()
+yaspmapper = None
+pruned_model_cache = None
+
+# The strips of the file which was open are gone
+@persistent
+def yasp_load_post(dummy):
+    global seqmgr
+    seqmgr = SequenceMgr()
+
+# markers may have been moved since the strips were marked
+@persistent
+def yasp_save_pre(dummy):
+    seqmgr.save_tracks()
+
+def get_pruned_model_cache():
+    global pruned_model_cache
+    if not pruned_model_cache:
+        pruned_model_cache = yasp_process.PrunedModelCache(
+            file_cache.get_cache_dir('dict'), yasp_model_dir)
+    return pruned_model_cache
+
+# The model directory with a dictionary of only the words of the
+# transcript, the number of distinct words in the transcript and those of
+# them which aren't in the dictionary. Falls back to
+# the shipped model if the pruned one can't be made.
+@timing.span('yasp.dictionary')
+def get_transcript_model(transcript):
+    try:
+        return get_pruned_model_cache().get_model_dir(transcript)
+    except Exception as e:
+        logger.critical("Failed to prune the dictionary: %s", e)
+        return yasp_model_dir, 0, []
+
+def get_yaspmapper():
+    global yaspmapper
+    if not yaspmapper:
+        yaspmapper = YASP2MBPhonemeMapper()
+    return yaspmapper
 
 class YASP_OT_mark(bpy.types.Operator):
     bl_idname = "yasp.mark_audio"
     bl_label = "Mark"
     bl_description = "Run YASP and mark audio"
 
-    def mark_audio(self, json_str, offset, seq, scn):
-        jdict = json.loads(json_str)
-        word_list = []
-        # iterate over the json dictionary to and create markers
-        try:
-            word_list = jdict['words']
-        except:
-            return False
-
-        for word in word_list:
+    @timing.span('yasp.markers')
+    def mark_audio(self, segments, offset, seq, scn):
+        # calculate the frames to insert the markers at
+        frames = segments.get_frames(scn.render.fps/scn.render.fps_base,
+                                     offset)
+        for i in range(0, len(segments)):
             try:
-                phonemes = word['phonemes']
-            except:
+                seqmgr.mark_seq_at_frame(seq, segments.get_phoneme(i),
+                                         frames[i], scn)
+            except Exception as e:
+                logger.critical(e)
                 return False
-            for phone in phonemes:
-                try:
-                    # calculate the frame to insert the marker
-                    frame = round((scn.render.fps/scn.render.fps_base) *
-                                  (phone['start'] / 100))
-                    cur_frame = offset + frame
-                    seqmgr.mark_seq_at_frame(seq, phone['phoneme'], cur_frame, scn)
-                except Exception as e:
-                    logger.critical(e)
-                    return False
+        timing.count(markers=len(segments))
         return True
 
-    def free_json_str(self, json_str):
-        #yasp.yasp_free_json_str(json_str)
-        return
-
     def run_yasp(self, wave, transcript, offset):
         if not wave or not transcript:
             self.report({'ERROR'}, "bad wave or transcript files")
             return None
 
-        logs = yasp.yasp_logs()
-        yasp.yasp_set_modeldir(yasp_model_dir)
-        yasp.yasp_setup_logging(logs, None, "MB_YASP_Logs")
-        json_str = yasp.yasp_interpret_get_str(wave, transcript, None)
-        yasp.yasp_finish_logging(logs)
-        if not json_str:
-            self.report({'ERROR'}, "Couldn't parse speech")
+        scn = bpy.context.scene
+        model_dir, nwords, oov = get_transcript_model(transcript)
+        if oov:
+            if len(oov) == nwords:
+                self.report({'ERROR'}, "None of the words of the transcript "
+                            "are in the dictionary")
+                return None
+            self.report({'WARNING'}, "Words not in the dictionary: " +
+                        ', '.join(oov))
+        yasp.yasp_set_modeldir(model_dir)
+        yasp_setup_buffer_logging(int(scn.yasp_log_level))
+        segments = yasp_interpret_segments(wave, transcript)
+        if scn.yasp_log_path:
+            try:
+                yasp_log_buffer.dump(bpy.path.abspath(scn.yasp_log_path))
+            except Exception as e:
+                logger.critical(e)
+        if not segments:
+            msg = "Couldn't parse speech"
+            errors = get_yasp_logs(yasp_process.ERR_WARN)
+            if errors:
+                msg = msg + '\n' + '\n'.join(errors[-5:])
+            self.report({'ERROR'}, msg)
             return None
-        if os.path.exists("MB_YASP_Logs"):
-            os.remove("MB_YASP_Logs")
 
-        return json_str
+        return segments
 
+    @timing.operator_span('yasp.mark')
     def execute(self, context):
         scn = context.scene
         wave = scn.yasp_wave_path
         transcript = scn.yasp_transcript_path
 
+        if not load_yasp():
+            self.report({'ERROR'}, 'Failed to load YASP libraries')
+            return {'FINISHED'}
+
         if not os.path.isfile(wave) or \
            not os.path.isfile(transcript):
             self.report({'ERROR'}, 'Bad path to wave or transcript')
@@ -532,8 +986,8 @@ class YASP_OT_mark(bpy.types.Operator):
                 self.report({'ERROR'}, 'Bad start frame')
                 return {'FINISHED'}
 
-        json_str = self.run_yasp(wave, transcript, start_frame)
-        if not json_str:
+        segments = self.run_yasp(wave, transcript, start_frame)
+        if not segments:
             return {'FINISHED'}
 
         # find a free channel in the sequence editor
@@ -551,17 +1005,15 @@ class YASP_OT_mark(bpy.types.Operator):
         seq = scn.sequence_editor.sequences.new_sound(os.path.basename(wave), wave,
                    channel_select, start_frame)
 
+        # the action cache keys the strip's animation by its transcript too
+        seq['yasp_transcript'] = os.path.realpath(transcript)
         seqmgr.add_sequence(seq)
 
-        if not self.mark_audio(json_str, start_frame, seq, scn):
+        if not self.mark_audio(segments, start_frame, seq, scn):
             seqmgr.rm_seq_from_scene(seq, scn)
             self.report({'ERROR'}, 'Failed to mark the audio file')
-            # some memory management
-            self.free_json_str(json_str)
             return {'FINISHED'}
-
-        # some memory management
-        self.free_json_str(json_str)
+        seqmgr.get_sequence(seq).save_track()
 
         # set the end frame
         end = 0
@@ -606,15 +1058,32 @@ class YASP_OT_delete_seq(bpy.types.Operator):
 
         return {'FINISHED'}
 
+# The rig a strip is animating can be set with a 'yasp_rig' custom
+# property on the strip. Otherwise it's the scene's phoneme rig.
+def get_strip_rig_name(strip, scn):
+    name = strip.get('yasp_rig', '')
+    if name:
+        return name
+    if scn.yasp_phoneme_rig:
+        return scn.yasp_phoneme_rig
+    return 'MBLab_skeleton_phoneme_rig'
+
+def get_phoneme_rig(scn, name=''):
+    if not name:
+        name = scn.yasp_phoneme_rig
+    if not name:
+        name = 'MBLab_skeleton_phoneme_rig'
+    rig = bpy.data.objects.get(name)
+    if not rig or rig.type != 'ARMATURE':
+        return None
+    return rig
+
 def set_animation_prereq(scn):
     seq = scn.sequence_editor.active_strip
     if not seq or not seq.select:
         return 'STRIP_ERROR', None
 
-    if not scn.yasp_phoneme_rig:
-        phoneme_rig = bpy.data.objects.get('MBLab_skeleton_phoneme_rig')
-    else:
-        phoneme_rig = bpy.data.objects.get(scn.yasp_phoneme_rig)
+    phoneme_rig = get_phoneme_rig(scn)
     if not phoneme_rig:
         return 'RIG_ERROR', None
 
@@ -633,6 +1102,7 @@ class YASP_OT_setallKeyframes(bpy.types.Operator):
     bl_label = "Animate"
     bl_description = "Set all marked lip-sync keyframe"
 
+    @timing.operator_span('yasp.animate')
     def execute(self, context):
         scn = context.scene
         rc, seq = set_animation_prereq(scn)
@@ -647,6 +1117,73 @@ class YASP_OT_setallKeyframes(bpy.types.Operator):
         seqmgr.animate_all_markers(seq)
         return {'FINISHED'}
 
+class YASP_OT_animate_all_strips(bpy.types.Operator):
+    bl_idname = "yasp.animate_all_strips"
+    bl_label = "Animate All Strips"
+    bl_description = "Animate every marked strip on its phoneme rig"
+
+    @timing.operator_span('yasp.animate_all')
+    def execute(self, context):
+        scn = context.scene
+        count, missing = seqmgr.animate_all_sequences(scn)
+        if missing:
+            self.report({'WARNING'}, "Phoneme rigs not found: " +
+                        ', '.join(missing))
+        if not count:
+            self.report({'ERROR'}, "No marked strips to animate")
+            return {'FINISHED'}
+        self.report({'INFO'}, "Animated %d strips" % count)
+        return {'FINISHED'}
+
+class YASP_OT_energy_lipsync(bpy.types.Operator):
+    bl_idname = "yasp.energy_lipsync"
+    bl_label = "Energy Lip-sync"
+    bl_description = "Open the mouth with the loudness of the audio. Needs no transcript"
+
+    @timing.operator_span('yasp.energy_lipsync')
+    def execute(self, context):
+        scn = context.scene
+        wave = scn.yasp_wave_path
+
+        if not os.path.isfile(wave):
+            self.report({'ERROR'}, 'Bad path to wave file')
+            return {'FINISHED'}
+
+        phoneme_rig = get_phoneme_rig(scn)
+        if not phoneme_rig:
+            self.report({'ERROR'}, "Phoneme Rig not found")
+            return {'FINISHED'}
+
+        start_frame = scn.yasp_start_frame
+        if not start_frame:
+            start_frame = 1
+
+        fps = scn.render.fps / scn.render.fps_base
+        try:
+            curves = energy_curves(wave, fps, start_frame,
+                                   scn.yasp_energy_gain)
+        except Exception as e:
+            logger.critical(e)
+            self.report({'ERROR'}, "Failed to read the wave file: %s" % e)
+            return {'FINISHED'}
+
+        # the rig's action isn't the cached one anymore
+        action_cache.forget_action(action_cache.get_action(phoneme_rig))
+        write_bone_curves(phoneme_rig, curves)
+        end = max([c[1][-1] for c in curves if c[1]] + [scn.frame_end])
+        scn.frame_end = int(end)
+        return {'FINISHED'}
+
+class YASP_OT_purge_action_cache(bpy.types.Operator):
+    bl_idname = "yasp.purge_action_cache"
+    bl_label = "Purge Action Cache"
+    bl_description = "Delete the cached lip-sync and facial animation Actions"
+
+    def execute(self, context):
+        removed = action_cache.get_action_cache().purge()
+        self.report({'INFO'}, "Removed %d cached Actions" % removed)
+        return {'FINISHED'}
+
 class YASP_OT_deleteallKeyframes(bpy.types.Operator):
     bl_idname = "yasp.delete_all_keyframes"
     bl_label = "Remove Animation"
@@ -748,12 +1285,21 @@ class VIEW3D_PT_tools_mb_yasp(bpy.types.Panel):
 
         seqmgr.set_orig_frame(scn)
 
-        if platform.system() != "Linux":
-            col.label(text="Linux only feature", icon='ERROR')
-            return
-
-        if not libs_loaded:
-            col.label(text="Libraries not loaded", icon='ERROR')
+        # energy lip-sync doesn't need the aligner
+        if platform.system() != "Linux" or not libs_loaded:
+            if platform.system() != "Linux":
+                col.label(text="Linux only feature", icon='ERROR')
+            else:
+                col.label(text="Libraries not loaded", icon='ERROR')
+            col.label(text="Phoneme Rig Name")
+            col.prop(scn, "yasp_phoneme_rig", text='')
+            col.label(text="Path to WAV file")
+            col.prop(scn, "yasp_wave_path", text='')
+            col.label(text="Start on frame")
+            col.prop(scn, "yasp_start_frame", text="")
+            col.prop(scn, "yasp_energy_gain", text="Energy Gain")
+            col = layout.column(align=True)
+            col.operator('yasp.energy_lipsync', icon='SOUND')
             return
 
         col.label(text="Phoneme Rig Name")
@@ -766,12 +1312,26 @@ class VIEW3D_PT_tools_mb_yasp(bpy.types.Panel):
         col.prop(scn, "yasp_start_frame", text="")
         col.label(text="Window Size")
         col.prop(scn, "yasp_avg_window_size", text="")
+        col.prop(scn, "yasp_coarticulation", text="Coarticulation")
+        col.label(text="Log Level")
+        col.prop(scn, "yasp_log_level", text="")
+        col.label(text="Log file (optional)")
+        col.prop(scn, "yasp_log_path", text="")
+        col.label(text="Trace file (optional)")
+        col.prop(scn, "yasp_trace_path", text="")
         col = layout.column(align=True)
         row = col.row(align=False)
         row.operator('yasp.mark_audio', icon='MARKER_HLT')
         row.operator('yasp.unmark_audio', icon='MARKER')
         col = layout.column(align=True)
         col.operator('yasp.set_all_keyframes', icon='DECORATE_KEYFRAME')
+        col.operator('yasp.animate_all_strips', icon='DECORATE_KEYFRAME')
+        row = col.row(align=True)
+        row.operator('yasp.energy_lipsync', icon='SOUND')
+        row.prop(scn, "yasp_energy_gain", text="Gain")
+        row = col.row(align=True)
+        row.prop(scn, "yasp_action_cache", text="Reuse Cached Actions")
+        row.operator('yasp.purge_action_cache', text='', icon='TRASH')
         col = layout.column(align=True)
         col.operator('yasp.delete_all_keyframes', icon='KEYFRAME')
         col = layout.column(align=True)
@@ -1,14 +1,15 @@
+import os
 import sys
 import csv
 import json
-from scipy.signal import savgol_filter
-from scipy.ndimage import gaussian_filter1d
 import numpy as np
-plt_unsupported = False
 try:
-    import matplotlib.pyplot as plt
-except:
-    plt_unsupported = True
+    from . import timing
+except ImportError:
+    # run as a script
+    import timing
+# scipy and matplotlib are slow to import. They're imported on first use
+# in the filters and plot_graph() respectively.
 # https://github.com/NumesSanguis/FACSvatar
 # https://github.com/TadasBaltrusaitis/OpenFace/wiki/Action-Units
 # https://www.cs.cmu.edu/~face/facs.htm
@@ -36,7 +37,358 @@ facs_data_items = ['frame', 'timestamp', 'AU01_r', 'AU02_r',
 rigid_data_items = ['frame', 'timestamp', 'p_scale', 'p_rx',
                     'p_ry', 'p_rz', 'p_tx', 'p_ty']
 
+# Distances between landmarks of the 68 point model which describe the
+# shape of the mouth: (name, landmark, landmarks). A feature is the mean
+# distance from the landmark to each of the others.
+distance_feature_points = [
+    ('upper_lip_roll', 51, [62]),
+    ('lower_lip_roll', 57, [66]),
+    ('left_lip_side', 54, [12]),
+    ('right_lip_side', 48, [4]),
+    ('left_lip_up', 54, [13, 14, 15]),
+    ('right_lip_up', 48, [1, 2, 3]),
+    ('left_lip_down', 54, [11]),
+    ('right_lip_down', 48, [5]),
+    ('chin', 57, [8]),
+    ('left_upper_lip_curl', 53, [29]),
+    ('right_upper_lip_curl', 49, [29]),
+    ('left_lower_lip_curl', 55, [9]),
+    ('right_lower_lip_curl', 59, [7]),
+]
+
+# OpenFace's eye model has 28 landmarks per eye, eye_lmk_*_0-27 for the
+# first eye and 28-55 for the second: 0-7 outline the iris, 8-19 the
+# eyelids with the corners at 8 and 14, and 20-27 the pupil.
+EYE_LMK_PER_EYE = 28
+eye_corners = (8, 14)
+eye_lid_pairs = [(9, 19), (10, 18), (11, 17), (12, 16), (13, 15)]
+eye_pupil = list(range(20, 28))
+
+# The tables of a take read from the csv file, and the tables computed from
+# them with the csv tables each is computed from
+csv_table_names = ['animation_data', 'pdm_2d', 'pdm_3d', 'rigid_data',
+                   'non_rigid_data']
+feature_sources = {
+    'distance_features': ['pdm_2d', 'pdm_3d', 'rigid_data'],
+    'eye_features': ['animation_data'],
+    'landmark_sliders': ['pdm_2d'],
+}
+
+# The tables of one face. Multi-face OpenFace output is split into one
+# take per face_id.
+class Take(object):
+    def __init__(self, face_id=0):
+        self.face_id = face_id
+        self.animation_data = {}
+        self.pdm_2d = {}
+        self.pdm_3d = {}
+        self.rigid_data = {}
+        self.non_rigid_data = {}
+        self.eye_lmk_2d = {}
+        self.eye_lmk_3d = {}
+        self.distance_features = {}
+        self.landmark_sliders = {}
+        self.eye_features = {}
+        # how the tables are processed once they're asked for, see
+        # process()
+        self.processing = None
+        self.processed = set()
+        self.computed = set()
+        self.raw = {}
+        self.init_tables()
+
+    def init_tables(self):
+        for e in facs_data_items:
+            self.animation_data[e] = [[], [], []]
+
+        for e in rigid_data_items:
+            self.rigid_data[e] = [[], [], []]
+
+        self.pdm_2d['frame'] = [[], [], []]
+        self.pdm_2d['timestamp'] = [[], [], []]
+        for i in range(0, MAX_PDM_ENTRIES):
+            name = 'x_'+str(i)
+            self.pdm_2d[name] = [[], [], []]
+        for i in range(0, MAX_PDM_ENTRIES):
+            name = 'y_'+str(i)
+            self.pdm_2d[name] = [[], [], []]
+
+        self.pdm_3d['frame'] = [[], [], []]
+        self.pdm_3d['timestamp'] = [[], [], []]
+        for i in range(0, MAX_PDM_ENTRIES):
+            name = 'X_'+str(i)
+            self.pdm_3d[name] = [[], [], []]
+        for i in range(0, MAX_PDM_ENTRIES):
+            name = 'Y_'+str(i)
+            self.pdm_3d[name] = [[], [], []]
+        for i in range(0, MAX_PDM_ENTRIES):
+            name = 'Z_'+str(i)
+            self.pdm_3d[name] = [[], [], []]
+
+        self.non_rigid_data['frame'] = [[], [], []]
+        self.non_rigid_data['timestamp'] = [[], [], []]
+        for i in range(0, MAX_PDM_NON_RIGID_ENTRIES):
+            name = 'p_'+str(i)
+            self.non_rigid_data[name] = [[], [], []]
+
+        self.eye_lmk_2d['frame'] = [[], [], []]
+        self.eye_lmk_2d['timestamp'] = [[], [], []]
+        for i in range(0, MAX_PDM_EYE_LMK):
+            name = 'eye_lmk_x_'+str(i)
+            self.eye_lmk_2d[name] = [[], [], []]
+        for i in range(0, MAX_PDM_EYE_LMK):
+            name = 'eye_lmk_y_'+str(i)
+            self.eye_lmk_2d[name] = [[], [], []]
+
+        for i in range(0, MAX_PDM_EYE_LMK):
+            name = 'eye_lmk_X_'+str(i)
+            self.eye_lmk_3d[name] = [[], [], []]
+        for i in range(0, MAX_PDM_EYE_LMK):
+            name = 'eye_lmk_Y_'+str(i)
+            self.eye_lmk_3d[name] = [[], [], []]
+        for i in range(0, MAX_PDM_EYE_LMK):
+            name = 'eye_lmk_Z_'+str(i)
+            self.eye_lmk_3d[name] = [[], [], []]
+
+        # computed from the landmarks by compute_features()
+        self.distance_features['frame'] = [[], [], []]
+        self.distance_features['timestamp'] = [[], [], []]
+        for name, start, ends in distance_feature_points:
+            self.distance_features[name] = [[], [], []]
+
+        # computed from the eye landmarks by compute_features()
+        for name in ['frame', 'timestamp', 'eye_aperture', 'blink',
+                     'gaze_x', 'gaze_y']:
+            self.eye_features[name] = [[], [], []]
+
+        # the slider channels solved from the landmarks by solve_sliders(),
+        # which depend on the calibration
+        self.landmark_sliders['frame'] = [[], [], []]
+        self.landmark_sliders['timestamp'] = [[], [], []]
+
+    # the tables filled in from the csv file
+    def csv_tables(self):
+        return [getattr(self, name) for name in csv_table_names]
+
+    # the tables derived from the csv tables
+    def feature_tables(self):
+        return [getattr(self, name) for name in feature_sources]
+
+    # Landmark tables which are read in but only used to compute features,
+    # they aren't resampled or smoothed themselves. The 3D eye landmarks
+    # aren't used and aren't read.
+    def landmark_tables(self):
+        return [self.eye_lmk_2d]
+
+    def reset(self):
+        self.processing = None
+        self.processed.clear()
+        self.computed.clear()
+        self.raw.clear()
+        for table in self.csv_tables() + self.feature_tables() + \
+                     [self.eye_lmk_2d, self.eye_lmk_3d]:
+            for k, v in table.items():
+                for i in range(0, 3):
+                    v[i].clear()
+
+    # OpenFace only writes the output groups it was asked for. Tables
+    # whose columns aren't in the row are left empty.
+    def add_row(self, row):
+        for table in self.csv_tables() + self.landmark_tables():
+            if not all(k in row for k in table):
+                continue
+            for k, v in table.items():
+                v[VALUES].append(float(row[k]))
+
+    # the csv and feature tables which have data
+    def loaded_tables(self):
+        return [table for table in self.csv_tables() + self.feature_tables() \
+                if table['frame'][VALUES]]
+
+    # the table with the frames and timestamps of the take. Output with
+    # only the landmarks has no AUs.
+    def time_table_name(self):
+        for name in csv_table_names:
+            if getattr(self, name)['frame'][VALUES]:
+                return name
+        return 'animation_data'
+
+    def time_table(self):
+        return getattr(self, self.time_table_name())
+
+    def __len__(self):
+        return len(self.time_table()['frame'][VALUES])
+
+    # Resampling, smoothing and finding the extrema of a table is put off
+    # until the table is first asked for with get_table(). Most runs only
+    # look at the AUs, the landmark and shape parameter tables are never
+    # touched. The resampling grid is set here, from the timestamps as
+    # they were read.
+    def process(self, window_size, polyorder, fps=0, profile='offline',
+                solver=None, bounded=True):
+        ts = self.time_table()['timestamp'][VALUES]
+        weights = None
+        if fps > 0 and len(ts) >= 2:
+            weights = resample_weights(ts, fps)
+        else:
+            fps = self.get_fps()
+        self.processing = {'window_size': window_size,
+                           'polyorder': polyorder, 'profile': profile,
+                           'fps': fps, 'weights': weights,
+                           'solver': solver, 'bounded': bounded}
+        self.processed.clear()
+        self.computed.clear()
+        self.raw.clear()
+
+    # the named table as it was read, before it was processed
+    def raw_table(self, name):
+        return self.raw.get(name, getattr(self, name))
+
+    # The named table, processed the first time it's asked for. The
+    # feature tables are computed from the tables as they were read.
+    def get_table(self, name):
+        table = getattr(self, name)
+        p = self.processing
+        if p is None or name in self.processed:
+            return table
+        if name in feature_sources:
+            self.compute_feature(name)
+        self.processed.add(name)
+        if not table['frame'][VALUES]:
+            return table
+        # processing puts new lists in the table, the features still to be
+        # computed from it keep the lists as they were read
+        if any(name in sources for f, sources in feature_sources.items() \
+               if f not in self.computed):
+            self.raw[name] = dict((k, [v[VALUES]]) for k, v in table.items())
+        with timing.span('facs.process', table=name):
+            if p['weights']:
+                resample_table(table, p['weights'], p['fps'])
+            smooth_table(table, p['window_size'], p['polyorder'],
+                         p['profile'], p['fps'])
+            find_data_extrema(table)
+        return table
+
+    def compute_feature(self, name):
+        if name in self.computed:
+            return
+        self.computed.add(name)
+        if name == 'distance_features':
+            self.compute_distance_features()
+        elif name == 'eye_features':
+            self.compute_eye_features()
+        elif name == 'landmark_sliders' and self.processing['solver']:
+            self.solve_sliders(self.processing['solver'],
+                               self.processing['bounded'])
+
+    # Fill in the distance features from the 2D landmarks, scaled by the
+    # rigid scale of the face when it's there, or from the 3D landmarks.
+    # They're computed on the raw rows, so resampling and smoothing treat
+    # them like any other channel.
+    def compute_distance_features(self):
+        pdm_2d = self.raw_table('pdm_2d')
+        pdm_3d = self.raw_table('pdm_3d')
+        if pdm_2d['frame'][VALUES]:
+            source = pdm_2d
+            points = landmark_array(source, ('x_', 'y_'))
+            scale = self.raw_table('rigid_data')['p_scale'][VALUES]
+            if len(scale) != len(points):
+                scale = None
+        elif pdm_3d['frame'][VALUES]:
+            source = pdm_3d
+            points = landmark_array(source, ('X_', 'Y_', 'Z_'))
+            scale = None
+        else:
+            return
+        dist = landmark_distances(points, distance_feature_points, scale)
+        table = self.distance_features
+        table['frame'][VALUES] = list(source['frame'][VALUES])
+        table['timestamp'][VALUES] = list(source['timestamp'][VALUES])
+        for (name, start, ends), row in zip(distance_feature_points,
+                                            dist.T.tolist()):
+            table[name][VALUES] = row
+
+    # Fill in eye_features: the aperture of the eyes, the blink it makes
+    # on the 0-5 scale of AU45, and the gaze angles from the position of
+    # the pupils. While the eyes are closed the pupils can't be seen, the
+    # gaze there is interpolated from the frames around the blink. If
+    # OpenFace's gaze angles are there, the gaze is fitted to them so it
+    # has the same range.
+    def compute_eye_features(self):
+        self.fill_eye_features(self.eye_features)
+
+    # The eye features of the rows read so far in a new table, leaving the
+    # take alone. For keying a take while OpenFace is still writing it.
+    def eye_feature_table(self):
+        table = dict((k, [[], [], []]) for k in self.eye_features)
+        self.fill_eye_features(table)
+        return table
+
+    def fill_eye_features(self, table):
+        source = self.eye_lmk_2d
+        if not source['frame'][VALUES]:
+            return
+        points = landmark_array(source, ('eye_lmk_x_', 'eye_lmk_y_'),
+                                MAX_PDM_EYE_LMK)
+        aperture, offset = eye_shape(points)
+        aperture = aperture.mean(axis=1)
+        blink = blink_level(aperture)
+        gaze = np.arcsin(np.clip(2 * offset.mean(axis=1), -1, 1))
+        open_frames = np.nonzero(blink < 0.5)[0]
+        if len(open_frames) < 2:
+            return
+        frames = np.arange(len(gaze))
+        animation_data = self.raw_table('animation_data')
+        for axis, name in enumerate(['gaze_angle_x', 'gaze_angle_y']):
+            g = np.interp(frames, open_frames, gaze[open_frames, axis])
+            ref = animation_data[name][VALUES]
+            if len(ref) == len(g):
+                ref = np.asarray(ref, dtype=float)
+                slope, intercept = np.polyfit(g[open_frames],
+                                              ref[open_frames], 1)
+                g = g * slope + intercept
+            else:
+                g = g - np.median(g)
+            gaze[:, axis] = g
+
+        table['frame'][VALUES] = list(source['frame'][VALUES])
+        table['timestamp'][VALUES] = list(source['timestamp'][VALUES])
+        table['eye_aperture'][VALUES] = aperture.tolist()
+        table['blink'][VALUES] = (blink * 5.0).tolist()
+        table['gaze_x'][VALUES] = gaze[:, 0].tolist()
+        table['gaze_y'][VALUES] = gaze[:, 1].tolist()
+
+    # Fill in landmark_sliders with the weights solver finds for the 2D
+    # landmarks of every frame. The channels are named like the AU
+    # columns, AU12_r and so on, with weights scaled to the 0-5 range of
+    # the AU intensities, so they're animated the same way.
+    def solve_sliders(self, solver, bounded=True):
+        table = self.landmark_sliders
+        for k in list(table.keys()):
+            if k != 'frame' and k != 'timestamp':
+                del table[k]
+        pdm_2d = self.raw_table('pdm_2d')
+        if not pdm_2d['frame'][VALUES]:
+            return
+        points = normalize_landmarks(landmark_array(pdm_2d, ('x_', 'y_')))
+        weights = solver.solve(points, bounded) * 5.0
+        table['frame'][VALUES] = list(pdm_2d['frame'][VALUES])
+        table['timestamp'][VALUES] = list(pdm_2d['timestamp'][VALUES])
+        for name, row in zip(solver.names, weights.T.tolist()):
+            table[name + '_r'] = [row, [], []]
+
+    # frame rate of the take, from its timestamps
+    def get_fps(self):
+        return get_table_fps(self.time_table())
+
+# takes by face_id. The module level tables below are the ones of the
+# current take, which is the face with the lowest id. They're only
+# processed once asked for through the get_*() functions below.
+takes = {}
+take = None
 animation_data = {}
+distance_features = {}
+eye_features = {}
 pdm_2d = {}
 pdm_3d = {}
 rigid_data = {}
@@ -44,7 +396,8 @@ non_rigid_data = {}
 eye_lmk_2d = {}
 eye_lmk_3d = {}
 
-def init_database():
+def set_current_take(t):
+    global take
     global animation_data
     global pdm_2d
     global pdm_3d
@@ -52,111 +405,423 @@ def init_database():
     global non_rigid_data
     global eye_lmk_2d
     global eye_lmk_3d
+    global distance_features
+    global eye_features
+
+    take = t
+    animation_data = t.animation_data
+    pdm_2d = t.pdm_2d
+    pdm_3d = t.pdm_3d
+    rigid_data = t.rigid_data
+    non_rigid_data = t.non_rigid_data
+    eye_lmk_2d = t.eye_lmk_2d
+    eye_lmk_3d = t.eye_lmk_3d
+    distance_features = t.distance_features
+    eye_features = t.eye_features
 
-    for e in facs_data_items:
-        animation_data[e] = [[], [], []]
-
-    for e in rigid_data_items:
-        rigid_data[e] = [[], [], []]
-
-    pdm_2d['frame'] = [[], [], []]
-    pdm_2d['timestamp'] = [[], [], []]
-    for i in range(0, MAX_PDM_ENTRIES):
-        name = 'x_'+str(i)
-        pdm_2d[name] = [[], [], []]
-    for i in range(0, MAX_PDM_ENTRIES):
-        name = 'y_'+str(i)
-        pdm_2d[name] = [[], [], []]
-
-    pdm_3d['frame'] = [[], [], []]
-    pdm_3d['timestamp'] = [[], [], []]
-    for i in range(0, MAX_PDM_ENTRIES):
-        name = 'X_'+str(i)
-        pdm_3d[name] = [[], [], []]
-    for i in range(0, MAX_PDM_ENTRIES):
-        name = 'Y_'+str(i)
-        pdm_3d[name] = [[], [], []]
-    for i in range(0, MAX_PDM_ENTRIES):
-        name = 'Z_'+str(i)
-        pdm_3d[name] = [[], [], []]
-
-    non_rigid_data['frame'] = [[], [], []]
-    non_rigid_data['timestamp'] = [[], [], []]
-    for i in range(0, MAX_PDM_NON_RIGID_ENTRIES):
-        name = 'p_'+str(i)
-        non_rigid_data[name] = [[], [], []]
-
-    for i in range(0, MAX_PDM_EYE_LMK):
-        name = 'eye_lmk_x_'+str(i)
-        eye_lmk_2d[name] = [[], [], []]
-    for i in range(0, MAX_PDM_EYE_LMK):
-        name = 'eye_lmk_y_'+str(i)
-        eye_lmk_2d[name] = [[], [], []]
-
-    for i in range(0, MAX_PDM_EYE_LMK):
-        name = 'eye_lmk_X_'+str(i)
-        eye_lmk_3d[name] = [[], [], []]
-    for i in range(0, MAX_PDM_EYE_LMK):
-        name = 'eye_lmk_Y_'+str(i)
-        eye_lmk_3d[name] = [[], [], []]
-    for i in range(0, MAX_PDM_EYE_LMK):
-        name = 'eye_lmk_Z_'+str(i)
-        eye_lmk_3d[name] = [[], [], []]
-
-def smooth_array(ar, window_size, polyorder):
-    # use savgol_filter() to do first path on smooth
-    # https://scipy.github.io/devdocs/generated/scipy.signal.savgol_filter.html
-    result = savgol_filter(ar, window_size, polyorder)
-    # to avoid high frequency/small-amplitude oscillations to help in
-    # finding peaks and troughs run a gaussian_filter.
-    # I'm not a math wiz so I got this from here:
-    # https://stackoverflow.com/questions/47962044/how-to-get-the-correct-peaks-and-troughs-from-an-1d-array
-    result = gaussian_filter1d(result, window_size).tolist()
-
+def init_database():
+    takes.clear()
+    takes[0] = Take(0)
+    set_current_take(takes[0])
+
+def get_takes():
+    return [takes[k] for k in sorted(takes.keys())]
+
+def get_take(face_id):
+    return takes.get(face_id)
+
+# smooth a single channel with the offline filters
+def smooth_values(ar, window_size, polyorder):
+    block = np.array([ar], dtype=float)
+    return smooth_rows(block, window_size, polyorder)[0].tolist()
+
+# Gaps between rows longer than this, in seconds, aren't interpolated
+# across. The face was lost there, the last value holds until it's back.
+max_resample_gap = 0.5
+
+# The samples either side of every point of a fps grid and their
+# interpolation weights, and the grid's frame numbers. The grid runs from
+# the first to the last timestamp, frame n is at time n / fps.
+def resample_weights(timestamps, fps, max_gap=max_resample_gap):
+    ts = np.asarray(timestamps, dtype=float)
+    first = int(np.ceil(ts[0] * fps - 1e-6))
+    last = int(np.floor(ts[-1] * fps + 1e-6))
+    frames = np.arange(first, max(first, last) + 1)
+    grid = frames / fps
+    hi = np.clip(np.searchsorted(ts, grid, side='right'), 1, len(ts) - 1)
+    lo = hi - 1
+    span = ts[hi] - ts[lo]
+    w = (grid - ts[lo]) / np.where(span > 0, span, 1)
+    w = np.clip(np.where((span > 0) & (span <= max_gap), w, 0), 0, 1)
+    # the last sample falls on the grid
+    w[grid >= ts[-1]] = 1
+    return lo, hi, w, frames
+
+# put the channels of a table on the grid of resample_weights()
+def resample_table(table, weights, fps):
+    lo, hi, w, frames = weights
+    names = [k for k in table.keys() if k != 'frame' and k != 'timestamp']
+    block = np.array([table[k][VALUES] for k in names], dtype=float)
+    block = block[:, lo] * (1 - w) + block[:, hi] * w
+    for k, row in zip(names, block.tolist()):
+        table[k][VALUES] = row
+    # OpenFace counts frames from 1
+    if 'frame' in table:
+        table['frame'][VALUES] = (frames + 1).tolist()
+    if 'timestamp' in table:
+        table['timestamp'][VALUES] = (frames / fps).tolist()
+
+# The landmarks of a table as a frames x points x dims array. prefixes are
+# the column prefixes of the coordinates.
+def landmark_array(table, prefixes, count=MAX_PDM_ENTRIES):
+    block = np.array([[table[p+str(i)][VALUES] for i in range(count)] \
+                      for p in prefixes], dtype=float)
+    return block.transpose(2, 1, 0)
+
+# The distance features of every frame of a frames x points x dims array
+# in one go. Returns frames x features. The distances are divided by
+# scale, one value per frame, if it's given.
+def landmark_distances(points, features, scale=None):
+    starts = []
+    ends = []
+    owner = []
+    for i, (name, start, others) in enumerate(features):
+        starts.extend([start] * len(others))
+        ends.extend(others)
+        owner.extend([i] * len(others))
+    dist = np.linalg.norm(points[:, starts] - points[:, ends], axis=-1)
+    # averages the distances of each feature
+    mean = np.zeros((len(starts), len(features)))
+    mean[np.arange(len(starts)), owner] = 1.0
+    dist = dist @ (mean / mean.sum(axis=0))
+    if scale is not None:
+        dist = dist / np.maximum(np.abs(np.asarray(scale, dtype=float)),
+                                 1e-9)[:, None]
+    return dist
+
+# The aperture of both eyes and the offset of their pupils for every
+# frame of a frames x 56 x 2 array of eye landmarks. The aperture is the
+# mean distance between the eyelids over the width of the eye. The offset
+# is the position of the pupil relative to the middle of the eye corners,
+# along and across the line through both eyes, over the width of the eye.
+# Returns frames x 2 eyes and frames x 2 eyes x 2.
+def eye_shape(points):
+    eyes = points.reshape(len(points), 2, EYE_LMK_PER_EYE, 2)
+    first = eyes[:, :, eye_corners[0]]
+    second = eyes[:, :, eye_corners[1]]
+    width = np.maximum(np.linalg.norm(second - first, axis=-1), 1e-9)
+    upper = eyes[:, :, [u for u, l in eye_lid_pairs]]
+    lower = eyes[:, :, [l for u, l in eye_lid_pairs]]
+    aperture = np.linalg.norm(upper - lower, axis=-1).mean(axis=2) / width
+
+    center = (first + second) / 2
+    axis = center[:, 1] - center[:, 0]
+    axis = axis / np.maximum(np.linalg.norm(axis, axis=-1), 1e-9)[:, None]
+    across = np.stack((-axis[:, 1], axis[:, 0]), axis=-1)
+    d = eyes[:, :, eye_pupil].mean(axis=2) - center
+    offset = np.stack(((d * axis[:, None]).sum(axis=-1),
+                       (d * across[:, None]).sum(axis=-1)), axis=-1)
+    return aperture, offset / width[..., None]
+
+# How closed the eyes are, 0 open to 1 closed, from their aperture. Open
+# is the aperture the eyes have most of the take, and they count as
+# closed at a fifth of it.
+def blink_level(aperture):
+    wide = max(np.percentile(aperture, 90), 1e-9)
+    return np.clip((wide - aperture) / (0.8 * wide), 0.0, 1.0)
+
+# Take out the position, the in-plane rotation and the size of the face
+# from a frames x points x 2 array of the 68 landmarks, so only their
+# shape is left. The rotation is the one of the line through the outer
+# eye corners, the size the RMS distance of the points to their centroid.
+def normalize_landmarks(points):
+    points = points - points.mean(axis=1)[:, None, :]
+    eyes = points[:, 45] - points[:, 36]
+    angle = np.arctan2(eyes[:, 1], eyes[:, 0])
+    c = np.cos(-angle)[:, None]
+    s = np.sin(-angle)[:, None]
+    x = points[:, :, 0]
+    y = points[:, :, 1]
+    points = np.stack((x * c - y * s, x * s + y * c), axis=-1)
+    size = np.sqrt((points ** 2).sum(axis=2).mean(axis=1))
+    return points / np.maximum(size, 1e-9)[:, None, None]
+
+# Solves for the slider weights which best explain the shape of the
+# landmarks as the neutral shape plus a weighted sum of the offsets of the
+# extreme shape of every slider:
+#   min |B w - (x - neutral)|^2 + damping |w|^2
+# The normal equations only depend on the calibration, so they're
+# factored once and every frame of a take is solved with one product.
+# Bounded solves keep the weights in [0, 1] by projected gradient steps
+# over all the frames at once, starting from the unbounded solution.
+class LandmarkSolver(object):
+    def __init__(self, neutral, extremes, names, damping=1e-3):
+        self.names = names
+        self.neutral = neutral.reshape(-1)
+        self.basis = (extremes.reshape(len(names), -1) - self.neutral).T
+        gram = self.basis.T @ self.basis
+        scale = max(np.trace(gram) / len(names), 1e-12)
+        self.gram = gram + damping * scale * np.eye(len(names))
+        from scipy.linalg import cho_factor, cho_solve
+        self.proj = cho_solve(cho_factor(self.gram), self.basis.T)
+        self.step = 1.0 / np.linalg.eigvalsh(self.gram).max()
+
+    # frames x sliders weights of a frames x points x 2 array of
+    # normalized landmarks
+    def solve(self, points, bounded=True, iterations=50):
+        d = points.reshape(len(points), -1) - self.neutral
+        w = d @ self.proj.T
+        if not bounded:
+            return w
+        b = d @ self.basis
+        w = np.clip(w, 0.0, 1.0)
+        for i in range(iterations):
+            w = np.clip(w - self.step * (w @ self.gram - b), 0.0, 1.0)
+        return w
+
+# The frame numbers and the frames x 68 x 2 landmarks of the confident
+# rows of the first face of an OpenFace csv
+def load_landmark_csv(csv_name):
+    names = ['x_'+str(i) for i in range(MAX_PDM_ENTRIES)] + \
+            ['y_'+str(i) for i in range(MAX_PDM_ENTRIES)]
+    frames = []
+    rows = []
+    with open(csv_name, 'r') as fcsv:
+        reader = csv.DictReader(fcsv, delimiter=',')
+        for row in reader:
+            row = dict((k.strip(), v.strip()) for k, v in row.items() if v)
+            if float(row['confidence']) < 0.7 or \
+               int(float(row.get('face_id', 0))) != 0:
+                continue
+            if not all(k in row for k in names):
+                raise ValueError('%s has no 2D landmarks' % csv_name)
+            frames.append(int(float(row['frame'])))
+            rows.append([float(row[k]) for k in names])
+    block = np.array(rows, dtype=float).reshape(-1, 2, MAX_PDM_ENTRIES)
+    return np.array(frames), block.transpose(0, 2, 1)
+
+# Build a LandmarkSolver from a calibration file:
+#   {"csv": "calibration.csv",
+#    "neutral": [1, 20],
+#    "sliders": {"AU12": [100, 110], "AU26": [160, 175]}}
+# The csv is OpenFace output of the actor holding a neutral face and then
+# the extreme of every slider. Each pose is the mean of the normalized
+# landmarks over its range of frames. A relative csv path is relative to
+# the calibration file.
+def load_calibration(path, damping=1e-3):
+    with open(path, 'r') as f:
+        calibration = json.load(f)
+    csv_name = os.path.join(os.path.dirname(os.path.realpath(path)),
+                            calibration['csv'])
+    frames, points = load_landmark_csv(csv_name)
+    points = normalize_landmarks(points)
+
+    def pose(name, frame_range):
+        first, last = frame_range
+        mask = (frames >= first) & (frames <= last)
+        if not mask.any():
+            raise ValueError('no confident frames in %d-%d for %s' %
+                             (first, last, name))
+        return points[mask].mean(axis=0)
+
+    names = sorted(calibration['sliders'].keys())
+    if not names:
+        raise ValueError('%s calibrates no sliders' % path)
+    neutral = pose('neutral', calibration['neutral'])
+    extremes = np.array([pose(n, calibration['sliders'][n]) for n in names])
+    return LandmarkSolver(neutral, extremes, names, damping)
+
+def get_table_fps(table):
+    ts = table['timestamp'][VALUES]
+    if len(ts) < 2 or ts[-1] <= ts[0]:
+        return 30.0
+    return (len(ts) - 1) / (ts[-1] - ts[0])
+
+def smooth_table(table, window_size, polyorder, profile, fps):
+    groups = {}
+    for k in table.keys():
+        if k == 'frame' or k == 'timestamp':
+            continue
+        groups.setdefault(channel_group(k), []).append(k)
+    for group, names in groups.items():
+        smooth_columns(table, names, window_size, polyorder,
+                       get_profile_filters(profile, group), fps)
+
+# Resample, smooth and find the extrema of a copy of a table, leaving the
+# table itself alone. Used on the rows read so far of a running take.
+def process_table(table, window_size, polyorder, fps=0, profile='offline'):
+    result = dict((k, [list(v[VALUES]), [], []]) for k, v in table.items())
+    if len(result['timestamp'][VALUES]) < 2:
+        return result
+    if fps > 0:
+        resample_table(result, resample_weights(result['timestamp'][VALUES],
+                                                fps), fps)
+    smooth_table(result, window_size, polyorder, profile,
+                 get_table_fps(result))
+    find_data_extrema(result)
+    return result
+
+# The number of frames at the end of a growing take whose smoothed values
+# still depend on frames which haven't arrived yet
+def filter_margin(profile, window_size, polyorder):
+    margin = 0
+    for stages in filter_profiles[profile].values():
+        m = 0
+        for name, params in stages:
+            kwargs = filters[name][1](window_size, polyorder, 30.0)
+            kwargs.update(params)
+            if name == 'savgol':
+                m = m + kwargs['window_size'] // 2
+            elif name == 'gaussian':
+                m = m + int(4.0 * kwargs['sigma'] + 0.5)
+        margin = max(margin, m)
+    # one more for the extrema and one for resampling
+    return margin + 2
+
+# smooth_values() over every row of a channels x frames array at once
+def smooth_rows(block, window_size, polyorder):
+    return apply_filters(block, filter_profiles['offline']['default'],
+                         window_size, polyorder, 30.0)
+
+def find_extrema(result):
     #https://stackoverflow.com/questions/52125211/find-peaks-and-bottoms-of-graph-and-label-them
     minimas = (np.diff(np.sign(np.diff(result))) > 0).nonzero()[0] + 1
     maximas = (np.diff(np.sign(np.diff(result))) < 0).nonzero()[0] + 1
 
-    return result, maximas.tolist(), minimas.tolist()
+    return maximas.tolist(), minimas.tolist()
 
-def reset_database():
-    global animation_data
-    global pdm_2d
-    global rigid_data
-    global non_rigid_data
-    global eye_lmk_2d
-    global eye_lmk_3d
-
-    for k, v in animation_data.items():
-        for i in range(0, 3):
-            v[i].clear()
-
-    for k, v in pdm_2d.items():
-        for i in range(0, 3):
-            v[i].clear()
-
-    for k, v in pdm_3d.items():
-        for i in range(0, 3):
-            v[i].clear()
+def smooth_array(ar, window_size, polyorder):
+    result = smooth_values(ar, window_size, polyorder)
+    maximas, minimas = find_extrema(result)
+    return result, maximas, minimas
 
-    for k, v in rigid_data.items():
-        for i in range(0, 3):
-            v[i].clear()
+# Filter bank. Every filter works on a channels x frames array along the
+# frames axis. Parameters a profile leaves out come from the smoothing
+# window size and polyorder, and the frame rate of the take.
 
-    for k, v in non_rigid_data.items():
-        for i in range(0, 3):
-            v[i].clear()
+def savgol(block, window_size, polyorder):
+    from scipy.signal import savgol_filter
 
-    for k, v in eye_lmk_2d.items():
-        for i in range(0, 3):
-            v[i].clear()
+    # use savgol_filter() to do first path on smooth
+    # https://scipy.github.io/devdocs/generated/scipy.signal.savgol_filter.html
+    # short takes (e.g. a spurious second face picked up for a few
+    # frames) get the largest odd window that still fits, or are left
+    # as is when not even that is larger than the polynomial order
+    n = block.shape[1]
+    if window_size > n:
+        window_size = n if n % 2 else n - 1
+    if window_size <= polyorder:
+        return block
+    return savgol_filter(block, window_size, polyorder, axis=1)
+
+def gaussian(block, sigma):
+    from scipy.ndimage import gaussian_filter1d
+
+    return gaussian_filter1d(block, sigma, axis=1)
+
+# The One Euro filter, an adaptive causal low-pass: the cutoff rises with
+# the speed of the signal, so slow motion is smoothed heavily and fast
+# motion lags little.
+# https://gery.casiez.net/1euro/
+def one_euro(block, fps, min_cutoff=1.0, beta=0.0, d_cutoff=1.0):
+    def alpha(cutoff):
+        tau = 1.0 / (2 * np.pi * cutoff)
+        return 1.0 / (1.0 + tau * fps)
+
+    out = np.empty_like(block)
+    if not block.shape[1]:
+        return out
+    x_hat = block[:, 0]
+    dx_hat = np.zeros(block.shape[0])
+    out[:, 0] = x_hat
+    a_d = alpha(d_cutoff)
+    for i in range(1, block.shape[1]):
+        x = block[:, i]
+        dx_hat = a_d * (x - x_hat) * fps + (1 - a_d) * dx_hat
+        a = alpha(min_cutoff + beta * np.abs(dx_hat))
+        x_hat = a * x + (1 - a) * x_hat
+        out[:, i] = x_hat
+    return out
+
+# causal Butterworth low-pass, cutoff in Hz. It starts in the steady state
+# of the first frame instead of ramping up from 0
+def iir_lowpass(block, fps, cutoff=4.0, order=2):
+    from scipy.signal import butter, lfilter, lfilter_zi
+
+    cutoff = min(cutoff, 0.45 * fps)
+    b, a = butter(order, cutoff, fs=fps)
+    zi = lfilter_zi(b, a)[np.newaxis, :] * block[:, :1]
+    return lfilter(b, a, block, axis=1, zi=zi)[0]
+
+filters = {
+    'savgol': (savgol, lambda ws, po, fps: {'window_size': ws,
+                                            'polyorder': po}),
+    'gaussian': (gaussian, lambda ws, po, fps: {'sigma': ws}),
+    'one_euro': (one_euro, lambda ws, po, fps: {'fps': fps}),
+    'iir': (iir_lowpass, lambda ws, po, fps: {'fps': fps}),
+}
+
+# Filters run in order on each group of channels: pose, gaze, au and
+# default for everything else. A profile without an entry for a group
+# uses its default entry.
+filter_profiles = {
+    # Savitzky-Golay, then a gaussian to get rid of the small high
+    # frequency oscillations which make finding the peaks and troughs
+    # hard. The head pose is always smoothed heavily.
+    # https://stackoverflow.com/questions/47962044/how-to-get-the-correct-peaks-and-troughs-from-an-1d-array
+    'offline': {
+        'pose': [('savgol', {'window_size': 11, 'polyorder': 5}),
+                 ('gaussian', {'sigma': 11})],
+        'default': [('savgol', {}), ('gaussian', {})],
+    },
+    # causal, only looks at past frames
+    'live': {
+        'pose': [('one_euro', {'min_cutoff': 0.5, 'beta': 0.05})],
+        'gaze': [('one_euro', {'min_cutoff': 1.0, 'beta': 0.5})],
+        'default': [('one_euro', {'min_cutoff': 1.5, 'beta': 0.3})],
+    },
+    'lowpass': {
+        'pose': [('iir', {'cutoff': 2.0})],
+        'default': [('iir', {'cutoff': 5.0})],
+    },
+}
+
+def channel_group(name):
+    if name.startswith('pose_'):
+        return 'pose'
+    if name.startswith('gaze_'):
+        return 'gaze'
+    if name.startswith('AU'):
+        return 'au'
+    return 'default'
+
+def get_profile_filters(profile, group):
+    p = filter_profiles[profile]
+    return p.get(group, p['default'])
+
+# run a list of (filter name, parameters) over a channels x frames array
+def apply_filters(block, stages, window_size, polyorder, fps):
+    for name, params in stages:
+        fn, defaults = filters[name]
+        kwargs = defaults(window_size, polyorder, fps)
+        kwargs.update(params)
+        block = fn(block, **kwargs)
+    return block
 
-    for k, v in eye_lmk_3d.items():
-        for i in range(0, 3):
-            v[i].clear()
+def reset_database():
+    # drop the faces of the previous file, keep an empty face 0
+    for face_id in list(takes.keys()):
+        if face_id != 0:
+            del takes[face_id]
+    if 0 not in takes:
+        takes[0] = Take(0)
+    takes[0].reset()
+    set_current_take(takes[0])
 
 def plot_graph(animation_data, name, show=True, pdf_path=''):
-    if plt_unsupported:
+    try:
+        import matplotlib.pyplot as plt
+    except:
         return
     # plot the first entry
     plt.plot(animation_data['frame'][0], animation_data[name][0], label=name)
@@ -173,25 +838,22 @@ def plot_graph(animation_data, name, show=True, pdf_path=''):
         f = plt.figure()
         f.savefig(pdf_path, bbox_inches='tight')
 
+# The tables of the current take. The tables are processed the first time
+# they're asked for, see Take.process()
 def get_facs_data():
-    global animation_data
-    return animation_data
+    return take.get_table('animation_data')
 
 def get_pdm2d_data():
-    global pdm_2d
-    return pdm_2d
+    return take.get_table('pdm_2d')
 
 def get_pdm3d_data():
-    global pdm_3d
-    return pdm_3d
+    return take.get_table('pdm_3d')
 
 def get_rigid_data():
-    global rigid_data
-    return rigid_data
+    return take.get_table('rigid_data')
 
 def get_non_rigid_data():
-    global non_rigid_data
-    return non_rigid_data
+    return take.get_table('non_rigid_data')
 
 def get_eye_lmk_2d():
     global eye_lmk_2d
@@ -201,67 +863,92 @@ def get_eye_lmk_3d():
     global eye_lmk_3d
     return eye_lmk_3d
 
+def get_distance_features():
+    return take.get_table('distance_features')
+
+def get_eye_features():
+    return take.get_table('eye_features')
+
+def get_landmark_sliders(face_id=0):
+    t = takes.get(face_id)
+    if not t:
+        return {}
+    return t.get_table('landmark_sliders')
+
 def smooth_data(d, window_size, polyorder):
     # smooth all the data
+    names = [k for k in d.keys() if k != 'frame' and k != 'timestamp']
+    smooth_columns(d, names, window_size, polyorder)
+
+# smooth the named channels of a table as one channels x frames array,
+# with the default filters if none are given
+def smooth_columns(d, names, window_size, polyorder, stages=None, fps=30.0):
+    if not names:
+        return
+    if stages is None:
+        stages = filter_profiles['offline']['default']
+    block = np.array([d[k][VALUES] for k in names], dtype=float)
+    block = apply_filters(block, stages, window_size, polyorder, fps)
+    for k, row in zip(names, block.tolist()):
+        d[k][VALUES] = row
+
+def find_data_extrema(d):
     for k, v in d.items():
         if k == 'frame' or k == 'timestamp':
             continue
-        d[k][VALUES], \
-        d[k][MAXIMAS], \
-        d[k][MINIMAS] = \
-            smooth_array(v[0], window_size, polyorder)
-
-def process_openface_csv(csv_name, window_size = 5, polyorder = 2):
-    global animation_data
-    global pdm_2d
-    global rigid_data
-    global non_rigid_data
+        d[k][MAXIMAS], d[k][MINIMAS] = find_extrema(v[VALUES])
 
+# Read the raw values of every row we trust into the data base. Rows are
+# split into takes by face_id, multi-face output interleaves the faces.
+@timing.span('facs.parse')
+def load_openface_csv(csv_name):
     with open(csv_name, 'r') as fcsv:
         reader = csv.DictReader(fcsv, delimiter=',')
         reader = (dict((k.strip(), v.strip()) for k, v in row.items() if v) \
                   for row in reader)
-        for row in reader:
-            # ignore entries with low confidence
-            if float(row['confidence']) < 0.7:
-                continue
-            # build my local data base
-            for k, v in animation_data.items():
-                v[VALUES].append(float(row[k]))
-            for k, v in pdm_2d.items():
-                v[VALUES].append(float(row[k]))
-            for k, v in pdm_3d.items():
-                v[VALUES].append(float(row[k]))
-            for k, v in rigid_data.items():
-                v[VALUES].append(float(row[k]))
-            for k, v in non_rigid_data.items():
-                v[VALUES].append(float(row[k]))
-
-        # smooth all the data
-        for k, v in animation_data.items():
-            if k == 'frame' or k == 'timestamp':
-                continue
-            if 'pose_' in k:
-                animation_data[k][VALUES], \
-                animation_data[k][MAXIMAS], \
-                animation_data[k][MINIMAS] = \
-                    smooth_array(v[VALUES], 11, 5)
-            else:
-                animation_data[k][VALUES], \
-                animation_data[k][MAXIMAS], \
-                animation_data[k][MINIMAS] = \
-                    smooth_array(v[VALUES], window_size, polyorder)
-
-        # smooth all the data
-        smooth_data(pdm_2d, window_size, polyorder)
-        smooth_data(pdm_3d, window_size, polyorder)
-        smooth_data(rigid_data, window_size, polyorder)
-        smooth_data(non_rigid_data, window_size, polyorder)
-
-        # export data to JSON
-        js = json.dumps(animation_data, indent=4)
-
-    return js
+        rows = add_rows(reader)
+    timing.count(rows=rows, faces=len([t for t in takes.values() if len(t)]))
+
+# Add OpenFace rows to the takes of their faces. Returns the number of
+# rows kept.
+def add_rows(rows):
+    count = 0
+    for row in rows:
+        # ignore entries with low confidence
+        if float(row['confidence']) < 0.7:
+            continue
+        face_id = int(float(row.get('face_id', 0)))
+        t = takes.get(face_id)
+        if not t:
+            t = Take(face_id)
+            takes[face_id] = t
+        t.add_row(row)
+        count = count + 1
+
+    # the lowest face id with data is the current take
+    for t in get_takes():
+        if len(t):
+            set_current_take(t)
+            break
+    return count
+
+@timing.span('facs.export')
+def export_database():
+    return json.dumps(get_facs_data(), indent=4)
+
+# fps, if given, is the frame rate the data is resampled to before
+# smoothing. profile is one of filter_profiles
+def process_database(window_size = 5, polyorder = 2, fps = 0,
+                     profile = 'offline', solver = None, bounded = True):
+    for t in get_takes():
+        t.process(window_size, polyorder, fps, profile, solver, bounded)
+
+def process_openface_csv(csv_name, window_size = 5, polyorder = 2, fps = 0,
+                         profile = 'offline', solver = None, bounded = True):
+    load_openface_csv(csv_name)
+    process_database(window_size, polyorder, fps, profile, solver, bounded)
+    # export data to JSON
+    return export_database()
 
 if __name__ == '__main__':
     if len(sys.argv) < 2:
@@ -0,0 +1,290 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+
+# Unindexed files and directories under the root modified in the last
+# day may be the output of a run still going, or another process' index
+# being saved. purge() leaves them alone.
+in_progress_age = 24 * 3600
+# how long get_entries() reuses the stale state of an entry
+stale_check_interval = 10.0
+# A lock on the index older than this, in seconds, was left by a process
+# which died while saving it
+stale_lock_age = 30.0
+
+# The directory of the add-on's cache called name. It's kept in
+# Blender's user scripts directory rather than in the add-on, which may
+# not be writable and is replaced when the add-on is updated. The temp
+# directory is used if that can't be written to either.
+def get_cache_dir(name):
+    import bpy
+    import tempfile
+
+    path = os.path.join('yasp_cache', name)
+    try:
+        root = bpy.utils.user_resource('SCRIPTS', path=path, create=True)
+    except (OSError, ValueError, TypeError):
+        root = ''
+    if root and os.access(root, os.W_OK):
+        return root
+    root = os.path.join(tempfile.gettempdir(), path)
+    if not os.path.exists(root):
+        os.makedirs(root)
+    return root
+
+# sha1 of a file's content, read in blocks
+def hash_file(path, block=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(block)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+# A cache of results made from files. Every entry lives in <root>/<key>,
+# a file or a directory. index.json records the entries, the content
+# hashes of the files each was made from, and the hashes of every file
+# seen keyed by path, size and mtime so unchanged files aren't hashed
+# again.
+#
+# Several processes may share a cache, Blender sessions and the
+# shot_pipeline workers. The index is read again when it changes on disk,
+# and save() merges the entries and hashes this process changed into the
+# index on disk under a lock, rather than writing its own copy over it.
+class FileCache(object):
+    def __init__(self, root):
+        self.root = root
+        self.index_path = os.path.join(root, 'index.json')
+        self.lock_path = self.index_path + '.lock'
+        self.index = None
+        self.index_mtime = None
+        # entries added, entries removed and file hashes added since the
+        # last save()
+        self.changed = set()
+        self.removed = set()
+        self.changed_hashes = set()
+        self.clear_hashes = False
+        # key -> (time checked, stale)
+        self.stale = {}
+
+    def get_index_mtime(self):
+        try:
+            return os.stat(self.index_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def read_index(self):
+        index = {'entries': {}, 'hashes': {}}
+        if os.path.isfile(self.index_path):
+            try:
+                with open(self.index_path, 'r') as f:
+                    index = json.load(f)
+            except (ValueError, OSError):
+                pass
+        return index
+
+    # The index, read again if another process saved it since. Changes
+    # which aren't saved yet are kept.
+    def load(self):
+        pending = self.changed or self.removed or self.changed_hashes or \
+                  self.clear_hashes
+        if self.index is not None and \
+           (pending or self.get_index_mtime() == self.index_mtime):
+            return self.index
+        self.index_mtime = self.get_index_mtime()
+        self.index = self.read_index()
+        self.stale.clear()
+        return self.index
+
+    def lock(self):
+        while True:
+            try:
+                fd = os.open(self.lock_path,
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.close(fd)
+                return
+            except FileExistsError:
+                pass
+            try:
+                if time.time() - os.path.getmtime(self.lock_path) > \
+                   stale_lock_age:
+                    os.remove(self.lock_path)
+                    continue
+            except OSError:
+                continue
+            time.sleep(0.01)
+
+    def unlock(self):
+        try:
+            os.remove(self.lock_path)
+        except OSError:
+            pass
+
+    def save(self):
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        self.lock()
+        try:
+            index = self.read_index()
+            entries = index.setdefault('entries', {})
+            hashes = index.setdefault('hashes', {})
+            for key in self.removed:
+                entries.pop(key, None)
+            for key in self.changed:
+                entries[key] = self.index['entries'][key]
+            if self.clear_hashes:
+                hashes.clear()
+            for path in self.changed_hashes:
+                if path in self.index['hashes']:
+                    hashes[path] = self.index['hashes'][path]
+            tmp = '%s.%d.tmp' % (self.index_path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(index, f, indent=4)
+            os.replace(tmp, self.index_path)
+            self.index = index
+            self.index_mtime = self.get_index_mtime()
+        finally:
+            self.unlock()
+        self.changed.clear()
+        self.removed.clear()
+        self.changed_hashes.clear()
+        self.clear_hashes = False
+
+    def get_file_hash(self, path):
+        hashes = self.load()['hashes']
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        entry = hashes.get(path)
+        if entry and entry[:2] == stamp:
+            return entry[2]
+        digest = hash_file(path)
+        hashes[path] = stamp + [digest]
+        self.changed_hashes.add(path)
+        self.save()
+        return digest
+
+    # sha1 of the content of files and of the json of params
+    def get_key(self, files, params):
+        h = hashlib.sha1()
+        for path in files:
+            h.update(self.get_file_hash(path).encode())
+        h.update(json.dumps(params, sort_keys=True).encode())
+        return h.hexdigest()[:16]
+
+    def get_path(self, key):
+        return os.path.join(self.root, key)
+
+    # Record an entry made from files. The entry's own fields are passed
+    # in fields.
+    def add_entry(self, key, files, fields):
+        entry = dict(fields)
+        entry['sources'] = dict((os.path.realpath(p), self.get_file_hash(p))
+                                for p in files)
+        entry['time'] = time.time()
+        self.load()['entries'][key] = entry
+        self.changed.add(key)
+        self.stale.pop(key, None)
+        self.save()
+        return entry
+
+    # An entry is stale if one of its files changed or went away since it
+    # was made. Files modified since they were last hashed count as
+    # changed, this doesn't hash anything.
+    def is_stale(self, key):
+        entry = self.load()['entries'][key]
+        hashes = self.index['hashes']
+        if 'sources' not in entry:
+            return True
+        for path, digest in entry['sources'].items():
+            if not os.path.isfile(path) or path not in hashes:
+                return True
+            st = os.stat(path)
+            if hashes[path] != [st.st_size, st.st_mtime_ns, digest]:
+                return True
+        return False
+
+    # is_stale() as it was checked in the last stale_check_interval
+    # seconds, so UI redraws don't stat every source
+    def is_stale_cached(self, key):
+        now = time.time()
+        checked = self.stale.get(key)
+        if checked and now - checked[0] < stale_check_interval:
+            return checked[1]
+        stale = self.is_stale(key)
+        self.stale[key] = (now, stale)
+        return stale
+
+    # list of (key, entry, stale) with the newest first
+    def get_entries(self):
+        entries = self.load()['entries']
+        keys = sorted(entries.keys(), key=lambda k: entries[k]['time'],
+                      reverse=True)
+        return [(k, entries[k], self.is_stale_cached(k)) for k in keys]
+
+    def get_size(self, key):
+        path = self.get_path(key)
+        if os.path.isfile(path):
+            return os.path.getsize(path)
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(path):
+            for f in filenames:
+                total = total + os.path.getsize(os.path.join(dirpath, f))
+        return total
+
+    # the newest modification time of path and everything under it
+    def get_mtime(self, path):
+        mtime = os.path.getmtime(path)
+        for dirpath, dirnames, filenames in os.walk(path):
+            for f in dirnames + filenames:
+                try:
+                    st = os.stat(os.path.join(dirpath, f))
+                except OSError:
+                    continue
+                mtime = max(mtime, st.st_mtime)
+        return mtime
+
+    def remove_path(self, path):
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    # Remove the stale entries, or all of them. Anything else under the
+    # root not touched in in_progress_age seconds, like the output of runs
+    # that never finished, is removed too. Returns the number of entries
+    # removed.
+    def purge(self, stale_only=False):
+        entries = self.load()['entries']
+        removed = 0
+        for key in list(entries.keys()):
+            if stale_only and not self.is_stale(key):
+                continue
+            self.remove_path(self.get_path(key))
+            del entries[key]
+            self.removed.add(key)
+            removed = removed + 1
+        self.stale.clear()
+        keep = [os.path.basename(self.get_path(k)) for k in entries]
+        if os.path.isdir(self.root):
+            now = time.time()
+            for name in os.listdir(self.root):
+                if name in keep or name.startswith('index.json'):
+                    continue
+                path = os.path.join(self.root, name)
+                try:
+                    if now - self.get_mtime(path) < in_progress_age:
+                        continue
+                except OSError:
+                    continue
+                self.remove_path(path)
+        if not stale_only:
+            self.index['hashes'] = {}
+            self.changed_hashes.clear()
+            self.clear_hashes = True
+        self.save()
+        return removed
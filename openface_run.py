@@ -0,0 +1,338 @@
+import os
+import re
+import json
+import queue
+import shutil
+import threading
+import subprocess
+from . import file_cache
+
+# Runs OpenFace's FeatureExtraction in the background. Its output is
+# collected by a reader thread, so polling never blocks.
+class OpenFaceRun(object):
+    # how long poll() waits for the reader to see the end of the output
+    # once the process has exited
+    reader_timeout = 2.0
+
+    def __init__(self, openface, video, outdir, args=None):
+        self.openface = openface
+        self.video = video
+        self.outdir = outdir
+        self.args = args or []
+        self.proc = None
+        self.reader = None
+        self.lines = queue.Queue()
+        self.output = []
+        self.progress = 0.0
+        self.returncode = None
+
+    def get_csv_path(self):
+        return os.path.join(self.outdir,
+            os.path.splitext(os.path.basename(self.video))[0]+'.csv')
+
+    # the flags OpenFace is run with, apart from the paths
+    def get_flags(self):
+        return ['-verbose'] + self.args
+
+    def start(self):
+        if not os.path.exists(self.outdir):
+            os.makedirs(self.outdir)
+        cmd = [self.openface, '-f', self.video, '-out_dir', self.outdir] + \
+              self.get_flags()
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT,
+                                     universal_newlines=True)
+        self.reader = threading.Thread(target=self.read_output, daemon=True)
+        self.reader.start()
+
+    def read_output(self):
+        for line in self.proc.stdout:
+            self.lines.put(line.rstrip())
+        self.proc.stdout.close()
+
+    # Collect what the process printed since the last call and check if
+    # it's done. Returns True once it has exited.
+    def poll(self):
+        if self.returncode is None and self.proc.poll() is not None:
+            # the last lines may still be on their way through the reader
+            self.reader.join(self.reader_timeout)
+            self.returncode = self.proc.returncode
+        while True:
+            try:
+                line = self.lines.get_nowait()
+            except queue.Empty:
+                break
+            self.output.append(line)
+            # FeatureExtraction reports its progress in percent
+            m = re.search(r'(\d+(\.\d+)?)\s*%', line)
+            if m:
+                self.progress = min(float(m.group(1)) / 100.0, 1.0)
+        return self.returncode is not None
+
+    def get_output(self, last=0):
+        return '\n'.join(self.output[-last:])
+
+    def terminate(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+
+# Frame rate and frame count of a video, from ffprobe. None if ffprobe
+# isn't around or can't read the video.
+def probe_video(video, ffprobe='ffprobe'):
+    if not shutil.which(ffprobe):
+        return None
+    cmd = [ffprobe, '-v', 'error', '-select_streams', 'v:0',
+           '-show_entries', 'stream=avg_frame_rate,nb_frames:format=duration',
+           '-of', 'json', video]
+    try:
+        info = json.loads(subprocess.check_output(cmd,
+                                                  universal_newlines=True))
+        stream = info['streams'][0]
+        num, den = stream['avg_frame_rate'].split('/')
+        fps = float(num) / float(den)
+        nframes = int(stream.get('nb_frames') or
+                      round(float(info['format']['duration']) * fps))
+    except (subprocess.CalledProcessError, KeyError, IndexError,
+            ValueError, ZeroDivisionError):
+        return None
+    return fps, nframes
+
+# Split nframes into count segments. Every segment starts overlap frames
+# early so OpenFace's tracking has settled by the time the frames we keep
+# come up. Returns a list of (warmup, start, end) frame numbers, counting
+# from 0, end excluded.
+def split_segments(nframes, count, overlap):
+    segments = []
+    for i in range(count):
+        start = i * nframes // count
+        end = (i + 1) * nframes // count
+        if end > start:
+            segments.append((max(0, start - overlap), start, end))
+    return segments
+
+# One segment of a SegmentedRun. ffmpeg cuts the segment's frames out of
+# the video, then OpenFace runs on the cut.
+class Segment(object):
+    def __init__(self, run, index, warmup, start, end):
+        self.index = index
+        self.warmup = warmup
+        self.start = start
+        self.end = end
+        stem = os.path.splitext(os.path.basename(run.video))[0]
+        self.video = os.path.join(run.segdir, '%s_%03d.mp4' % (stem, index))
+        self.cut = None
+        self.run = OpenFaceRun(run.openface, self.video,
+            os.path.join(run.segdir, '%03d' % index), run.args)
+        self.returncode = None
+
+    def start_cut(self, ffmpeg, video, fps):
+        # seeking before -i and re-encoding cuts on the exact frame
+        cmd = [ffmpeg, '-nostdin', '-v', 'error', '-y',
+               '-ss', '%.6f' % (self.warmup / fps), '-i', video,
+               '-frames:v', str(self.end - self.warmup), '-an',
+               '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '12',
+               self.video]
+        self.cut = subprocess.Popen(cmd, stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.PIPE,
+                                    universal_newlines=True)
+
+    # advance the segment, returns True once it's done
+    def poll(self):
+        if self.returncode is not None:
+            return True
+        if not self.run.proc:
+            rc = self.cut.poll()
+            if rc is None:
+                return False
+            if rc:
+                self.run.output.append(self.cut.stderr.read())
+                self.returncode = rc
+                return True
+            self.run.start()
+        if self.run.poll():
+            self.returncode = self.run.returncode
+            return True
+        return False
+
+    def terminate(self):
+        if self.cut and self.cut.poll() is None:
+            self.cut.kill()
+        self.run.terminate()
+
+# Runs OpenFace on a long video as several processes, each on a time
+# segment of it. When they're all done the segment CSVs are stitched into
+# the one get_csv_path() gives, with frame and timestamp counting from the
+# start of the video. Needs ffmpeg and ffprobe; the interface is the one
+# of OpenFaceRun.
+class SegmentedRun(object):
+    def __init__(self, openface, video, outdir, args=None, count=2,
+                 overlap=1.0, ffmpeg='ffmpeg', ffprobe='ffprobe'):
+        self.openface = openface
+        self.video = video
+        self.outdir = outdir
+        self.args = args or []
+        self.count = count
+        self.overlap = overlap
+        self.ffmpeg = ffmpeg
+        self.ffprobe = ffprobe
+        self.segments = []
+        self.fps = 0.0
+        self.progress = 0.0
+        self.returncode = None
+
+    @property
+    def segdir(self):
+        return os.path.join(self.outdir, 'segments')
+
+    def get_csv_path(self):
+        return os.path.join(self.outdir,
+            os.path.splitext(os.path.basename(self.video))[0]+'.csv')
+
+    # The flags OpenFace is run with plus the segmenting. They identify
+    # the run in the cache, stitched output isn't bit for bit the same as
+    # a single run's.
+    def get_flags(self):
+        return ['-verbose'] + self.args + \
+               ['segments=%d' % self.count, 'overlap=%g' % self.overlap]
+
+    def start(self):
+        if not shutil.which(self.ffmpeg):
+            raise OSError('%s not found' % self.ffmpeg)
+        probe = probe_video(self.video, self.ffprobe)
+        if not probe:
+            raise OSError("can't read the frame rate of " + self.video)
+        self.fps, nframes = probe
+        shutil.rmtree(self.segdir, ignore_errors=True)
+        os.makedirs(self.segdir)
+        overlap = int(round(self.overlap * self.fps))
+        for i, (warmup, start, end) in enumerate(
+                split_segments(nframes, self.count, overlap)):
+            seg = Segment(self, i, warmup, start, end)
+            seg.start_cut(self.ffmpeg, self.video, self.fps)
+            self.segments.append(seg)
+
+    def poll(self):
+        if self.returncode is not None:
+            return True
+        done = [seg.poll() for seg in self.segments]
+        self.progress = sum(seg.run.progress for seg in self.segments) / \
+                        len(self.segments)
+        failed = [seg for seg in self.segments if seg.returncode]
+        if failed:
+            self.terminate()
+            self.returncode = failed[0].returncode
+            return True
+        if not all(done):
+            return False
+        stitch_csvs(self.get_csv_path(),
+                    [(seg.run.get_csv_path(), seg.warmup, seg.start) \
+                     for seg in self.segments], self.fps)
+        shutil.rmtree(self.segdir, ignore_errors=True)
+        self.returncode = 0
+        return True
+
+    def get_output(self, last=0):
+        lines = []
+        for seg in self.segments:
+            lines = lines + seg.run.output
+        return '\n'.join(lines[-last:])
+
+    def terminate(self):
+        for seg in self.segments:
+            seg.terminate()
+
+# Join the CSVs of the segments of a video. parts is a list of
+# (csv, warmup, start): the segment's csv, the frame of the video it
+# starts at and the first frame to keep, the warm up frames before it are
+# dropped. OpenFace counts frames from 1 and time from 0 in every segment.
+def stitch_csvs(path, parts, fps):
+    header = None
+    with open(path + '.tmp', 'w') as out:
+        for csv, warmup, start in parts:
+            if not os.path.isfile(csv):
+                continue
+            with open(csv, 'r') as f:
+                lines = iter(f)
+                fields = [v.strip() for v in next(lines, '').split(',')]
+                if not header:
+                    header = fields
+                    frame_col = header.index('frame')
+                    ts_col = header.index('timestamp')
+                    out.write(', '.join(header) + '\n')
+                for line in lines:
+                    row = [v.strip() for v in line.split(',')]
+                    if len(row) != len(header):
+                        continue
+                    frame = int(float(row[frame_col])) + warmup
+                    if frame <= start:
+                        continue
+                    row[frame_col] = str(frame)
+                    row[ts_col] = '%.3f' % (float(row[ts_col]) + warmup / fps)
+                    out.write(', '.join(row) + '\n')
+    os.replace(path + '.tmp', path)
+
+# Reads the rows appended to a CSV file which is still being written.
+# Only complete lines are returned, a partly written last line is kept
+# for the next call.
+class CsvTail(object):
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.header = None
+        self.partial = ''
+
+    def read_rows(self):
+        if not os.path.isfile(self.path):
+            return []
+        with open(self.path, 'r') as f:
+            f.seek(self.offset)
+            data = f.read()
+            self.offset = f.tell()
+        if not data:
+            return []
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        rows = []
+        for line in lines:
+            if not line.strip():
+                continue
+            fields = [v.strip() for v in line.split(',')]
+            if not self.header:
+                self.header = fields
+                continue
+            rows.append(dict((k, v) for k, v in zip(self.header, fields) \
+                             if v))
+        return rows
+
+# Cache of OpenFace output. Every run goes into <root>/<key>, where the key
+# is a hash of the video's content, the OpenFace binary and the flags it
+# was run with. Changing any of them gives a new key.
+class OpenFaceCache(file_cache.FileCache):
+    def get_key(self, openface, video, flags):
+        return file_cache.FileCache.get_key(self, [video, openface],
+                                            list(flags))
+
+    def get_dir(self, key):
+        return self.get_path(key)
+
+    # path of the cached csv of the key, None if there isn't a usable one
+    def lookup(self, key):
+        entry = self.load()['entries'].get(key)
+        if not entry:
+            return None
+        csv = os.path.join(self.get_dir(key), entry['csv'])
+        if not os.path.isfile(csv) or os.path.getsize(csv) != entry['size']:
+            return None
+        return csv
+
+    def store(self, key, openface, video, flags, csv):
+        self.add_entry(key, [video, openface], {
+            'video': os.path.realpath(video),
+            'openface': os.path.realpath(openface),
+            'flags': list(flags),
+            'csv': os.path.basename(csv),
+            'size': os.path.getsize(csv)})
@@ -0,0 +1,399 @@
+# Apply lip-sync and FACS animation to a list of shot files without
+# opening them in the UI.
+#
+#   python shot_pipeline.py shots.json [-j 8] [--blender blender] [-o report.json]
+#                           [--timeout 600]
+#
+# The manifest is a JSON file:
+#
+#   {
+#       "output_dir": "animated",
+#       "defaults": {"scene": {"yafr_openface_ws": 5}},
+#       "shots": [
+#           {"name": "sh010", "blend": "shots/sh010.blend",
+#            "phoneme_rig": "sh010_phoneme_rig",
+#            "wav": "audio/sh010.wav", "transcript": "audio/sh010.txt",
+#            "start_frame": 1,
+#            "facs_rig": "sh010_facs_rig", "csv": "facs/sh010.csv",
+#            "scene": {"yasp_coarticulation": true}, "timeout": 600}
+#       ]
+#   }
+#
+# A shot is lip-synced if it has a wav and a transcript. A wav without a
+# transcript gets energy lip-sync, which follows the loudness of the audio
+# and is good enough for background characters. A shot gets FACS
+# animation if it has a csv or a video (which OpenFace is run on). "scene"
+# sets any scene property of the add-on. Every shot takes the defaults
+# first. The result is saved to the shot's "output", or under output_dir
+# with the name of the blend file. Relative paths are relative to the
+# manifest. A shot which takes longer than its "timeout" in seconds, or
+# --timeout, fails and its worker is killed.
+#
+# The shots are handed out to a pool of `blender --background` workers,
+# -j of them (the number of cores by default). Every worker runs this
+# script with --worker, loads the add-on once and then opens, animates
+# and saves the shots it's given one after the other. The time every step
+# took and the errors of every shot are printed and written to the
+# report.
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+import traceback
+import subprocess
+
+RESULT_PREFIX = 'YASP_SHOT_RESULT '
+
+addon_dir = os.path.dirname(os.path.realpath(__file__))
+
+path_fields = ['blend', 'output', 'wav', 'transcript', 'csv', 'video']
+
+# The shots of the manifest with the defaults applied and the paths made
+# absolute
+def load_manifest(path):
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    root = os.path.dirname(os.path.realpath(path))
+    defaults = manifest.get('defaults', {})
+    output_dir = manifest.get('output_dir', '')
+    shots = []
+    for i, s in enumerate(manifest['shots']):
+        shot = dict(defaults)
+        shot.update(s)
+        shot['scene'] = dict(defaults.get('scene', {}))
+        shot['scene'].update(s.get('scene', {}))
+        if 'blend' not in shot:
+            raise ValueError('shot %d has no blend file' % i)
+        if 'output' not in shot:
+            if not output_dir:
+                raise ValueError('shot %d has no output and there is no '
+                                 'output_dir' % i)
+            shot['output'] = os.path.join(output_dir,
+                                          os.path.basename(shot['blend']))
+        for k in path_fields:
+            if shot.get(k):
+                shot[k] = os.path.join(root, os.path.expanduser(shot[k]))
+        shot.setdefault('name', os.path.splitext(
+                        os.path.basename(shot['blend']))[0])
+        shots.append(shot)
+    return shots
+
+# A running worker. Shots go in on its stdin as JSON lines, results come
+# back on stdout after RESULT_PREFIX. Anything else it prints is kept
+# around for the report of a shot which fails. Its output is read by a
+# thread, so a worker which hangs can be given up on.
+class Worker(object):
+    def __init__(self, blender, verbose=False):
+        cmd = [blender, '--background', '--factory-startup',
+               '--python', os.path.realpath(__file__), '--', '--worker']
+        self.verbose = verbose
+        self.timed_out = False
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT,
+                                     universal_newlines=True, bufsize=1)
+        # the lines the worker printed, None once it exited
+        self.lines = queue.Queue()
+        reader = threading.Thread(target=self.read_output, daemon=True)
+        reader.start()
+
+    def read_output(self):
+        for line in self.proc.stdout:
+            self.lines.put(line)
+        self.lines.put(None)
+
+    # Run shot, waiting at most timeout seconds for it if timeout is set.
+    # Returns its result, or None if the worker died or timed out on it,
+    # and the last lines the worker printed.
+    def run(self, shot, timeout=0):
+        log = []
+        try:
+            self.proc.stdin.write(json.dumps(shot) + '\n')
+            self.proc.stdin.flush()
+        except OSError:
+            return None, log
+        deadline = time.time() + timeout if timeout else None
+        while True:
+            wait = None
+            if deadline:
+                wait = max(0, deadline - time.time())
+            try:
+                line = self.lines.get(timeout=wait)
+            except queue.Empty:
+                self.timed_out = True
+                self.proc.kill()
+                return None, log
+            if line is None:
+                # the worker died on the shot
+                return None, log
+            if line.startswith(RESULT_PREFIX):
+                return json.loads(line[len(RESULT_PREFIX):]), log
+            if self.verbose:
+                sys.stderr.write(line)
+            log = (log + [line.rstrip()])[-20:]
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+
+# Run the shots on jobs workers. A worker which dies is replaced and the
+# shot it was on fails. Returns the results in the order of the shots.
+# timeout, if set, is the time a shot without a timeout of its own may
+# take.
+def dispatch(shots, jobs, blender, verbose=False, timeout=0):
+    todo = queue.Queue()
+    for i, shot in enumerate(shots):
+        todo.put(i)
+    results = [None] * len(shots)
+    lock = threading.Lock()
+    done = [0]
+
+    def work():
+        worker = None
+        while True:
+            try:
+                i = todo.get_nowait()
+            except queue.Empty:
+                break
+            if not worker:
+                worker = Worker(blender, verbose)
+            start = time.time()
+            limit = shots[i].get('timeout', timeout)
+            result, log = worker.run(shots[i], limit)
+            if result is None:
+                error = 'worker exited'
+                if worker.timed_out:
+                    error = 'timed out after %gs' % limit
+                worker.close()
+                worker = None
+                result = {'name': shots[i]['name'], 'ok': False,
+                          'errors': ['%s (%s)' % (error, '\n'.join(log))],
+                          'steps': {}}
+            result['wall'] = time.time() - start
+            results[i] = result
+            with lock:
+                done[0] = done[0] + 1
+                # the last line of every error, the report has them whole
+                errors = [e.strip().splitlines()[-1] \
+                          for e in result['errors'] if e.strip()]
+                print('[%d/%d] %-24s %-6s %8.2fs %s' % (done[0], len(shots),
+                      result['name'], 'ok' if result['ok'] else 'FAILED',
+                      result['wall'], '; '.join(errors)[:200]),
+                      file=sys.stderr, flush=True)
+        if worker:
+            worker.close()
+
+    threads = [threading.Thread(target=work) \
+               for i in range(max(1, min(jobs, len(shots))))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+def summarize(results, wall):
+    steps = {}
+    for r in results:
+        for name, t in r['steps'].items():
+            steps[name] = steps.get(name, 0.0) + t
+    return {'shots': len(results),
+            'failed': len([r for r in results if not r['ok']]),
+            'wall': wall,
+            'shot_time': sum(r['wall'] for r in results),
+            'steps': steps}
+
+def main():
+    parser = argparse.ArgumentParser(description='animate shots headless')
+    parser.add_argument('manifest')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='Blender workers to run at once')
+    parser.add_argument('--blender', default='blender',
+                        help='path to the Blender binary')
+    parser.add_argument('-o', '--output', default='',
+                        help='write the report to this JSON file')
+    parser.add_argument('--verbose', action='store_true',
+                        help="print the workers' output")
+    parser.add_argument('--timeout', type=float, default=0,
+                        help='seconds a shot may take before its worker '
+                             'is killed, 0 for no limit')
+    args = parser.parse_args()
+
+    shots = load_manifest(args.manifest)
+    start = time.time()
+    results = dispatch(shots, args.jobs, args.blender, args.verbose,
+                       args.timeout)
+    report = {'summary': summarize(results, time.time() - start),
+              'shots': results}
+    s = report['summary']
+    print('%d shots, %d failed, %.1fs (%.1fs of shot time on %d workers)' %
+          (s['shots'], s['failed'], s['wall'], s['shot_time'], args.jobs),
+          file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+    return 1 if s['failed'] else 0
+
+# ---- worker side, runs inside Blender ----
+
+# Calls an operator's methods on a stand-in for the operator, so the
+# operators can be run without a UI and what they report collected.
+class OperatorCall(object):
+    def __init__(self, cls):
+        self.op_class = cls
+        self.reports = []
+
+    def __getattr__(self, name):
+        attr = getattr(self.op_class, name)
+        if callable(attr):
+            return attr.__get__(self)
+        return attr
+
+    def report(self, level, msg):
+        self.reports.append((sorted(level)[0], msg))
+
+    def errors(self):
+        return [msg for level, msg in self.reports if level == 'ERROR']
+
+# Import the add-on from this directory, whatever it's called, and
+# register it
+def load_addon():
+    import importlib.util
+
+    spec = importlib.util.spec_from_file_location('yasp_addon',
+        os.path.join(addon_dir, '__init__.py'),
+        submodule_search_locations=[addon_dir])
+    addon = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = addon
+    spec.loader.exec_module(addon)
+    addon.register()
+    return addon
+
+# forget what the add-on knows about the previous shot's file
+def reset_addon(addon):
+    addon.byasp.seqmgr = addon.byasp.SequenceMgr()
+    addon.bface.global_sliders_set = False
+    addon.bface.global_sliders = {}
+    addon.bface.base_keys.clear()
+    if addon.bface.facs:
+        addon.bface.facs.reset_database()
+
+def set_scene(scn, shot):
+    for k, v in shot['scene'].items():
+        setattr(scn, k, v)
+    if shot.get('phoneme_rig'):
+        scn.yasp_phoneme_rig = shot['phoneme_rig']
+    if shot.get('facs_rig'):
+        scn.yafr_facs_rig = shot['facs_rig']
+
+def lipsync(addon, scn, shot):
+    import bpy
+
+    scn.yasp_wave_path = shot['wav']
+    scn.yasp_transcript_path = shot['transcript']
+    scn.yasp_start_frame = int(shot.get('start_frame', 1))
+    if not scn.sequence_editor:
+        scn.sequence_editor_create()
+    errors = []
+    for cls in [addon.byasp.YASP_OT_mark,
+                addon.byasp.YASP_OT_animate_all_strips]:
+        op = OperatorCall(cls)
+        op.execute(bpy.context)
+        errors = errors + op.errors()
+        if errors:
+            break
+    return errors
+
+def energy_lipsync(addon, scn, shot):
+    import bpy
+
+    scn.yasp_wave_path = shot['wav']
+    scn.yasp_start_frame = int(shot.get('start_frame', 1))
+    op = OperatorCall(addon.byasp.YASP_OT_energy_lipsync)
+    op.execute(bpy.context)
+    return op.errors()
+
+def face(addon, scn, shot):
+    import bpy
+
+    csv = shot.get('csv', '')
+    if not csv:
+        openface = os.path.join(addon_dir, 'openface', 'FeatureExtraction')
+        csv = addon.bface.extract_openface(scn, openface, shot['video'])
+    scn.yafr_csvfile = csv
+    scn.yafr_videofile = ''
+    if 'start_frame' in shot and 'yafr_start_frame' not in shot['scene']:
+        scn.yafr_start_frame = int(shot['start_frame'])
+    op = OperatorCall(addon.bface.FACE_OT_animate)
+    op.execute(bpy.context)
+    return op.errors()
+
+def run_shot(addon, shot):
+    import bpy
+
+    result = {'name': shot['name'], 'ok': False, 'errors': [], 'steps': {}}
+    steps = result['steps']
+
+    def step(name, fn, *args):
+        start = time.perf_counter()
+        try:
+            errors = fn(*args)
+        except Exception:
+            errors = [traceback.format_exc()]
+        steps[name] = time.perf_counter() - start
+        result['errors'] = result['errors'] + (errors or [])
+        return not errors
+
+    def open_shot():
+        reset_addon(addon)
+        bpy.ops.wm.open_mainfile(filepath=shot['blend'])
+        set_scene(bpy.context.scene, shot)
+
+    def save_shot():
+        out_dir = os.path.dirname(shot['output'])
+        if out_dir and not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        bpy.ops.wm.save_as_mainfile(filepath=shot['output'], copy=True)
+
+    if not step('open', open_shot):
+        return result
+    scn = bpy.context.scene
+    ok = True
+    if shot.get('wav') and shot.get('transcript'):
+        ok = step('lipsync', lipsync, addon, scn, shot) and ok
+    elif shot.get('wav'):
+        ok = step('lipsync', energy_lipsync, addon, scn, shot) and ok
+    if shot.get('csv') or shot.get('video'):
+        ok = step('face', face, addon, scn, shot) and ok
+    if ok:
+        ok = step('save', save_shot)
+    result['ok'] = ok
+    return result
+
+def worker_main():
+    addon = load_addon()
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        shot = json.loads(line)
+        try:
+            result = run_shot(addon, shot)
+        except Exception:
+            result = {'name': shot.get('name', ''), 'ok': False,
+                      'errors': [traceback.format_exc()], 'steps': {}}
+        sys.stdout.write(RESULT_PREFIX + json.dumps(result) + '\n')
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    if '--worker' in sys.argv:
+        worker_main()
+    else:
+        sys.exit(main())
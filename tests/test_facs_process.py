@@ -0,0 +1,86 @@
+# facs_process doesn't need Blender, import it on its own from the add-on
+# directory.
+import os
+import sys
+
+addon_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, addon_dir)
+sys.path.insert(0, os.path.join(addon_dir, 'benchmarks'))
+import facs_process as facs
+import synth_openface
+
+table_names = facs.csv_table_names + list(facs.feature_sources)
+
+# Write a take of nframes for face 0, followed by a few rows of a second
+# face, like OpenFace picking up something face like in the background.
+def write_take(path, nframes, extra_rows):
+    synth_openface.write_openface_csv(path, nframes, low_conf=0)
+    with open(path, 'r') as f:
+        lines = f.readlines()
+    header = [c.strip() for c in lines[0].split(',')]
+    face_id = header.index('face_id')
+    with open(path, 'a') as f:
+        for line in lines[1:extra_rows + 1]:
+            cols = line.rstrip('\n').split(', ')
+            cols[face_id] = '1'
+            f.write(', '.join(cols) + '\n')
+
+def process(path, profile='offline'):
+    facs.init_database()
+    facs.reset_database()
+    facs.process_openface_csv(path, 5, 2, 24, profile)
+    return facs.get_takes()
+
+def test_short_second_face(tmp_path):
+    path = str(tmp_path / 'take.csv')
+    write_take(path, 480, 3)
+    for profile in facs.filter_profiles:
+        takes = process(path, profile)
+        assert [len(t) for t in takes] == [len(takes[0]), 3]
+        for t in takes:
+            for name in table_names:
+                table = t.get_table(name)
+                values = table['frame'][facs.VALUES]
+                if name in facs.csv_table_names:
+                    assert len(values) == len(t)
+
+def test_savgol_short_block():
+    import numpy as np
+
+    block = np.arange(6, dtype=float).reshape(2, 3)
+    assert facs.savgol(block, 5, 2).shape == block.shape
+    # too short for any window larger than the polynomial order
+    block = np.arange(4, dtype=float).reshape(2, 2)
+    assert (facs.savgol(block, 5, 2) == block).all()
+
+def test_resample_holds_across_gaps():
+    ts = [1.0, 1.04, 1.08, 2.5, 2.54]
+    table = {'frame': [[1, 2, 3, 4, 5], [], []],
+             'timestamp': [list(ts), [], []],
+             'AU01_r': [[0.0, 1.0, 2.0, 3.0, 4.0], [], []]}
+    facs.resample_table(table, facs.resample_weights(ts, 25), 25)
+    frames = table['frame'][facs.VALUES]
+    values = table['AU01_r'][facs.VALUES]
+    # the grid starts at the first row, not at time 0
+    assert frames[0] == 26
+    assert table['timestamp'][facs.VALUES][0] == 1.0
+    # the lost face holds its last value until it's back
+    assert values[:3] == [0.0, 1.0, 2.0]
+    assert values[frames.index(62)] == 2.0
+    assert values[-1] == 3.5
+
+# Keying a take while it's read processes the eye features of the rows so
+# far the way the complete take's are processed
+def test_streamed_eye_features(tmp_path):
+    path = str(tmp_path / 'take.csv')
+    write_take(path, 240, 0)
+    facs.init_database()
+    facs.reset_database()
+    facs.load_openface_csv(path)
+    t = facs.get_take(0)
+    streamed = facs.process_table(t.eye_feature_table(), 5, 2)
+    facs.process_database(5, 2)
+    final = t.get_table('eye_features')
+    assert streamed['blink'][facs.VALUES]
+    for name in ['blink', 'gaze_x', 'gaze_y']:
+        assert streamed[name] == final[name]
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import functools
+import logging
+import threading
+
+# Lightweight timing spans.
+#
+#   with timing.span('facs.parse') as s:
+#       ...
+#       s.count(rows=len(rows))
+#
+#   @timing.span('yasp.recognition')
+#   def run_yasp(...):
+#       ...
+#       timing.count(segments=len(segments))
+#
+# Spans are only recorded while timing is enabled, either through
+# timing.enable() or by setting YASP_TRACE in the environment. When
+# disabled entering a span only checks a flag.
+# The recorded spans can be exported as Chrome trace-event JSON (load it
+# in chrome://tracing or https://ui.perfetto.dev) or as a summary table.
+
+logger = logging.getLogger(__name__)
+
+enabled = bool(os.environ.get('YASP_TRACE'))
+spans = []
+epoch = time.perf_counter()
+local = threading.local()
+
+def enable(state=True):
+    global enabled
+    enabled = state
+
+def reset():
+    global epoch
+    del spans[:]
+    epoch = time.perf_counter()
+
+def get_stack():
+    try:
+        return local.stack
+    except AttributeError:
+        local.stack = []
+        return local.stack
+
+class Span(object):
+    __slots__ = ('name', 'counts', 'start')
+
+    def __init__(self, name, counts):
+        self.name = name
+        self.counts = counts
+        self.start = None
+
+    def __enter__(self):
+        if enabled:
+            get_stack().append(self)
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.start is None:
+            return False
+        end = time.perf_counter()
+        stack = get_stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        spans.append((self.name, self.start - epoch, end - self.start,
+                      threading.get_ident(), self.counts))
+        return False
+
+    # add to the counts carried by the span, e.g. rows=100
+    def count(self, **counts):
+        if self.start is None:
+            return
+        for k, v in counts.items():
+            self.counts[k] = self.counts.get(k, 0) + v
+
+    # use the span as a decorator. A new span is opened for every call.
+    def __call__(self, fn):
+        name = self.name
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            with Span(name, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+
+def span(name, **counts):
+    return Span(name, counts)
+
+# add counts to the innermost open span of the calling thread
+def count(**counts):
+    if not enabled:
+        return
+    stack = get_stack()
+    if stack:
+        stack[-1].count(**counts)
+
+def chrome_trace():
+    pid = os.getpid()
+    events = []
+    for name, start, duration, tid, counts in spans:
+        events.append({'name': name, 'cat': name.split('.')[0], 'ph': 'X',
+                       'ts': start * 1e6, 'dur': duration * 1e6,
+                       'pid': pid, 'tid': tid, 'args': counts})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+def export_chrome_trace(path):
+    with open(path, 'w') as f:
+        json.dump(chrome_trace(), f)
+
+# Aggregate the spans by name. Returns a list of
+# (name, calls, total, mean, max, counts) sorted by total time
+def summarize():
+    agg = {}
+    for name, start, duration, tid, counts in spans:
+        entry = agg.setdefault(name, [0, 0.0, 0.0, {}])
+        entry[0] = entry[0] + 1
+        entry[1] = entry[1] + duration
+        entry[2] = max(entry[2], duration)
+        for k, v in counts.items():
+            entry[3][k] = entry[3].get(k, 0) + v
+    rows = [(name, e[0], e[1], e[1] / e[0], e[2], e[3]) \
+            for name, e in agg.items()]
+    rows.sort(key=lambda r: r[2], reverse=True)
+    return rows
+
+def summary_table():
+    lines = ['%-28s %7s %10s %10s %10s  %s' % ('span', 'calls', 'total ms',
+             'mean ms', 'max ms', 'counts')]
+    for name, calls, total, mean, longest, counts in summarize():
+        c = ' '.join('%s=%s' % (k, v) for k, v in sorted(counts.items()))
+        lines.append('%-28s %7d %10.2f %10.2f %10.2f  %s' % (name, calls,
+                     total * 1e3, mean * 1e3, longest * 1e3, c))
+    return '\n'.join(lines)
+
+# Wrap an operator's execute(). The whole run is a span. If the scene
+# property named by path_prop holds a path, timing is switched on for the
+# run and the spans recorded are written there as a Chrome trace, with
+# the summary going to the log.
+def operator_span(name, path_prop='yasp_trace_path'):
+    def wrap(execute):
+        @functools.wraps(execute)
+        def wrapper(self, context):
+            path = getattr(context.scene, path_prop, '')
+            if not path:
+                with Span(name, {}):
+                    return execute(self, context)
+
+            import bpy
+            was_enabled = enabled
+            enable(True)
+            reset()
+            try:
+                with Span(name, {}):
+                    return execute(self, context)
+            finally:
+                enable(was_enabled)
+                try:
+                    export_chrome_trace(bpy.path.abspath(path))
+                    logger.critical('%s timings:\n%s', name, summary_table())
+                except Exception as e:
+                    logger.critical(e)
+        return wrapper
+    return wrap
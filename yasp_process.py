@@ -0,0 +1,671 @@
+import re
+import os
+import json
+import hashlib
+import array
+import logging
+import collections
+from . import file_cache
+
+logger = logging.getLogger(__name__)
+
+# Phone set of the en-us acoustic model shipped under
+# yasp/sphinxinstall/share/pocketsphinx/model/en-us. The phoneme id stored
+# in a PhonemeSegments track is the index into this table.
+yasp_phonemes = ['SIL', 'AA', 'AE', 'AH', 'AO', 'AW', 'AY', 'B', 'CH',
+                 'D', 'DH', 'EH', 'ER', 'EY', 'F', 'G', 'HH', 'IH', 'IY',
+                 'JH', 'K', 'L', 'M', 'N', 'NG', 'OW', 'OY', 'P', 'R', 'S',
+                 'SH', 'T', 'TH', 'UH', 'UW', 'V', 'W', 'Y', 'Z', 'ZH',
+                 '+NSN+', '+SPN+']
+yasp_phoneme_ids = dict((p, i) for i, p in enumerate(yasp_phonemes))
+
+# Pack the phoneme markers of a strip into a dict of int arrays, which is
+# what gets stored in the strip's custom properties. Marker names which
+# aren't phonemes are listed in vocab and get ids past the phoneme table.
+TRACK_VERSION = 1
+
+def pack_track(names, frames):
+    vocab = []
+    ids = []
+    for name in names:
+        pid = yasp_phoneme_ids.get(name)
+        if pid is None:
+            if name not in vocab:
+                vocab.append(name)
+            pid = len(yasp_phonemes) + vocab.index(name)
+        ids.append(pid)
+    return {'version': TRACK_VERSION, 'phonemes': ids,
+            'frames': [int(f) for f in frames], 'vocab': '\n'.join(vocab)}
+
+# the marker names and frames of a packed track, None if it can't be read
+def unpack_track(track):
+    try:
+        if track['version'] != TRACK_VERSION:
+            return None
+        vocab = [v for v in track['vocab'].split('\n') if v]
+        names = yasp_phonemes + vocab
+        return [names[i] for i in track['phonemes']], list(track['frames'])
+    except (KeyError, IndexError, TypeError):
+        return None
+
+# A phoneme track as produced by the aligner.
+# Each segment is stored in compact parallel arrays:
+#   phonemes: phoneme id (index into yasp_phonemes)
+#   start/end: segment boundaries in centiseconds (10ms sphinx frames)
+#   word: index of the word in self.words the phoneme belongs to
+# The arrays support the buffer protocol, so they can be handed to numpy
+# with np.frombuffer() without copying.
+class PhonemeSegments(object):
+    def __init__(self):
+        self.phonemes = array.array('H')
+        self.start = array.array('i')
+        self.end = array.array('i')
+        self.word = array.array('i')
+        self.words = []
+
+    def __len__(self):
+        return len(self.phonemes)
+
+    def add_word(self, word):
+        self.words.append(word)
+        return len(self.words) - 1
+
+    def add_segment(self, phoneme, start, end, word):
+        try:
+            pid = yasp_phoneme_ids[phoneme]
+        except KeyError:
+            logger.critical("Unknown phoneme %s", phoneme)
+            return False
+        self.phonemes.append(pid)
+        self.start.append(start)
+        self.end.append(end)
+        self.word.append(word)
+        return True
+
+    def get_phoneme(self, i):
+        return yasp_phonemes[self.phonemes[i]]
+
+    # convert the segment start times to frames on a grid of fps frames
+    # per second, starting at offset
+    def get_frames(self, fps, offset=0):
+        return [offset + round(fps * (s / 100)) for s in self.start]
+
+# The phoneme to viseme mapping compiled into a dense matrix.
+# weights[phoneme_id, viseme] is the value the ph_<viseme> bone takes for
+# that phoneme. An extra row of zeros at the end is used for phonemes
+# which aren't in the phone set, so a whole track can be evaluated with a
+# single gather: weights[ids]
+class PhonemeMap(object):
+    def __init__(self, visemes, weights):
+        self.visemes = visemes
+        self.weights = weights
+        self.unknown_id = len(weights) - 1
+
+    def get_ids(self, names):
+        import numpy as np
+        ids = [yasp_phoneme_ids.get(n, self.unknown_id) for n in names]
+        return np.array(ids, dtype=np.intp)
+
+    # per viseme values for each phoneme id in ids. Returns a
+    # len(ids) x len(visemes) matrix
+    def get_weights(self, ids):
+        return self.weights[ids]
+
+    # per viseme values for a phoneme activation matrix of
+    # frames x len(yasp_phonemes)
+    def evaluate(self, activation):
+        return activation @ self.weights[:len(yasp_phonemes)]
+
+    def get_phoneme_animation_data(self, phoneme):
+        pid = yasp_phoneme_ids.get(phoneme)
+        if pid is None:
+            return None
+        row = self.weights[pid]
+        anim_data = [[self.visemes[v], float(row[v])] \
+                     for v in row.nonzero()[0]]
+        if not anim_data:
+            return None
+        return anim_data
+
+def compile_phoneme_map(phoneme_map):
+    import numpy as np
+
+    visemes = sorted(set(v[0] for entries in phoneme_map.values() \
+                         for v in entries))
+    viseme_ids = dict((v, i) for i, v in enumerate(visemes))
+    weights = np.zeros((len(yasp_phonemes) + 1, len(visemes)),
+                       dtype=np.float64)
+    for phoneme, entries in phoneme_map.items():
+        pid = yasp_phoneme_ids.get(phoneme)
+        if pid is None:
+            logger.critical("Unknown phoneme %s in phoneme map", phoneme)
+            continue
+        for viseme, value in entries:
+            weights[pid, viseme_ids[viseme]] = value
+    return PhonemeMap(visemes, weights)
+
+# Load the phoneme map in map_file, using the compiled form cached in
+# cache_file if it was built from the same map and phone set. The cache is
+# rebuilt otherwise. Failing to write the cache isn't fatal.
+def load_phoneme_map(map_file, cache_file):
+    import numpy as np
+
+    with open(map_file, 'rb') as f:
+        raw = f.read()
+    h = hashlib.sha1(raw)
+    h.update(' '.join(yasp_phonemes).encode())
+    digest = h.hexdigest()
+
+    if os.path.isfile(cache_file):
+        try:
+            with np.load(cache_file) as cache:
+                if str(cache['digest']) == digest:
+                    return PhonemeMap([str(v) for v in cache['visemes']],
+                                      cache['weights'])
+        except Exception as e:
+            logger.critical("Failed to read %s: %s", cache_file, e)
+
+    pmap = compile_phoneme_map(json.loads(raw))
+    try:
+        with open(cache_file, 'wb') as f:
+            np.savez(f, digest=np.array(digest),
+                     visemes=np.array(pmap.visemes), weights=pmap.weights)
+    except Exception as e:
+        logger.critical("Failed to write %s: %s", cache_file, e)
+    return pmap
+
+# Build a PhonemeSegments track out of the JSON document produced by
+# yasp_interpret_get_str()
+def segments_from_json(json_str):
+    jdict = json.loads(json_str)
+    segments = PhonemeSegments()
+    try:
+        word_list = jdict['words']
+    except (KeyError, TypeError):
+        return None
+
+    for word in word_list:
+        try:
+            phonemes = word['phonemes']
+        except (KeyError, TypeError):
+            return None
+        widx = segments.add_word(word.get('word', ''))
+        for phone in phonemes:
+            try:
+                start = int(phone['start'])
+                end = start + int(phone.get('duration', 0))
+                if not segments.add_segment(phone['phoneme'], start, end, widx):
+                    return None
+            except (KeyError, TypeError, ValueError) as e:
+                logger.critical(e)
+                return None
+    return segments
+
+# sphinxbase log levels (err_lvl_t)
+ERR_DEBUG = 0
+ERR_INFO = 1
+ERR_INFOCONT = 2
+ERR_WARN = 3
+ERR_ERROR = 4
+ERR_FATAL = 5
+log_level_names = ['DEBUG', 'INFO', 'INFOCONT', 'WARN', 'ERROR', 'FATAL']
+
+c_format_spec = re.compile(r'%[-+ #0]*\d*(?:\.\d+)?(hh|h|ll|l|z|j|t)?([diouxXeEfgGcsp%])')
+
+# Expand a printf style format with the raw arguments handed to a native
+# logging callback. args are pointer sized integers (or None). read_str
+# converts a char pointer into a python string.
+# Floating point arguments are passed in registers we never see, so they
+# are rendered as '?' and don't consume an argument.
+def format_c_message(fmt, args, read_str):
+    out = []
+    pos = 0
+    argi = 0
+    for m in c_format_spec.finditer(fmt):
+        out.append(fmt[pos:m.start()])
+        pos = m.end()
+        length, conv = m.group(1), m.group(2)
+        if conv == '%':
+            out.append('%')
+            continue
+        if conv in 'eEfgG' or argi >= len(args):
+            out.append('?')
+            continue
+        arg = args[argi] or 0
+        argi = argi + 1
+        if conv == 's':
+            out.append(read_str(arg) if arg else '(null)')
+        elif conv == 'c':
+            out.append(chr(arg & 0xff))
+        elif conv == 'p':
+            out.append(hex(arg))
+        else:
+            bits = 64 if length in ('l', 'll', 'z', 'j', 't') else 32
+            arg = arg & ((1 << bits) - 1)
+            if conv in 'di' and arg >> (bits - 1):
+                arg = arg - (1 << bits)
+            if conv in 'xX':
+                arg = format(arg, conv)
+            elif conv == 'o':
+                arg = format(arg, 'o')
+            out.append(str(arg))
+    out.append(fmt[pos:])
+    return ''.join(out)
+
+# Bounded in-memory log of the aligner.
+# Only messages at or above level are kept and once maxlen entries are
+# stored the oldest ones are dropped.
+class YaspLogBuffer(object):
+    def __init__(self, maxlen=512, level=ERR_INFO):
+        self.entries = collections.deque(maxlen=maxlen)
+        self.level = level
+
+    def set_level(self, level):
+        self.level = level
+
+    def log(self, level, msg):
+        # continuation lines are filtered the same way as the INFO
+        # message they continue
+        if level == ERR_INFOCONT:
+            if ERR_INFO < self.level:
+                return
+        elif level < self.level:
+            return
+        self.entries.append((level, msg.rstrip('\n')))
+
+    def clear(self):
+        self.entries.clear()
+
+    def get_lines(self, level=ERR_DEBUG):
+        lines = []
+        joined = False
+        for lvl, msg in self.entries:
+            if lvl == ERR_INFOCONT:
+                if ERR_INFO < level:
+                    joined = False
+                    continue
+                if joined:
+                    lines[-1] = lines[-1] + msg
+                    continue
+            elif lvl < level:
+                joined = False
+                continue
+            lines.append(log_level_names[lvl] + ': ' + msg)
+            joined = True
+        return lines
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            for line in self.get_lines():
+                f.write(line + '\n')
+
+# Phoneme classes used by the coarticulation stage
+phoneme_classes = {'SIL': 'silence', '+NSN+': 'silence', '+SPN+': 'silence',
+                   'B': 'bilabial', 'M': 'bilabial', 'P': 'bilabial',
+                   'F': 'labiodental', 'V': 'labiodental'}
+for p in ['AA', 'AE', 'AH', 'AO', 'AW', 'AY', 'EH', 'ER', 'EY', 'IH',
+          'IY', 'OW', 'OY', 'UH', 'UW']:
+    phoneme_classes[p] = 'vowel'
+for p in yasp_phonemes:
+    phoneme_classes.setdefault(p, 'consonant')
+
+# attack, hold and decay in seconds of the viseme of each phoneme class.
+# The attack starts before the phoneme is heard, which is what makes the
+# mouth anticipate the next sound. Lips have to fully close on bilabials,
+# so those are sharp. Silence doesn't produce a viseme.
+coarticulation_kernels = {'bilabial': (0.04, 0.02, 0.05),
+                          'labiodental': (0.05, 0.02, 0.06),
+                          'vowel': (0.08, 0.0, 0.10),
+                          'consonant': (0.06, 0.0, 0.07)}
+
+# Build the kernel of a phoneme class on a grid of fps frames per second.
+# Returns the taps and the offset of the first tap. Tap i weighs the
+# phoneme's presence at frame t + offset - i into frame t.
+def coarticulation_kernel(attack, hold, decay, fps):
+    import numpy as np
+
+    attack = int(round(attack * fps))
+    hold = int(round(hold * fps))
+    decay = int(round(decay * fps))
+    up = 1 - np.arange(attack, 0, -1) / (attack + 1)
+    flat = np.ones(hold + 1)
+    down = 1 - np.arange(1, decay + 1) / (decay + 1)
+    return np.concatenate((up, flat, down)), attack
+
+# Correlate every column of x along the frames axis with kernel, taking
+# the first tap from offset frames ahead.
+def convolve_frames(x, kernel, offset):
+    import numpy as np
+
+    pad = len(kernel)
+    xp = np.zeros((x.shape[0] + 2 * pad,) + x.shape[1:], dtype=x.dtype)
+    xp[pad:pad + x.shape[0]] = x
+    out = np.zeros_like(x)
+    for i, w in enumerate(kernel):
+        shift = pad + offset - i
+        out += w * xp[shift:shift + x.shape[0]]
+    return out
+
+# Compute blended viseme values for every frame of a phoneme track.
+#   ids: phoneme ids of the track (see PhonemeMap.get_ids())
+#   starts, ends: frames each phoneme starts and ends on
+#   pmap: the compiled PhonemeMap
+# Returns the frames, a frames x visemes matrix of values and the rest
+# pose value of each frame.
+def coarticulate(ids, starts, ends, fps, pmap, rest_level=0.5,
+                 kernels=coarticulation_kernels):
+    import numpy as np
+
+    ids = np.asarray(ids, dtype=np.intp)
+    starts = np.asarray(starts, dtype=np.intp)
+    ends = np.maximum(np.asarray(ends, dtype=np.intp), starts + 1)
+    nphonemes = len(yasp_phonemes)
+
+    built = {}
+    margin = 1
+    for name, (attack, hold, decay) in kernels.items():
+        built[name] = coarticulation_kernel(attack, hold, decay, fps)
+        margin = max(margin, len(built[name][0]))
+
+    # don't run the track past frame 0 unless it starts there
+    first = min(max(int(starts.min()) - margin, 0), int(starts.min()))
+    last = int(ends.max()) + margin
+    nframes = last - first
+
+    # presence of each phoneme on each frame, built from the segment
+    # boundaries with a cumulative sum. Unknown phonemes are dropped.
+    known = ids < nphonemes
+    edges = np.zeros((nframes + 1, nphonemes))
+    np.add.at(edges, (starts[known] - first, ids[known]), 1)
+    np.add.at(edges, (ends[known] - first, ids[known]), -1)
+    presence = np.clip(np.cumsum(edges, axis=0)[:nframes], 0, 1)
+
+    activation = np.zeros_like(presence)
+    classes = np.array([phoneme_classes[p] for p in yasp_phonemes])
+    for name, (kernel, offset) in built.items():
+        cols = (classes == name).nonzero()[0]
+        activation[:, cols] = np.clip(
+            convolve_frames(presence[:, cols], kernel, offset), 0, 1)
+
+    # overlapping phonemes share the mouth
+    total = activation.sum(axis=1)
+    activation = activation / np.maximum(total, 1)[:, None]
+    values = pmap.evaluate(activation)
+    rest = rest_level * (1 - np.clip(total, 0, 1))
+
+    return np.arange(first, last), values, rest
+
+# Mark which frames of a curve need a key. Starting from the last key,
+# frames are dropped for as long as a line from that key reproduces all
+# of them within tolerance, so the error can't build up over a slow curve.
+# At most max_run - 1 frames are dropped in a row. values is frames x
+# curves.
+def key_frames_mask(values, tolerance=1e-3, max_run=32):
+    import numpy as np
+
+    n = len(values)
+    keep = np.zeros(values.shape, dtype=bool)
+    if n == 0:
+        return keep
+    keep[0] = True
+    keep[-1] = True
+    offsets = np.arange(1, max_run + 1)
+    # the last key of every curve, the curves are stepped together
+    start = np.zeros(values.shape[1], dtype=int)
+    curves = np.arange(values.shape[1])
+    while True:
+        active = start < n - 1
+        if not active.any():
+            break
+        s = start[active]
+        c = curves[active]
+        idx = np.minimum(s[:, None] + np.arange(max_run + 1), n - 1)
+        seg = values[idx, c[:, None]]
+        rise = seg[:, 1:] - seg[:, :1]
+        # The slopes of the lines from the key which pass every frame up to
+        # and including the one at each offset within tolerance, and the
+        # slope of the line from the key to each frame. A frame can have
+        # the next key if its line passes all the frames before it.
+        lo = np.maximum.accumulate((rise - tolerance) / offsets, axis=1)
+        hi = np.minimum.accumulate((rise + tolerance) / offsets, axis=1)
+        slope = rise[:, 1:] / offsets[1:]
+        miss = (slope < lo[:, :-1]) | (slope > hi[:, :-1])
+        # there are no lines past the last frame
+        miss |= offsets[1:] > (n - 1 - s)[:, None]
+        # the key goes on the frame before the first line that misses
+        run = np.where(miss.any(axis=1), miss.argmax(axis=1) + 1, max_run)
+        start[active] = s + run
+        keep[s + run, c] = True
+    return keep
+
+# Read a PCM wave file with the wave module. Returns the samples mixed
+# down to mono as floats in [-1, 1] and the sample rate.
+def read_wave(path):
+    import wave
+    import numpy as np
+
+    with wave.open(path, 'rb') as w:
+        rate = w.getframerate()
+        width = w.getsampwidth()
+        channels = w.getnchannels()
+        data = w.readframes(w.getnframes())
+    if width == 1:
+        samples = (np.frombuffer(data, np.uint8) - 128.0) / 128.0
+    elif width == 2:
+        samples = np.frombuffer(data, '<i2') / 32768.0
+    elif width == 3:
+        b = np.frombuffer(data, np.uint8).reshape(-1, 3).astype(np.int32)
+        v = b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16)
+        samples = np.where(v >= 1 << 23, v - (1 << 24), v) / float(1 << 23)
+    elif width == 4:
+        samples = np.frombuffer(data, '<i4') / float(1 << 31)
+    else:
+        raise ValueError('unsupported sample width %d' % width)
+    return samples.reshape(-1, channels).mean(axis=1), rate
+
+# Frequency bands (Hz) the energy of speech is split into: the open vowels
+# sit in the first formant, spread vowels push energy into the second one
+# and fricatives are mostly noise above it.
+speech_bands = [(80, 800), (800, 2500), (2500, 8000)]
+
+# Loudness and spectral balance of the samples on a grid of fps frames
+# per second. Every frame looks at a Hann window of two frames centred on
+# it. Returns the RMS of every frame and frames x bands with the share of
+# the frame's speech energy in each band. The frames are processed in
+# blocks to bound the memory used on long files. Nothing above the bands
+# is needed, so high sample rates are brought down to about 16kHz first by
+# averaging runs of samples.
+def energy_envelope(samples, rate, fps, bands=speech_bands, block=4096):
+    import numpy as np
+
+    factor = int(rate // 16000)
+    if factor > 1:
+        samples = samples[:len(samples) // factor * factor]
+        samples = samples.reshape(-1, factor).mean(axis=1)
+        rate = rate / float(factor)
+    hop = rate / float(fps)
+    win = max(int(2 * hop) // 2 * 2, 2)
+    nfft = 1 << (win - 1).bit_length()
+    nframes = int(len(samples) / hop) + 1
+    padded = np.concatenate((np.zeros(win // 2), samples,
+                             np.zeros(win)))
+    window = np.hanning(win)
+    freqs = np.fft.rfftfreq(nfft, 1.0 / rate)
+    masks = np.array([(freqs >= lo) & (freqs < hi) for lo, hi in bands],
+                     dtype=float).T
+
+    rms = np.zeros(nframes)
+    shares = np.zeros((nframes, len(bands)))
+    taps = np.arange(win)
+    for first in range(0, nframes, block):
+        starts = (np.arange(first, min(first + block, nframes)) * hop)
+        frames = padded[starts.astype(np.intp)[:, None] + taps]
+        rms[first:first + len(starts)] = np.sqrt(np.mean(frames ** 2,
+                                                          axis=1))
+        power = np.abs(np.fft.rfft(frames * window, n=nfft)) ** 2
+        energy = power @ masks
+        shares[first:first + len(starts)] = \
+            energy / np.maximum(energy.sum(axis=1), 1e-12)[:, None]
+    return rms, shares
+
+# The visemes driven by each band of speech_bands
+energy_visemes = ['AI', 'E', 'CDGKNRSYZ']
+
+# Turn an energy envelope into viseme values. The loudness in dB is
+# scaled between the noise floor and the loud parts of the take, and
+# opens the viseme of the dominant band by that much, the others in
+# proportion to their share. Returns frames x visemes and the rest pose
+# value of every frame, like coarticulate().
+def energy_viseme_values(rms, shares, visemes, gain=1.0, range_db=40.0,
+                         rest_level=0.5):
+    import numpy as np
+
+    db = 20 * np.log10(np.maximum(rms, 1e-9))
+    peak = np.percentile(db, 95)
+    floor = max(np.percentile(db, 10), peak - range_db)
+    level = np.clip((db - floor) / max(peak - floor, 1e-6) * gain, 0, 1)
+    # the jaw can't follow the envelope frame by frame
+    level = np.convolve(np.pad(level, 1, mode='edge'), [0.25, 0.5, 0.25],
+                        mode='valid')
+
+    values = np.zeros((len(rms), len(visemes)))
+    dominant = shares / np.maximum(shares.max(axis=1), 1e-12)[:, None]
+    for band, viseme in enumerate(energy_visemes):
+        if viseme in visemes:
+            values[:, visemes.index(viseme)] = level * dominant[:, band]
+    return values, rest_level * (1 - level)
+
+# The words of a transcript as they might be looked up in the
+# pronunciation dictionary: lower case, with and without the punctuation
+# around them. Returns a list of lists of the forms of every word, in the
+# order they first appear.
+def transcript_words(text):
+    words = []
+    seen = set()
+    for token in text.lower().split():
+        stripped = token.strip('.,;:!?"()[]{}-')
+        if not stripped:
+            continue
+        forms = [stripped]
+        if stripped != token:
+            forms.append(token)
+        if stripped not in seen:
+            seen.add(stripped)
+            words.append(forms)
+    return words
+
+# The lines of a pocketsphinx dictionary keyed by word. Alternative
+# pronunciations, word(2) and so on, are kept under the word.
+def read_dictionary(path):
+    entries = collections.defaultdict(list)
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            word = line.split(None, 1)[0] if line.strip() else ''
+            if not word:
+                continue
+            paren = word.find('(', 1)
+            if paren > 0 and word.endswith(')'):
+                word = word[:paren]
+            entries[word].append(line.rstrip('\n') + '\n')
+    return entries
+
+# Write the entries of the transcript's words to path. Returns the words
+# none of whose forms are in the dictionary.
+def write_pruned_dictionary(entries, words, path):
+    oov = []
+    written = set()
+    with open(path, 'w', encoding='utf-8') as f:
+        for forms in words:
+            found = [w for w in forms if w in entries]
+            if not found:
+                oov.append(forms[0])
+            for w in found:
+                if w not in written:
+                    written.add(w)
+                    f.writelines(entries[w])
+    return oov
+
+# Acoustic model directories, laid out like the shipped one, whose
+# dictionaries only hold the words of one transcript. Loading the full
+# dictionary dominates the start up of the aligner although a transcript
+# uses a handful of its words. Everything but the dictionaries is
+# symlinked to the shipped model. An entry is keyed by the content of the
+# transcript and of the dictionaries, and records the out of vocabulary
+# words so they're known without running the aligner.
+class PrunedModelCache(file_cache.FileCache):
+    def __init__(self, root, model_dir):
+        super(PrunedModelCache, self).__init__(root)
+        self.model_dir = model_dir
+        # parsed dictionaries by path, with the hash they were parsed at
+        self.dictionaries = {}
+
+    def get_dictionary_paths(self, src=None):
+        if src is None:
+            src = self.model_dir
+        paths = []
+        for name in sorted(os.listdir(src)):
+            path = os.path.join(src, name)
+            if name.endswith('.dict'):
+                paths.append(path)
+            elif os.path.isdir(path) and not os.path.islink(path):
+                paths.extend(self.get_dictionary_paths(path))
+        return paths
+
+    def get_dictionary(self, path):
+        digest = self.get_file_hash(path)
+        cached = self.dictionaries.get(path)
+        if cached and cached[0] == digest:
+            return cached[1]
+        entries = read_dictionary(path)
+        self.dictionaries[path] = (digest, entries)
+        return entries
+
+    # Recreate the directories of src holding a dictionary under dst, with
+    # the dictionaries pruned to words and everything else symlinked.
+    # Returns the out of vocabulary words of the dictionaries.
+    def mirror(self, src, dst, words, dicts):
+        os.makedirs(dst)
+        oov = set()
+        for name in os.listdir(src):
+            s = os.path.join(src, name)
+            d = os.path.join(dst, name)
+            if s in dicts:
+                entries = self.get_dictionary(s)
+                oov.update(write_pruned_dictionary(entries, words, d))
+            elif any(p.startswith(s + os.sep) for p in dicts):
+                oov.update(self.mirror(s, d, words, dicts))
+            else:
+                os.symlink(s, d)
+        return oov
+
+    # The model directory to give the aligner for the transcript, the
+    # number of distinct words in the transcript and those of them which
+    # aren't in the dictionary
+    def get_model_dir(self, transcript):
+        dicts = self.get_dictionary_paths()
+        if not dicts:
+            return self.model_dir, 0, []
+        key = self.get_key([transcript] + dicts,
+                           {'model_dir': os.path.realpath(self.model_dir)})
+        path = self.get_path(key)
+        entry = self.load()['entries'].get(key)
+        if entry and os.path.isdir(path):
+            return path, entry['words'], entry['oov']
+
+        with open(transcript, 'r', encoding='utf-8', errors='replace') as f:
+            words = transcript_words(f.read())
+        # built aside and moved in place, other processes may share the
+        # cache
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        self.remove_path(tmp)
+        try:
+            oov = self.mirror(self.model_dir, tmp, words, set(dicts))
+            if not os.path.isdir(path):
+                os.rename(tmp, path)
+        finally:
+            self.remove_path(tmp)
+        oov = [forms[0] for forms in words if forms[0] in oov]
+        self.add_entry(key, [transcript] + dicts,
+                       {'transcript': os.path.realpath(transcript),
+                        'words': len(words), 'oov': oov})
+        return path, len(words), oov